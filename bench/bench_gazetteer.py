@@ -0,0 +1,157 @@
+"""Микробенчмарк: решение «нужна ли справка из вики».
+
+Сравнивает прежнюю эвристику (больше трёх слов и монетка 60%, запрос — весь
+текст) со словарём сущностей (gazetteer.py):
+
+* стоимость проверки одного сообщения — автомат Ахо — Корасик против наивного
+  перебора всех псевдонимов, в том числе на словаре, раздутом синтетическими
+  заголовками (--extra-titles);
+* сколько сообщений на самом деле уходит в вики и сколько разных запросов
+  получается (от этого зависит попадание в кэш вики).
+
+Сообщения берутся из файла (--messages, по одному в строке) или из встроенной
+смеси болтовни и вопросов о Fallout:
+
+    python bench/bench_gazetteer.py --extra-titles 50000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gazetteer as gz  # noqa: E402
+
+CHATTER = [
+    "Привет",
+    "Привет, как дела?",
+    "Доброе утро, синт, чем занимаешься сегодня?",
+    "Спасибо, очень помог, ты лучший",
+    "Мне скучно, расскажи что-нибудь интересное",
+    "Что ты думаешь о погоде сегодня вечером?",
+    "ахахах ну ты даёшь конечно",
+    "Пойду посплю, завтра рано вставать на работу",
+    "Ты вообще умеешь нормально отвечать на вопросы?",
+    "Какой сегодня день недели, не подскажешь?",
+    "Я устал после работы и хочу просто поболтать",
+    "Ладно, пока, до завтра",
+]
+QUESTIONS = [
+    "Где найти силовую броню в Бостоне?",
+    "Расскажи про Братство Стали и их дирижабль",
+    "Чем опасны когти смерти на пустоши?",
+    "Как лучше лечить радиацию без антирадина?",
+    "Что случилось с Институтом после войны?",
+    "Сколько стоит стимпак у торговцев в Даймонд-сити?",
+    "Кто такие гули и почему они светятся?",
+    "Какое оружие лучше против супермутантов?",
+    "Где безопасно переночевать около Убежища 111?",
+    "Стоит ли вступать в Подземку или лучше к минитменам?",
+    "Кто такой мистер Хаус и зачем ему Нью-Вегас?",
+    "Из чего делают ядер-колу квантум?",
+]
+
+
+def legacy_query(text: str, rng: random.Random):
+    """Прежнее условие из _handle_dialog: весь текст уходит в opensearch"""
+    if len(text.split()) > 3 and rng.random() > 0.4:
+        return text
+    return None
+
+
+class NaiveMatcher:
+    """Для сравнения: каждый псевдоним ищется в тексте отдельно"""
+    def __init__(self, entries):
+        self.patterns = []
+        for key, aliases in entries:
+            for alias in (key, *aliases):
+                pattern = gz._pattern(alias)
+                if len(pattern.strip()) >= 2:
+                    self.patterns.append((pattern, key))
+
+    def find(self, text: str):
+        normalized = gz.normalize(text)
+        best = None
+        for pattern, key in self.patterns:
+            if pattern in normalized and (best is None or len(pattern) > len(best[0])):
+                best = (pattern, key)
+        return best[1] if best else None
+
+
+def synthetic_titles(count: int, rng: random.Random) -> list:
+    syllables = ["ка", "ро", "зен", "тар", "вол", "мир", "лекс", "dor", "van", "shi", "kel", "mon"]
+    return [
+        " ".join("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize()
+                 for _ in range(rng.randint(1, 3)))
+        for _ in range(count)
+    ]
+
+
+def per_message_us(find, messages: list, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in messages:
+            find(text)
+    return (time.perf_counter() - start) / (repeat * len(messages)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gazetteer", default=gz.DEFAULT_PATH)
+    parser.add_argument("--messages", help="файл с сообщениями, по одному в строке")
+    parser.add_argument("--count", type=int, default=2000, help="сколько сообщений взять из встроенной смеси")
+    parser.add_argument("--chatter-share", type=float, default=0.6, help="доля болтовни во встроенной смеси")
+    parser.add_argument("--extra-titles", type=int, default=0, help="добавить синтетических заголовков в словарь")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.messages:
+        with open(args.messages, encoding="utf-8") as f:
+            messages = [line.strip() for line in f if line.strip()]
+    else:
+        messages = [rng.choice(CHATTER if rng.random() < args.chatter_share else QUESTIONS)
+                    for _ in range(args.count)]
+
+    with open(args.gazetteer, encoding="utf-8") as f:
+        base_entries = gz.parse_entries(f)
+    entries = base_entries
+    if args.extra_titles:
+        entries = gz.build_entries(synthetic_titles(args.extra_titles, rng), base_entries)
+
+    start = time.perf_counter()
+    gazetteer = gz.Gazetteer(entries)
+    build_ms = (time.perf_counter() - start) * 1000
+    naive = NaiveMatcher(entries)
+
+    print(f"словарь: статей {len(gazetteer.keys)}, псевдонимов {len(gazetteer)}, "
+          f"состояний автомата {len(gazetteer._goto)}, сборка {build_ms:.1f} мс")
+    print(f"сообщений: {len(messages)}")
+    print()
+    print(f"{'matcher':<20}{'мкс/сообщение':>15}")
+    print("-" * 35)
+    print(f"{'aho-corasick':<20}{per_message_us(gazetteer.find, messages, args.repeat):>15.1f}")
+    print(f"{'naive scan':<20}{per_message_us(naive.find, messages, max(1, args.repeat // 5)):>15.1f}")
+    print(f"{'normalize only':<20}{per_message_us(gz.normalize, messages, args.repeat):>15.1f}")
+
+    legacy_rng = random.Random(args.seed)
+    legacy = [legacy_query(text, legacy_rng) for text in messages]
+    # Решения — по настоящему словарю: синтетические заголовки нужны только для замера скорости
+    gate = gz.Gazetteer(base_entries) if args.extra_titles else gazetteer
+    gated = [gate.find(text) for text in messages]
+    chatter = set(CHATTER)
+    print()
+    print(f"{'gate':<20}{'в вики':>10}{'доля':>8}{'разных запросов':>18}{'из них болтовня':>18}")
+    print("-" * 74)
+    for name, queries in (("legacy", legacy), ("gazetteer", gated)):
+        calls = [(text, query) for text, query in zip(messages, queries) if query]
+        wasted = sum(1 for text, _ in calls if text in chatter)
+        print(f"{name:<20}{len(calls):>10}{len(calls) / len(messages):>8.0%}"
+              f"{len({query for _, query in calls}):>18}{wasted:>18}")
+
+
+if __name__ == "__main__":
+    main()
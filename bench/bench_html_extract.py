@@ -0,0 +1,176 @@
+"""Микробенчмарк: прежний _clean_html против WikiTextExtractor.
+
+Страницы берутся из каталога (по умолчанию bench/pages): *.html — готовый HTML,
+*.json — сохранённый ответ api.php?action=parse. Скачать страницы:
+
+    python bench/bench_html_extract.py --fetch Ghoul "Brotherhood of Steel" Institute
+
+Если страниц нет, используется синтетическая страница в духе fandom.
+
+Для каждой страницы печатается процессорное время на один разбор и максимальная
+задержка цикла событий, пока разбор выполняется внутри asyncio (для нового
+экстрактора — и в варианте с пулом потоков).
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+import bot  # noqa: E402
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+
+
+def legacy_clean_html(html: str) -> str:
+    """Копия WikiClient._clean_html до замены на WikiTextExtractor"""
+    html = re.sub(r'<script.*?>.*?</script>', '', html, flags=re.DOTALL)
+    html = re.sub(r'<style.*?>.*?</style>', '', html, flags=re.DOTALL)
+    html = re.sub(r'<!--.*?-->', '', html, flags=re.DOTALL)
+    html = re.sub(r'<br\s*/?>|</p>|</div>|</li>', '\n', html, flags=re.IGNORECASE)
+    html = re.sub(r'</h[1-6]>', '\n\n', html, flags=re.IGNORECASE)
+    text = re.sub(r'<[^>]+>', '', html)
+    text = re.sub(r'\n\s*\n', '\n\n', text)
+    text = re.sub(r' +', ' ', text)
+    return text.strip()
+
+
+def legacy_extract(html: str, limit: int) -> str:
+    return legacy_clean_html(html)[:limit]
+
+
+def synthetic_page(paragraphs: int = 400) -> str:
+    infobox = (
+        '<aside class="portable-infobox pi-theme-fallout">'
+        + "".join(f'<div class="pi-item"><h3>Поле {i}</h3><div>Значение {i}</div></div>' for i in range(40))
+        + "</aside>"
+    )
+    body = "".join(
+        f'<h2><span class="mw-headline">Раздел {i}</span></h2>'
+        f'<p>Гули — это люди, подвергшиеся сильному облучению <a href="/wiki/Radiation">радиацией</a> '
+        f'во время <b>Великой войны</b> 2077 года. Абзац {i}.<sup class="reference">[{i}]</sup></p>'
+        f'<script>var x{i} = "{"a" * 200}";</script><!-- комментарий {i} -->'
+        for i in range(paragraphs)
+    )
+    navbox = '<table class="navbox">' + "<tr><td>ссылка</td></tr>" * 300 + "</table>"
+    return f'<div class="mw-parser-output">{infobox}{body}{navbox}</div>'
+
+
+def load_pages(directory: str) -> dict:
+    pages = {}
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            with open(path, encoding="utf-8") as f:
+                if name.endswith(".html"):
+                    pages[name] = f.read()
+                elif name.endswith(".json"):
+                    pages[name] = json.load(f)["parse"]["text"]["*"]
+    if not pages:
+        pages["synthetic.html"] = synthetic_page()
+    return pages
+
+
+async def fetch_pages(titles: list, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    client = bot.WikiClient()
+    await client.init()
+    try:
+        for title in titles:
+            params = {"action": "parse", "page": title, "format": "json", "prop": "text",
+                      "disableeditsection": 1, "disabletoc": 1}
+            async with client.session.get(client.base_url, params=params, timeout=30) as resp:
+                data = await resp.json()
+            path = os.path.join(directory, re.sub(r"\W+", "_", title) + ".json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            print(f"saved {path}")
+    finally:
+        await client.close()
+
+
+def cpu_time_per_call(fn, html: str, limit: int, repeat: int) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        fn(html, limit)
+    return (time.process_time() - start) / repeat
+
+
+async def max_loop_block(coro_factory, repeat: int) -> float:
+    """Максимальная задержка тикера с периодом 1 мс, пока выполняются разборы"""
+    worst = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal worst
+        loop = asyncio.get_running_loop()
+        while running:
+            before = loop.time()
+            await asyncio.sleep(0.001)
+            worst = max(worst, loop.time() - before - 0.001)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    for _ in range(repeat):
+        await coro_factory()
+        await asyncio.sleep(0)
+    running = False
+    await task
+    return worst
+
+
+async def run(args):
+    pages = load_pages(args.pages)
+    limit = args.limit
+    loop = asyncio.get_running_loop()
+
+    header = f"{'page':<32}{'size KB':>9}{'legacy cpu ms':>15}{'new cpu ms':>12}{'legacy block ms':>17}{'new block ms':>14}{'thread block ms':>17}"
+    print(header)
+    print("-" * len(header))
+    for name, html in pages.items():
+        legacy_cpu = cpu_time_per_call(legacy_extract, html, limit, args.repeat)
+        new_cpu = cpu_time_per_call(bot.extract_wiki_text, html, limit, args.repeat)
+
+        async def legacy_inline():
+            legacy_extract(html, limit)
+
+        async def new_inline():
+            bot.extract_wiki_text(html, limit)
+
+        async def new_thread():
+            await loop.run_in_executor(None, bot.extract_wiki_text, html, limit)
+
+        legacy_block = await max_loop_block(legacy_inline, args.repeat)
+        new_block = await max_loop_block(new_inline, args.repeat)
+        thread_block = await max_loop_block(new_thread, args.repeat)
+        print(f"{name[:31]:<32}{len(html) / 1024:>9.1f}{legacy_cpu * 1000:>15.3f}{new_cpu * 1000:>12.3f}"
+              f"{legacy_block * 1000:>17.2f}{new_block * 1000:>14.2f}{thread_block * 1000:>17.2f}")
+
+    if args.show:
+        for name, html in pages.items():
+            print(f"\n=== {name}: legacy ===\n{legacy_extract(html, limit)}")
+            print(f"\n=== {name}: new ===\n{bot.extract_wiki_text(html, limit)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", default=PAGES_DIR, help="каталог с сохранёнными страницами")
+    parser.add_argument("--fetch", nargs="+", metavar="TITLE", help="скачать страницы с fandom в --pages и выйти")
+    parser.add_argument("--limit", type=int, default=bot.WIKI_EXTRACT_CHARS)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--show", action="store_true", help="напечатать извлечённый текст")
+    args = parser.parse_args()
+
+    if args.fetch:
+        asyncio.run(fetch_pages(args.fetch, args.pages))
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
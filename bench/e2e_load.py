@@ -0,0 +1,523 @@
+"""Сквозной нагрузочный тест без внешних сервисов.
+
+Поднимает локальные стенды Telegram Bot API (getUpdates/sendMessage/sendChatAction
+и т. п.), YandexGPT (completion, в том числе потоковый) и fandom api.php
+(opensearch/parse), запускает настоящий bot.py отдельным процессом в режиме
+polling и гоняет через него N синтетических пользователей: личные чаты,
+группы (упоминание или ответ на сообщение бота) и вопросы про имя.
+
+Нужен Postgres либо встроенное хранилище (--storage memory, данные во временном каталоге):
+
+    DATABASE_URL=postgresql://postgres@127.0.0.1:5432/bench \\
+        python bench/e2e_load.py --users 200 --messages 5 --llm-latency-ms 600
+    python bench/e2e_load.py --storage memory --users 200
+
+Каждый пользователь отправляет сообщение, ждёт ответа и «думает» перед
+следующим. Итог: сообщений в секунду, p50/p95/p99 задержки ответа (от выдачи
+обновления до последнего sendMessage ответа), SQL-операторов на сообщение
+(по метрике synth_db_statements_total бота) и пиковый RSS процесса бота.
+С --abusers N параллельно работают нарушители, которые без пауз пишут боту в
+несколько групп; задержки по-прежнему считаются только для обычных пользователей,
+а отказы допуска к генерации печатаются отдельно.
+Остальные переменные окружения (COALESCE_WINDOW, LLM_STREAMING и т. д.)
+передаются боту как есть.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import deque
+
+from aiohttp import web
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_PATH = os.path.join(BENCH_DIR, "..", "bot.py")
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+
+from bench_html_extract import synthetic_page  # noqa: E402
+
+BOT_TOKEN = "123456:BENCHMARK"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Synth", "username": "synth_bench_bot"}
+
+QUESTIONS = [
+    "Где найти силовую броню в Бостоне?",
+    "Расскажи про Братство Стали и их дирижабль",
+    "Чем опасны когти смерти на пустоши?",
+    "Как лучше лечить радиацию без антирадина?",
+    "Что случилось с Институтом после войны?",
+    "Сколько стоит стимпак у торговцев в Даймонд-сити?",
+    "Привет",
+    "Кто такие гули и почему они светятся?",
+    "Какое оружие лучше против супермутантов?",
+    "Где безопасно переночевать около Убежища 111?",
+]
+NAME_QUESTIONS = ["Как тебя зовут?", "Ты кто такой вообще?", "Назови своё имя"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def sample_latency(median_ms: float, sigma: float) -> float:
+    """Логнормальная задержка в секундах с заданной медианой"""
+    if median_ms <= 0:
+        return 0.0
+    return median_ms / 1000 * random.lognormvariate(0, sigma)
+
+
+# ============ СТЕНД TELEGRAM ============
+class TelegramStub:
+    """Минимальный Bot API: очередь обновлений для getUpdates и журнал отправленных сообщений"""
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self.updates = []
+        self.first_update_id = 1
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.new_updates = asyncio.Event()
+        self.polling = asyncio.Event()
+        self.on_reply = None
+        self.calls = {}
+
+    def push(self, update: dict):
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def make_message(self, chat: dict, text: str, sender: dict = None) -> dict:
+        message = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": sender or BOT_USER,
+            "text": text,
+        }
+        self.next_message_id += 1
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post())
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        if self.latency_ms:
+            await asyncio.sleep(sample_latency(self.latency_ms, 0.3))
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+            result = self.make_message(chat, params.get("text", ""))
+            if method == "sendMessage" and self.on_reply:
+                self.on_reply(chat_id)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: dict) -> list:
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        # Подтверждённые обновления больше не нужны
+        if offset > self.first_update_id:
+            del self.updates[:offset - self.first_update_id]
+            self.first_update_id = offset
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+# ============ СТЕНД YANDEXGPT ============
+class YandexGPTStub:
+    def __init__(self, latency_ms: float, sigma: float, error_rate: float, chunks: int):
+        self.latency_ms = latency_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.chunks = chunks
+        self.requests = 0
+        self.errors = 0
+
+    @staticmethod
+    def _chunk(text: str) -> bytes:
+        return (json.dumps({"result": {"alternatives": [{"message": {"role": "assistant", "text": text}}]}},
+                           ensure_ascii=False) + "\n").encode()
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        payload = await request.json()
+        delay = sample_latency(self.latency_ms, self.sigma)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(delay / 4)
+            return web.json_response({"error": {"message": "stub: internal error"}}, status=500)
+
+        question = payload["messages"][-1]["text"][:40]
+        text = f"Слушай, выживший, про «{question}» скажу так: держись подальше от радиации. Пип-бой согласен."
+        if not payload.get("completionOptions", {}).get("stream"):
+            await asyncio.sleep(delay)
+            return web.json_response({"result": {"alternatives": [
+                {"message": {"role": "assistant", "text": text}, "status": "ALTERNATIVE_STATUS_FINAL"}
+            ]}})
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for i in range(1, self.chunks + 1):
+            await asyncio.sleep(delay / self.chunks)
+            await response.write(self._chunk(text[:len(text) * i // self.chunks]))
+        await response.write_eof()
+        return response
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/foundationModels/v1/completion", self.handle)
+        return app
+
+
+# ============ СТЕНД FANDOM ============
+class FandomStub:
+    def __init__(self, latency_ms: float, miss_rate: float, paragraphs: int):
+        self.latency_ms = latency_ms
+        self.miss_rate = miss_rate
+        self.page = synthetic_page(paragraphs)
+        self.requests = {}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        action = request.query.get("action")
+        self.requests[action] = self.requests.get(action, 0) + 1
+        await asyncio.sleep(sample_latency(self.latency_ms, 0.5))
+        if action == "opensearch":
+            query = request.query.get("search", "")
+            if random.random() < self.miss_rate:
+                return web.json_response([query, [], [], []])
+            # Несколько заголовков на весь корпус, чтобы кэш страниц работал как в жизни
+            title = f"Статья {hash(query) % 50}"
+            return web.json_response([query, [title], [""], [f"https://fallout.fandom.com/wiki/{title}"]])
+        if action == "parse":
+            return web.json_response({"parse": {"title": request.query.get("page"), "text": {"*": self.page}}})
+        return web.json_response({"error": {"code": "badaction"}}, status=400)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api.php", self.handle)
+        return app
+
+
+# ============ НАГРУЗКА ============
+class LoadGenerator:
+    """Синтетические пользователи в замкнутом цикле: вопрос → ответ → пауза → вопрос.
+
+    Ответы в чате приходят в порядке обработки (бот обрабатывает чат строго
+    последовательно), поэтому каждый sendMessage засчитывается самому старому
+    ожидающему запросу этого чата. Вопрос про имя ждёт четыре сообщения.
+    """
+    def __init__(self, telegram: TelegramStub, args):
+        self.telegram = telegram
+        self.args = args
+        self.pending = {}     # chat_id -> deque[[осталось ответов, время отправки, future]]
+        self.latencies = []
+        self.latencies_by_chat = {"private": [], "group": []}
+        self.timeouts = 0
+        self.sent = 0
+        self.abuse_sent = 0
+        telegram.on_reply = self.on_reply
+
+    def on_reply(self, chat_id: int):
+        queue = self.pending.get(chat_id)
+        if not queue:
+            return
+        request = queue[0]
+        request[0] -= 1
+        if request[0] <= 0:
+            queue.popleft()
+            if not request[2].done():
+                request[2].set_result(time.perf_counter() - request[1])
+
+    async def ask(self, chat: dict, user: dict, text: str, expected: int, reply_to_bot: bool):
+        message = self.telegram.make_message(chat, text, user)
+        if reply_to_bot:
+            message["reply_to_message"] = self.telegram.make_message(chat, "...")
+        request = [expected, time.perf_counter(), asyncio.get_running_loop().create_future()]
+        self.pending.setdefault(chat["id"], deque()).append(request)
+        self.telegram.push({"message": message})
+        self.sent += 1
+        try:
+            latency = await asyncio.wait_for(asyncio.shield(request[2]), self.args.reply_timeout)
+            self.latencies.append(latency)
+            self.latencies_by_chat["private" if chat["type"] == "private" else "group"].append(latency)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            try:
+                self.pending[chat["id"]].remove(request)
+            except ValueError:
+                pass
+
+    async def user(self, index: int):
+        args = self.args
+        user = {"id": 10_000 + index, "is_bot": False, "first_name": f"Bench{index}"}
+        if args.groups and random.random() < args.group_share:
+            group_id = -1_000_000 - index % args.groups
+            chat = {"id": group_id, "type": "supergroup", "title": f"Bench group {group_id}"}
+        else:
+            chat = {"id": user["id"], "type": "private", "first_name": user["first_name"]}
+        group = chat["type"] != "private"
+
+        await asyncio.sleep(random.uniform(0, args.ramp_up))
+        for _ in range(args.messages):
+            if random.random() < args.name_share:
+                text, expected = random.choice(NAME_QUESTIONS), 4
+            else:
+                text, expected = random.choice(QUESTIONS), 1
+            reply_to_bot = group and random.random() < 0.5
+            if group and not reply_to_bot:
+                text = f"@{BOT_USER['username']} {text}"
+            await self.ask(chat, user, text, expected, reply_to_bot)
+            await asyncio.sleep(random.expovariate(1000 / args.think_ms) if args.think_ms else 0)
+
+    async def abuser(self, index: int, stop: asyncio.Event):
+        """Нарушитель: без пауз упоминает бота в нескольких группах и не ждёт ответов"""
+        args = self.args
+        user = {"id": 90_000 + index, "is_bot": False, "first_name": f"Abuser{index}"}
+        chats = [
+            {"id": -2_000_000 - index * 100 - k, "type": "supergroup", "title": f"Abuse group {index}.{k}"}
+            for k in range(args.abuse_chats)
+        ]
+        sent = 0
+        while not stop.is_set():
+            chat = chats[sent % len(chats)]
+            text = f"@{BOT_USER['username']} {random.choice(QUESTIONS)}"
+            self.telegram.push({"message": self.telegram.make_message(chat, text, user)})
+            sent += 1
+            self.abuse_sent += 1
+            await asyncio.sleep(1 / args.abuse_rate)
+
+    async def run(self) -> float:
+        """Время работы обычных пользователей (задержки считаются только для них)"""
+        stop = asyncio.Event()
+        abusers = [asyncio.create_task(self.abuser(i, stop)) for i in range(self.args.abusers)]
+        start = time.perf_counter()
+        await asyncio.gather(*(self.user(i) for i in range(self.args.users)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*abusers)
+        return elapsed
+
+
+# ============ ПРОЦЕСС БОТА ============
+async def scrape_metrics(session: aiohttp.ClientSession, port: int) -> dict:
+    """Метрики бота без гистограмм: {"имя{метки}": значение}"""
+    async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+        text = await resp.text()
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#") and "_bucket{" not in line:
+            name, _, value = line.rpartition(" ")
+            values[name] = float(value)
+    return values
+
+
+def db_statements(values: dict) -> float:
+    return sum(v for k, v in values.items() if k.startswith("synth_db_statements_total"))
+
+
+def labelled(before: dict, after: dict, metric: str) -> dict:
+    """Прирост счётчика по меткам за время нагрузки: {метка: значение}"""
+    return {
+        key.split('"')[1]: value - before.get(key, 0)
+        for key, value in after.items() if key.startswith(metric + "{")
+    }
+
+
+def stage_means(before: dict, after: dict) -> list:
+    """[(этап, сумма секунд, число замеров)] по synth_stage_seconds за время нагрузки"""
+    result = []
+    for key, total in after.items():
+        if not key.startswith("synth_stage_seconds_sum{"):
+            continue
+        count = after[key.replace("_sum{", "_count{")] - before.get(key.replace("_sum{", "_count{"), 0)
+        if count:
+            stage = key.split('"')[1]
+            result.append((stage, total - before.get(key, 0), count))
+    return result
+
+
+def peak_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+async def wait_for(predicate, timeout: float, interval: float = 0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await predicate():
+            return True
+        await asyncio.sleep(interval)
+    return False
+
+
+async def run(args):
+    telegram = TelegramStub(args.telegram_latency_ms)
+    llm = YandexGPTStub(args.llm_latency_ms, args.llm_sigma, args.llm_error_rate, args.llm_chunks)
+    fandom = FandomStub(args.wiki_latency_ms, args.wiki_miss_rate, args.wiki_paragraphs)
+
+    runners = []
+    ports = {}
+    for name, stub in (("telegram", telegram), ("llm", llm), ("wiki", fandom)):
+        runner = web.AppRunner(stub.app(), access_log=None)
+        await runner.setup()
+        ports[name] = free_port()
+        await web.TCPSite(runner, "127.0.0.1", ports[name]).start()
+        runners.append(runner)
+    metrics_port = free_port()
+    data_dir = tempfile.TemporaryDirectory(prefix="synth-bench-")
+
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "BOT_MODE": "polling",
+        "ALLOWED_USERS": "all",
+        "YC_API_KEY": "bench",
+        "YC_FOLDER_ID": "bench",
+        "STORAGE_BACKEND": args.storage,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{ports['telegram']}",
+        "YC_COMPLETION_URL": f"http://127.0.0.1:{ports['llm']}/foundationModels/v1/completion",
+        "WIKI_API_URL": f"http://127.0.0.1:{ports['wiki']}/api.php",
+        "METRICS_HOST": "127.0.0.1",
+        "METRICS_PORT": str(metrics_port),
+        "PYTHONUNBUFFERED": "1",
+    })
+    if args.storage == "memory":
+        env["MEMORY_STORE_PATH"] = data_dir.name
+    else:
+        env["DATABASE_URL"] = args.database_url
+    output = None if args.bot_output else asyncio.subprocess.DEVNULL
+    process = await asyncio.create_subprocess_exec(sys.executable, BOT_PATH, env=env, stdout=output, stderr=output)
+
+    session = aiohttp.ClientSession()
+    try:
+        try:
+            await asyncio.wait_for(telegram.polling.wait(), args.startup_timeout)
+        except asyncio.TimeoutError:
+            print("❌ Бот не начал опрашивать getUpdates (запустите с --bot-output, чтобы увидеть ошибку)")
+            return
+        before = await scrape_metrics(session, metrics_port)
+
+        generator = LoadGenerator(telegram, args)
+        elapsed = await generator.run()
+
+        # Дожидаемся, пока буфер истории уйдёт в БД, чтобы учесть и эти операторы
+        async def flushed():
+            return (await scrape_metrics(session, metrics_port)).get("synth_history_buffer_pending", 0) == 0
+        await wait_for(flushed, 30)
+        await asyncio.sleep(1)
+        after = await scrape_metrics(session, metrics_port)
+        rss = peak_rss_mb(process.pid)
+    finally:
+        await session.close()
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), 30)
+            except asyncio.TimeoutError:
+                process.kill()
+        for runner in runners:
+            await runner.cleanup()
+        data_dir.cleanup()
+
+    answered = len(generator.latencies)
+    statements = db_statements(after) - db_statements(before)
+    print(f"пользователей {args.users}, сообщений отправлено {generator.sent}, "
+          f"отвечено {answered}, без ответа за {args.reply_timeout:g} с: {generator.timeouts}")
+    print(f"время {elapsed:.1f} с, пропускная способность {answered / elapsed:.1f} сообщ./с")
+    print("задержка ответа, мс: " + ", ".join(
+        f"p{p} {percentile(generator.latencies, p) * 1000:.0f}" for p in (50, 95, 99)
+    ))
+    print("по типу чата, мс: " + "; ".join(
+        f"{kind} " + ", ".join(f"p{p} {percentile(values, p) * 1000:.0f}" for p in (50, 95, 99))
+        for kind, values in generator.latencies_by_chat.items() if values
+    ))
+    if args.abusers:
+        shed = labelled(before, after, "synth_admission_shed_total")
+        print(f"нарушителей {args.abusers}, их сообщений {generator.abuse_sent}; "
+              f"отклонено допуском: {dict(sorted((k, int(v)) for k, v in shed.items() if v))}")
+    cache = labelled(before, after, "synth_response_cache_total")
+    if any(cache.values()):
+        print(f"кэш ответов: {dict(sorted((k, int(v)) for k, v in cache.items() if v))}")
+    print(f"SQL-операторов на сообщение: {statements / max(generator.sent, 1):.2f}")
+    print(f"пиковый RSS бота: {f'{rss:.1f} МБ' if rss is not None else 'n/a'}")
+    print("этапы бота, среднее мс: " + ", ".join(
+        f"{stage} {total / count * 1000:.0f}" for stage, total, count in stage_means(before, after)
+    ))
+    print(f"YandexGPT: запросов {llm.requests}, ошибок {llm.errors}; fandom: {fandom.requests}; "
+          f"Telegram: {dict(sorted(telegram.calls.items()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storage", choices=["postgres", "memory"], default="postgres", help="хранилище бота")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="Postgres для бота (по умолчанию DATABASE_URL)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=5, help="сообщений на пользователя")
+    parser.add_argument("--think-ms", type=float, default=500, help="средняя пауза пользователя между вопросами")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="разброс старта пользователей (секунды)")
+    parser.add_argument("--groups", type=int, default=5, help="число групповых чатов")
+    parser.add_argument("--group-share", type=float, default=0.2, help="доля пользователей, пишущих в группы")
+    parser.add_argument("--name-share", type=float, default=0.05, help="доля вопросов про имя")
+    parser.add_argument("--abusers", type=int, default=0, help="нарушителей, засыпающих бота сообщениями")
+    parser.add_argument("--abuse-rate", type=float, default=20, help="сообщений в секунду от каждого нарушителя")
+    parser.add_argument("--abuse-chats", type=int, default=10, help="групп, в которые пишет каждый нарушитель")
+    parser.add_argument("--reply-timeout", type=float, default=30)
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--telegram-latency-ms", type=float, default=20)
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="медиана задержки YandexGPT")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="разброс логнормальной задержки YandexGPT")
+    parser.add_argument("--llm-error-rate", type=float, default=0.01)
+    parser.add_argument("--llm-chunks", type=int, default=8, help="частей в потоковом ответе")
+    parser.add_argument("--wiki-latency-ms", type=float, default=150)
+    parser.add_argument("--wiki-miss-rate", type=float, default=0.2)
+    parser.add_argument("--wiki-paragraphs", type=int, default=100, help="размер синтетической статьи")
+    parser.add_argument("--bot-output", action="store_true", help="показывать вывод процесса бота")
+    args = parser.parse_args()
+    if args.storage == "postgres" and not args.database_url:
+        parser.error("нужен Postgres (--database-url или DATABASE_URL) или --storage memory")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
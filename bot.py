@@ -1,25 +1,435 @@
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import Message
 from aiogram.filters import Command, Filter
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramMigrateToChat, TelegramNetworkError,
+    TelegramNotFound, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 import asyncio
 import aiohttp
+import bisect
+import contextvars
+import hashlib
+import heapq
+import json
 import os
 import re
 import random
+import signal
+import socket
+import time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from html.parser import HTMLParser
 import asyncpg
 
+from gazetteer import DEFAULT_PATH as GAZETTEER_DEFAULT_PATH, Gazetteer, stem
+from memory_store import MemoryStorage
+from wiki_index import LocalWikiIndex
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 YC_API_KEY = os.getenv("YC_API_KEY")
 YC_FOLDER_ID = os.getenv("YC_FOLDER_ID")
 ALLOWED_USERS = os.getenv("ALLOWED_USERS", "all").split(",")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-bot = Bot(token=BOT_TOKEN)
+# Хранилище: "postgres" (DATABASE_URL) или "memory" — встроенное для одного процесса,
+# с журналом и снимками в MEMORY_STORE_PATH (снимок, когда журнал больше MEMORY_SNAPSHOT_BYTES)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+MEMORY_STORE_PATH = os.getenv("MEMORY_STORE_PATH", "synth_data")
+MEMORY_SNAPSHOT_BYTES = int(os.getenv("MEMORY_SNAPSHOT_BYTES", str(16 * 1024 * 1024)))
+MEMORY_STORE_FSYNC = os.getenv("MEMORY_STORE_FSYNC", "0") == "1"
+
+# Адреса внешних API (переопределяются для локального Bot API сервера или стендов нагрузочного теста)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+WIKI_API_URL = os.getenv("WIKI_API_URL", "https://fallout.fandom.com/api.php")
+
+# Кэш вики: размер LRU в памяти и время жизни записей (секунды)
+WIKI_CACHE_SIZE = int(os.getenv("WIKI_CACHE_SIZE", "2048"))
+WIKI_CACHE_TTL = int(os.getenv("WIKI_CACHE_TTL", str(7 * 24 * 3600)))
+WIKI_NEGATIVE_TTL = int(os.getenv("WIKI_NEGATIVE_TTL", "3600"))
+
+# Извлечение текста статьи: длина выдержки и размер HTML, начиная с которого разбор уходит в поток
+WIKI_EXTRACT_CHARS = int(os.getenv("WIKI_EXTRACT_CHARS", "800"))
+WIKI_EXTRACT_THREAD_THRESHOLD = int(os.getenv("WIKI_EXTRACT_THREAD_THRESHOLD", "65536"))
+
+# Источник справки: "remote" — fandom.com, "local" — локальный индекс (fandom как запасной вариант)
+WIKI_BACKEND = os.getenv("WIKI_BACKEND", "remote")
+WIKI_INDEX_PATH = os.getenv("WIKI_INDEX_PATH", "wiki_index.db")
+WIKI_TOP_K = int(os.getenv("WIKI_TOP_K", "3"))
+# Словарь сущностей Fallout: справка ищется, только если в сообщении есть известная сущность
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", GAZETTEER_DEFAULT_PATH)
+
+# Клиент YandexGPT: пул keep-alive соединений, лимит одновременных запросов, таймауты (секунды)
+YC_COMPLETION_URL = os.getenv("YC_COMPLETION_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "20"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "10"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+
+# Потоковые ответы: первое сообщение после первого предложения, затем редкие правки
+LLM_STREAMING = os.getenv("LLM_STREAMING", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", "3.5"))
+
+# Бюджеты этапов ответа (секунды): история из БД и справка вики; не успевшая справка
+# дорабатывает в фоне и попадает в кэш. YandexGPT ограничен LLM_TIMEOUT
+HISTORY_BUDGET = float(os.getenv("HISTORY_BUDGET", "1.5"))
+WIKI_BUDGET = float(os.getenv("WIKI_BUDGET", "2.0"))
+TYPING_REFRESH_INTERVAL = float(os.getenv("TYPING_REFRESH_INTERVAL", "4.5"))
+
+# Предохранители внешних сервисов: окно статистики (секунды), минимум запросов для решения,
+# доля ошибок, при которой цепь размыкается, и сколько секунд она разомкнута до пробного запроса.
+# Запрос дольше *_SLOW_CALL секунд считается ошибкой. Дублирующий запрос (хедж) уходит, если
+# первый не ответил за наблюдаемый p95 (не раньше HEDGE_MIN_DELAY), и не больше HEDGE_MAX_INFLIGHT сразу
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "60"))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+WIKI_SLOW_CALL = float(os.getenv("WIKI_SLOW_CALL", "5"))
+LLM_SLOW_CALL = float(os.getenv("LLM_SLOW_CALL", "15"))
+WIKI_HEDGE = os.getenv("WIKI_HEDGE", "1") == "1"
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.3"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MAX_INFLIGHT = int(os.getenv("HEDGE_MAX_INFLIGHT", "4"))
+
+# Отложенная запись истории: сброс в БД по интервалу (секунды) или по размеру пачки
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+HISTORY_FLUSH_SIZE = int(os.getenv("HISTORY_FLUSH_SIZE", "200"))
+
+# Кэш истории в памяти: сообщений на пользователя и общий лимит (в символах текста)
+HISTORY_CACHE_PER_USER = int(os.getenv("HISTORY_CACHE_PER_USER", "16"))
+HISTORY_CACHE_MAX_CHARS = int(os.getenv("HISTORY_CACHE_MAX_CHARS", "20000000"))
+# Несколько процессов, принимающих обновления (только при маршрутизации по chat_id на балансировщике)
+ALLOW_MULTIPLE_INGEST = os.getenv("ALLOW_MULTIPLE_INGEST", "0") == "1"
+# Сверять кэш истории с БД перед каждым ответом (нужно, если историю пишут несколько процессов)
+HISTORY_CACHE_REVALIDATE = os.getenv("HISTORY_CACHE_REVALIDATE", "1" if ALLOW_MULTIPLE_INGEST else "0") == "1"
+HISTORY_TTL = timedelta(hours=24)
+
+# Бюджет промпта в токенах (оценка локальная): всего, реплик истории, справки вики и сводки
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1800"))
+PROMPT_MAX_TURNS = int(os.getenv("PROMPT_MAX_TURNS", "6"))
+PROMPT_WIKI_TOKENS = int(os.getenv("PROMPT_WIKI_TOKENS", "300"))
+PROMPT_SUMMARY_TOKENS = int(os.getenv("PROMPT_SUMMARY_TOKENS", "200"))
+# Сводка обновляется, когда вне промпта накопилось столько несвёрнутых реплик или токенов
+SUMMARY_MIN_TURNS = int(os.getenv("SUMMARY_MIN_TURNS", "8"))
+SUMMARY_MIN_TOKENS = int(os.getenv("SUMMARY_MIN_TOKENS", "600"))
+
+# Кэш ответов на типовые вопросы: записей (0 — выключен), время жизни (секунды), вариантов
+# ответа на вопрос, сколько секунд тишины в истории пользователя нужно, чтобы отдать готовый
+# ответ, максимум значимых слов в вопросе и хранить ли кэш ещё и в БД (RESPONSE_CACHE_PERSIST=1)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))
+RESPONSE_CACHE_QUIET = int(os.getenv("RESPONSE_CACHE_QUIET", "1800"))
+RESPONSE_CACHE_MAX_WORDS = int(os.getenv("RESPONSE_CACHE_MAX_WORDS", "8"))
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "0") == "1"
+
+# Секционирование dialog_history: размер секции ("hour" или "day"), сколько секций
+# создавать наперёд и как часто запускать обслуживание (секунды)
+DIALOG_PARTITION_INTERVAL = os.getenv("DIALOG_PARTITION_INTERVAL", "hour")
+DIALOG_PARTITIONS_AHEAD = int(os.getenv("DIALOG_PARTITIONS_AHEAD", "6"))
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "600"))
+
+# "Живые" сообщения: как часто писать первым, горизонт планирования (секунды),
+# размер пачки и ограничения на отправку (одновременно и в секунду — доля общего лимита исходящих)
+LIFE_MESSAGE_INTERVAL = timedelta(hours=3)
+LIFE_REFRESH_INTERVAL = int(os.getenv("LIFE_REFRESH_INTERVAL", "300"))
+LIFE_BATCH_SIZE = int(os.getenv("LIFE_BATCH_SIZE", "500"))
+LIFE_SEND_CONCURRENCY = int(os.getenv("LIFE_SEND_CONCURRENCY", "10"))
+LIFE_SEND_RATE = float(os.getenv("LIFE_SEND_RATE", "20"))
+
+# Исходящие сообщения: общий лимит Telegram (в секунду), лимит на личный чат (в секунду,
+# с запасом на короткую серию) и на группу (в минуту); сколько отправок одновременно и повторов
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "32"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Несколько процессов: идентификатор процесса, аренда пользователей для "живых"
+# сообщений (секунды) и сколько пользователей брать за одну подгрузку
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LIFE_LEASE_TTL = int(os.getenv("LIFE_LEASE_TTL", str(LIFE_REFRESH_INTERVAL * 3)))
+LIFE_CLAIM_LIMIT = int(os.getenv("LIFE_CLAIM_LIMIT", "5000"))
+
+# Склейка серий сообщений: тишина, после которой серия считается законченной,
+# и максимальное ожидание с первого сообщения (секунды)
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0.8"))
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "3"))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "10"))
+
+# Допуск к генерации: сколько ответов готовится одновременно, мест в очереди (всего и на
+# пользователя), сколько секунд можно ждать места, лимит пользователя (ответов в минуту и
+# серия), квант справедливой очереди и базовая цена ответа (в токенах вопроса) и как
+# часто повторять пользователю «занят»
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", str(LLM_MAX_CONCURRENCY * 2)))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "200"))
+ADMISSION_USER_QUEUE = int(os.getenv("ADMISSION_USER_QUEUE", "2"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "10"))
+ADMISSION_USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "5"))
+ADMISSION_QUANTUM = int(os.getenv("ADMISSION_QUANTUM", "300"))
+ADMISSION_BASE_COST = int(os.getenv("ADMISSION_BASE_COST", "100"))
+ADMISSION_NOTICE_INTERVAL = float(os.getenv("ADMISSION_NOTICE_INTERVAL", "60"))
+
+# Режим получения обновлений: "polling" или "webhook". Обновления принимает один процесс:
+# кэш истории, склейка сообщений чата, сводки и лимиты допуска живут в памяти процесса,
+# поэтому остальные ждут блокировку приёма (раз в INGEST_LOCK_RETRY секунд)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+INGEST_LOCK_RETRY = float(os.getenv("INGEST_LOCK_RETRY", "5"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена,
+# чтобы все процессы за балансировщиком использовали один и тот же
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+
+# Метрики в формате Prometheus на локальном порту (0 — не поднимать сервер) и JSON-логи
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LOG_JSON = os.getenv("LOG_JSON", "0") == "1"
+
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
-# Глобальное подключение к БД
-db_pool = None
+# Глобальное хранилище (PostgresStorage или MemoryStorage), создаётся в init_db()
+storage = None
+
+# ============ МЕТРИКИ И ЛОГИ ============
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+def log(message: str, **fields):
+    """Строка лога; при LOG_JSON=1 — JSON с trace id текущего обновления"""
+    if not LOG_JSON:
+        print(message)
+        return
+    record = {"ts": round(time.time(), 3), "trace_id": trace_id_var.get(), "msg": message}
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(name: str, value: str, le=None) -> str:
+    """Метки в формате экспозиции; le — граница корзины гистограммы"""
+    pairs = [(name, value)] if name else []
+    if le is not None:
+        pairs.append(("le", le))
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(val)}"' for key, val in pairs) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+    
+    def inc(self, label_value: str = "", amount: float = 1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for value, count in self._values.items():
+            lines.append(f"{self.name}{_labels(self.label, value)} {count}")
+        return lines
+
+class Gauge:
+    """Значение снимается в момент отдачи метрик: callback -> число или {метка: число}.
+    
+    type="counter" — для накопительных счётчиков, которые уже ведут сами объекты (stats()).
+    """
+    def __init__(self, name: str, help: str, callback, label: str = None, type: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.label = label
+        self.type = type
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        try:
+            values = self.callback()
+        except Exception:
+            return lines
+        if not isinstance(values, dict):
+            values = {"": values}
+        for value, number in values.items():
+            lines.append(f"{self.name}{_labels(self.label, value)} {number}")
+        return lines
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+    
+    def __init__(self, name: str, help: str, label: str = None, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}   # метка -> [счётчики по корзинам (+Inf последней), сумма]
+    
+    def observe(self, seconds: float, label_value: str = ""):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.label, value, bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label, value)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label, value)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+    
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class Timer:
+    """with Timer(histogram, "метка"): ... — время блока в гистограмму (и в JSON-лог)"""
+    __slots__ = ("histogram", "label", "start")
+    
+    def __init__(self, histogram: Histogram, label: str):
+        self.histogram = histogram
+        self.label = label
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed, self.label)
+        if LOG_JSON:
+            log("timing", metric=self.histogram.name, stage=self.label, seconds=round(elapsed, 6),
+                error=exc_type.__name__ if exc_type else None)
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.add(Histogram("synth_stage_seconds", "Время этапов обработки сообщения", "stage"))
+JOB_SECONDS = metrics.add(Histogram("synth_job_seconds", "Время итераций фоновых задач", "job"))
+JOB_ERRORS = metrics.add(Counter("synth_job_errors_total", "Ошибки фоновых задач", "job"))
+UPDATES_TOTAL = metrics.add(Counter("synth_updates_total", "Полученные обновления Telegram", "type"))
+DB_POOL_WAIT = metrics.add(Histogram("synth_db_pool_wait_seconds", "Ожидание соединения из пула asyncpg"))
+DB_QUERY_SECONDS = metrics.add(Histogram("synth_db_query_seconds", "Время выполнения SQL-запросов"))
+DB_STATEMENTS = metrics.add(Counter("synth_db_statements_total", "Выполненные SQL-операторы", "kind"))
+LOOP_LAG = metrics.add(Histogram(
+    "synth_event_loop_lag_seconds", "Задержка цикла событий",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+))
+
+def stage_timer(stage: str) -> Timer:
+    return Timer(STAGE_SECONDS, stage)
+
+def job_timer(job: str) -> Timer:
+    return Timer(JOB_SECONDS, job)
+
+class _TimedAcquire:
+    def __init__(self, pool):
+        self._ctx = pool.acquire()
+    
+    async def __aenter__(self):
+        start = time.perf_counter()
+        conn = await self._ctx.__aenter__()
+        DB_POOL_WAIT.observe(time.perf_counter() - start)
+        return conn
+    
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+class InstrumentedPool:
+    """Обёртка над пулом asyncpg, которая меряет ожидание свободного соединения"""
+    def __init__(self, pool):
+        self._pool = pool
+    
+    def acquire(self):
+        return _TimedAcquire(self._pool)
+    
+    async def execute(self, query: str, *args, timeout: float = None):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, timeout=timeout)
+    
+    async def fetch(self, query: str, *args, timeout: float = None):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, timeout=timeout)
+    
+    async def fetchrow(self, query: str, *args, timeout: float = None):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, timeout=timeout)
+    
+    async def fetchval(self, query: str, *args, timeout: float = None):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, timeout=timeout)
+    
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+def _log_query(record):
+    # Служебный сброс состояния соединения при возврате в пул не считаем
+    if "RESET ALL" in record.query:
+        return
+    DB_STATEMENTS.inc("query")
+    DB_QUERY_SECONDS.observe(record.elapsed)
+
+async def _setup_connection(conn):
+    conn.add_query_logger(_log_query)
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Фоновая задача: насколько позже запланированного просыпается цикл событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - start - interval, 0.0))
+
+async def start_metrics_server():
+    """HTTP-сервер с /metrics в текстовом формате Prometheus"""
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+@dp.update.outer_middleware()
+async def trace_middleware(handler, event, data):
+    """Каждому обновлению — свой trace id для логов"""
+    trace_id_var.set(f"u{event.update_id}")
+    UPDATES_TOTAL.inc(event.event_type)
+    return await handler(event, data)
 
 class AllowedUsersFilter(Filter):
     async def __call__(self, message: Message) -> bool:
@@ -51,10 +461,432 @@ SYSTEM_PROMPT = """Ты — А-7X-42-Синт, выживший в постап
 4. Если спросят «Ты синт?» — ответь с паникой: «Что? Нет... радиация глючит 😰»
 5. Если спросят про имя — сначала 3 бредовых сообщения, потом нормальный ответ"""
 
+# ============ УСТОЙЧИВОСТЬ К СБОЯМ ВНЕШНИХ СЕРВИСОВ ============
+class UpstreamError(Exception):
+    """Сбой внешнего сервиса (сеть, таймаут, 5xx/429) — учитывается предохранителем"""
+
+class CircuitOpenError(UpstreamError):
+    """Цепь разомкнута: запрос не отправлялся"""
+
+class CircuitBreaker:
+    """Предохранитель одного внешнего сервиса со скользящей статистикой.
+    
+    closed — запросы идут, за последние window секунд считаются ошибки и
+    длительности; при min_requests и доле ошибок от error_rate цепь размыкается.
+    open — запросы сразу получают CircuitOpenError, через open_seconds
+    пропускается пробный запрос (half_open): успех замыкает цепь, ошибка снова
+    размыкает. Запрос дольше slow_call тоже считается ошибкой.
+    
+    С hedge=True, если ответа нет дольше наблюдаемого p95, параллельно уходит
+    второй такой же запрос и берётся тот, что ответит первым. Проигравший не
+    отменяется (отмена посреди записи портит keep-alive соединение сессии), а
+    дорабатывает в фоне; ограничения параллельности factory соблюдает сама.
+    """
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+    
+    def __init__(self, name: str, window: float = 60, min_requests: int = 10, error_rate: float = 0.5,
+                 open_seconds: float = 30, slow_call: float = None, hedge: bool = False,
+                 hedge_min_delay: float = 0.3, hedge_min_samples: int = 20, max_hedges: int = 4):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate
+        self.open_seconds = open_seconds
+        self.slow_call = slow_call
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedges = max_hedges
+        self.state = self.CLOSED
+        self._calls = deque()  # (время, успех, длительность)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe = False
+        self._hedges_inflight = 0
+        self._p95 = (0.0, None)
+        self.rejected = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+    
+    def _trim(self, now: float):
+        while self._calls and now - self._calls[0][0] > self.window:
+            _, ok, _ = self._calls.popleft()
+            if not ok:
+                self._failures -= 1
+    
+    def error_rate(self) -> float:
+        self._trim(time.monotonic())
+        return self._failures / len(self._calls) if self._calls else 0.0
+    
+    def p95(self):
+        """p95 длительности успешных запросов в окне (пересчёт не чаще раза в секунду)"""
+        now = time.monotonic()
+        computed_at, value = self._p95
+        if now - computed_at < 1:
+            return value
+        self._trim(now)
+        latencies = sorted(latency for _, ok, latency in self._calls if ok)
+        value = latencies[int(len(latencies) * 0.95)] if len(latencies) >= self.hedge_min_samples else None
+        self._p95 = (now, value)
+        return value
+    
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            log(f"⚡ {self.name}: предохранитель {state}", upstream=self.name, state=state)
+    
+    def acquire(self) -> bool:
+        """Разрешение на запрос или CircuitOpenError; True — это пробный запрос полуоткрытой цепи.
+        
+        Запросы, которые нельзя обернуть в call (потоковые), сами вызывают acquire и
+        затем record либо release.
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                self.rejected += 1
+                raise CircuitOpenError(self.name)
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probe:
+                self.rejected += 1
+                raise CircuitOpenError(self.name)
+            self._probe = True
+            return True
+        return False
+    
+    def release(self, probe: bool):
+        if probe:
+            self._probe = False
+    
+    def record(self, ok: bool, latency: float, probe: bool):
+        now = time.monotonic()
+        if self.slow_call and latency > self.slow_call:
+            ok = False
+        if probe:
+            self._probe = False
+            if ok:
+                self._calls.clear()
+                self._failures = 0
+                self._set_state(self.CLOSED)
+            else:
+                self._opened_at = now
+                self._set_state(self.OPEN)
+        self._calls.append((now, ok, latency))
+        if not ok:
+            self._failures += 1
+        self._trim(now)
+        if (self.state == self.CLOSED and len(self._calls) >= self.min_requests
+                and self._failures / len(self._calls) >= self.error_rate_threshold):
+            self._opened_at = now
+            self._set_state(self.OPEN)
+    
+    async def call(self, factory):
+        """factory() → корутина запроса; сбои она сообщает через UpstreamError"""
+        probe = self.acquire()
+        start = time.monotonic()
+        try:
+            if self.hedge and not probe:
+                result = await self._hedged(factory)
+            else:
+                result = await factory()
+        except UpstreamError:
+            self.record(False, time.monotonic() - start, probe)
+            raise
+        except BaseException:
+            self.release(probe)
+            raise
+        self.record(True, time.monotonic() - start, probe)
+        return result
+    
+    async def _hedged(self, factory):
+        delay = self.p95()
+        if delay is None or self._hedges_inflight >= self.max_hedges:
+            return await factory()
+        first = asyncio.ensure_future(factory())
+        done, _ = await asyncio.wait({first}, timeout=max(delay, self.hedge_min_delay))
+        if done:
+            return first.result()
+        
+        self.hedges += 1
+        self._hedges_inflight += 1
+        second = asyncio.ensure_future(factory())
+        try:
+            pending = {first, second}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            self._hedges_inflight -= 1
+            for task in (first, second):
+                if not task.done():
+                    _late_tasks.add(task)
+                    task.add_done_callback(_finish_late)
+
+def _breaker(name: str, slow_call: float, hedge: bool) -> CircuitBreaker:
+    return CircuitBreaker(
+        name, window=BREAKER_WINDOW, min_requests=BREAKER_MIN_REQUESTS, error_rate=BREAKER_ERROR_RATE,
+        open_seconds=BREAKER_OPEN_SECONDS, slow_call=slow_call, hedge=hedge,
+        hedge_min_delay=HEDGE_MIN_DELAY, hedge_min_samples=HEDGE_MIN_SAMPLES, max_hedges=HEDGE_MAX_INFLIGHT
+    )
+
+breakers = {
+    "wiki": _breaker("wiki", WIKI_SLOW_CALL, WIKI_HEDGE),
+    "llm": _breaker("llm", LLM_SLOW_CALL, LLM_HEDGE),
+}
+
+# ============ КЭШ ВИКИ ============
+_MISSING = object()
+
+class TTLCache:
+    """LRU-кэш в памяти процесса с ограничением размера и временем жизни записей"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=_MISSING):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def pop(self, key):
+        self._data.pop(key, None)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+class WikiCache:
+    """Двухуровневый кэш вики: LRU в памяти + таблица wiki_cache в Postgres.
+    
+    Раздельно хранятся: запрос → заголовок ("title"), заголовок → очищенный
+    текст ("page") и отрицательные результаты (value = None) с коротким TTL.
+    """
+    def __init__(self, size: int, ttl: int, negative_ttl: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.tiers = {
+            "title": TTLCache(size, ttl),
+            "page": TTLCache(size, ttl),
+        }
+        self.negative = TTLCache(size, negative_ttl)
+        self.db_hits = 0
+        self.db_misses = 0
+        self.db_errors = 0
+    
+    async def get(self, kind: str, key: str):
+        """Возвращает строку, None (закэшированное отсутствие) или _MISSING"""
+        value = self.tiers[kind].get(key)
+        if value is not _MISSING:
+            return value
+        if self.negative.get((kind, key)) is not _MISSING:
+            return None
+        
+        if storage is None:
+            return _MISSING
+        try:
+            row = await storage.get_cached(kind, key, datetime.utcnow())
+        except Exception as e:
+            self.db_errors += 1
+            log(f"⚠️ Ошибка чтения кэша вики: {e}")
+            return _MISSING
+        
+        if row is None:
+            self.db_misses += 1
+            return _MISSING
+        
+        self.db_hits += 1
+        value, expires_at = row
+        remaining = (expires_at - datetime.utcnow()).total_seconds()
+        if value is None:
+            self.negative.set((kind, key), True, ttl=min(remaining, self.negative_ttl))
+        else:
+            self.tiers[kind].set(key, value, ttl=min(remaining, self.ttl))
+        return value
+    
+    async def put(self, kind: str, key: str, value: str = None):
+        """Сохраняет результат; value = None — запомнить, что ничего не найдено"""
+        if value is None:
+            ttl = self.negative_ttl
+            self.negative.set((kind, key), True)
+        else:
+            ttl = self.ttl
+            self.negative.pop((kind, key))
+            self.tiers[kind].set(key, value)
+        
+        if storage is None:
+            return
+        try:
+            await storage.put_cached(kind, key, value, datetime.utcnow() + timedelta(seconds=ttl))
+        except Exception as e:
+            self.db_errors += 1
+            log(f"⚠️ Ошибка записи кэша вики: {e}")
+    
+    def stats(self) -> dict:
+        return {
+            "title": self.tiers["title"].stats(),
+            "page": self.tiers["page"].stats(),
+            "negative": self.negative.stats(),
+            "db": {"hits": self.db_hits, "misses": self.db_misses, "errors": self.db_errors},
+        }
+
+# ============ ИЗВЛЕЧЕНИЕ ТЕКСТА ИЗ HTML ============
+class _BudgetReached(Exception):
+    pass
+
+class WikiTextExtractor(HTMLParser):
+    """Однопроходное извлечение текста статьи с остановкой по лимиту символов.
+    
+    Пропускает script/style, комментарии, инфобоксы, навигационные блоки и сноски;
+    переводы строк ставятся по границам блоков, как в прежнем _clean_html.
+    """
+    SKIP_TAGS = {"script", "style"}
+    # Классы сравниваются целиком: "navbox-icon" или "references-small" не пропускаются
+    SKIP_CLASSES = {"infobox", "portable-infobox", "navbox", "reference", "references", "mw-references-wrap"}
+    # У пустых элементов нет закрывающего тега — пропуск по ним никогда бы не закончился
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+    LINE_BREAK_TAGS = {"p", "div", "li"}
+    HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+    CHUNK_SIZE = 8192
+    
+    def __init__(self, limit: int):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self._newlines = 2          # переводов строк в конце вывода (2 = начало текста)
+        self._pending_space = False
+        self._skip_tag = None
+        self._skip_depth = 0
+    
+    def _should_skip(self, tag: str, attrs: list) -> bool:
+        if tag in self.VOID_TAGS:
+            return False
+        if tag in self.SKIP_TAGS:
+            return True
+        for name, value in attrs:
+            if name == "class" and value and not self.SKIP_CLASSES.isdisjoint(value.split()):
+                return True
+        return False
+    
+    def _emit(self, text: str):
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= self.limit:
+            raise _BudgetReached
+    
+    def _emit_break(self, count: int):
+        self._pending_space = False
+        if self._newlines < count:
+            self._emit("\n" * (count - self._newlines))
+            self._newlines = count
+    
+    def handle_starttag(self, tag, attrs):
+        if self._skip_tag:
+            if tag == self._skip_tag:
+                self._skip_depth += 1
+            return
+        if self._should_skip(tag, attrs):
+            self._skip_tag = tag
+            self._skip_depth = 1
+        elif tag == "br":
+            self._emit_break(1)
+    
+    def handle_startendtag(self, tag, attrs):
+        if not self._skip_tag and tag == "br":
+            self._emit_break(1)
+    
+    def handle_endtag(self, tag):
+        if self._skip_tag:
+            if tag == self._skip_tag:
+                self._skip_depth -= 1
+                if self._skip_depth == 0:
+                    self._skip_tag = None
+            return
+        if tag in self.HEADING_TAGS:
+            self._emit_break(2)
+        elif tag in self.LINE_BREAK_TAGS:
+            self._emit_break(1)
+    
+    def handle_data(self, data):
+        if self._skip_tag:
+            return
+        words = data.split()
+        if not words:
+            if data:
+                self._pending_space = True
+            return
+        text = " ".join(words)
+        if (self._pending_space or data[0].isspace()) and self._newlines == 0:
+            text = " " + text
+        self._pending_space = data[-1].isspace()
+        self._newlines = 0
+        self._emit(text)
+    
+    def extract(self, html: str) -> str:
+        try:
+            for i in range(0, len(html), self.CHUNK_SIZE):
+                self.feed(html[i:i + self.CHUNK_SIZE])
+            self.close()
+        except _BudgetReached:
+            pass
+        return "".join(self.parts).strip()[:self.limit]
+
+def extract_wiki_text(html: str, limit: int = WIKI_EXTRACT_CHARS) -> str:
+    return WikiTextExtractor(limit).extract(html)
+
+async def extract_wiki_text_async(html: str, limit: int = WIKI_EXTRACT_CHARS) -> str:
+    """Большие страницы разбираются в пуле потоков, чтобы не блокировать цикл событий"""
+    if len(html) < WIKI_EXTRACT_THREAD_THRESHOLD:
+        return extract_wiki_text(html, limit)
+    return await asyncio.get_running_loop().run_in_executor(None, extract_wiki_text, html, limit)
+
 class WikiClient:
-    def __init__(self):
-        self.base_url = "https://fallout.fandom.com/api.php"
+    def __init__(self, cache: WikiCache = None, breaker: CircuitBreaker = None):
+        self.base_url = WIKI_API_URL
         self.session = None
+        self.cache = cache
+        self.breaker = breaker
     
     async def init(self):
         if self.session is None:
@@ -68,9 +900,71 @@ class WikiClient:
             self.session = None
     
     async def search_and_get_content(self, query: str) -> str:
+        return (await self.lookup(query))[1]
+    
+    async def lookup(self, query: str) -> tuple:
+        """Запрос → (заголовок статьи, текст); ("", ""), если ничего нет"""
+        title = await self.find_title(query)
+        if not title:
+            return "", ""
+        text = await self.get_extract(title)
+        return (title, text) if text else ("", "")
+    
+    async def find_title(self, query: str) -> str:
+        """Запрос → заголовок статьи (через кэш)"""
+        key = " ".join(query.lower().split())
+        if self.cache:
+            cached = await self.cache.get("title", key)
+            if cached is not _MISSING:
+                return cached or ""
+        
+        with stage_timer("wiki_search"):
+            title = await self._search_title(query)
+        # None — сетевая ошибка, её не кэшируем; "" — ничего не найдено
+        if title is not None and self.cache:
+            await self.cache.put("title", key, title or None)
+        return title or ""
+    
+    async def get_extract(self, title: str) -> str:
+        """Заголовок → очищенный текст статьи (через кэш)"""
+        if self.cache:
+            cached = await self.cache.get("page", title)
+            if cached is not _MISSING:
+                return cached or ""
+        
+        with stage_timer("wiki_parse"):
+            text = await self._fetch_extract(title)
+        if text is not None and self.cache:
+            await self.cache.put("page", title, text or None)
+        return text or ""
+    
+    async def _get_json(self, params: dict, timeout: float):
+        """GET к api.php; любые сбои — UpstreamError"""
+        try:
+            async with self.session.get(self.base_url, params=params, timeout=timeout) as resp:
+                if resp.status != 200:
+                    raise UpstreamError(f"HTTP {resp.status}")
+                return await resp.json()
+        except asyncio.TimeoutError:
+            raise UpstreamError(f"таймаут {timeout} с")
+        except (aiohttp.ClientError, ValueError) as e:
+            raise UpstreamError(f"{type(e).__name__}: {e}")
+    
+    async def _request(self, params: dict, timeout: float):
+        """Запрос через предохранитель; None — сервис недоступен (результат не кэшируется)"""
         if not self.session:
             await self.init()
-        
+        try:
+            if self.breaker:
+                return await self.breaker.call(lambda: self._get_json(params, timeout))
+            return await self._get_json(params, timeout)
+        except CircuitOpenError:
+            return None
+        except UpstreamError as e:
+            log(f"⚠️ Вики не ответила ({params['action']}): {e}")
+            return None
+    
+    async def _search_title(self, query: str):
         search_params = {
             "action": "opensearch",
             "search": query,
@@ -78,17 +972,14 @@ class WikiClient:
             "format": "json"
         }
         
-        try:
-            async with self.session.get(self.base_url, params=search_params, timeout=10) as resp:
-                if resp.status != 200:
-                    return ""
-                data = await resp.json()
-                if len(data) < 2 or not data[1]:
-                    return ""
-                title = data[1][0]
-        except:
+        data = await self._request(search_params, 10)
+        if data is None:
+            return None
+        if len(data) < 2 or not data[1]:
             return ""
-        
+        return data[1][0]
+    
+    async def _fetch_extract(self, title: str):
         parse_params = {
             "action": "parse",
             "page": title,
@@ -98,211 +989,1066 @@ class WikiClient:
             "disabletoc": 1
         }
         
-        try:
-            async with self.session.get(self.base_url, params=parse_params, timeout=15) as resp:
-                if resp.status != 200:
-                    return ""
-                data = await resp.json()
-                if "parse" not in data or "text" not in data["parse"] or "*" not in data["parse"]["text"]:
-                    return ""
-                
-                html = data["parse"]["text"]["*"]
-                return self._clean_html(html)[:800]
-        except:
+        data = await self._request(parse_params, 15)
+        if data is None:
+            return None
+        if "parse" not in data or "text" not in data["parse"] or "*" not in data["parse"]["text"]:
             return ""
-    
-    def _clean_html(self, html: str) -> str:
-        html = re.sub(r'<script.*?>.*?</script>', '', html, flags=re.DOTALL)
-        html = re.sub(r'<style.*?>.*?</style>', '', html, flags=re.DOTALL)
-        html = re.sub(r'<!--.*?-->', '', html, flags=re.DOTALL)
-        html = re.sub(r'<br\s*/?>|</p>|</div>|</li>', '\n', html, flags=re.IGNORECASE)
-        html = re.sub(r'</h[1-6]>', '\n\n', html, flags=re.IGNORECASE)
-        text = re.sub(r'<[^>]+>', '', html)
-        text = re.sub(r'\n\s*\n', '\n\n', text)
-        text = re.sub(r' +', ' ', text)
-        return text.strip()
+        
+        return await extract_wiki_text_async(data["parse"]["text"]["*"])
 
-wiki_client = WikiClient()
+wiki_cache = WikiCache(WIKI_CACHE_SIZE, WIKI_CACHE_TTL, WIKI_NEGATIVE_TTL)
+remote_wiki_client = WikiClient(cache=wiki_cache, breaker=breakers["wiki"])
+
+if WIKI_BACKEND == "local":
+    wiki_client = LocalWikiIndex(
+        WIKI_INDEX_PATH,
+        top_k=WIKI_TOP_K,
+        max_chars=WIKI_EXTRACT_CHARS,
+        fallback=remote_wiki_client
+    )
+else:
+    wiki_client = remote_wiki_client
+
+def load_gazetteer(path: str):
+    try:
+        gazetteer = Gazetteer.load(path)
+    except OSError as e:
+        log(f"⚠️ Словарь сущностей не загружен ({e}), справка по прежней эвристике")
+        return None
+    log(f"📚 Словарь сущностей: статей {len(gazetteer.keys)}, псевдонимов {len(gazetteer)}")
+    return gazetteer
+
+gazetteer = load_gazetteer(GAZETTEER_PATH)
 
 # ============ СИСТЕМА ПАМЯТИ ============
-async def init_db():
-    """Инициализация БД для хранения истории диалогов и пользователей"""
-    global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL)
-    
-    # Таблица истории диалогов (24 часа хранения)
-    await db_pool.execute('''
-        CREATE TABLE IF NOT EXISTS dialog_history (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            chat_id BIGINT NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT NOW()
+# dialog_history секционирована по created_at: старые сообщения удаляются
+# целыми секциями (DROP TABLE) вместо массового DELETE.
+_PARTITION_PREFIX = "dialog_history_p"
+_PARTITION_FORMATS = {"hour": "%Y%m%d%H", "day": "%Y%m%d"}
+_MIGRATION_LOCK_ID = 7_042_001
+
+def _partition_step() -> timedelta:
+    return timedelta(days=1) if DIALOG_PARTITION_INTERVAL == "day" else timedelta(hours=1)
+
+def _partition_start(ts: datetime) -> datetime:
+    if DIALOG_PARTITION_INTERVAL == "day":
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def _partition_name(start: datetime) -> str:
+    fmt = _PARTITION_FORMATS["day" if DIALOG_PARTITION_INTERVAL == "day" else "hour"]
+    return _PARTITION_PREFIX + start.strftime(fmt)
+
+def _partition_range(name: str):
+    """Границы секции по её имени (понимает и часовые, и суточные секции).
+    
+    Формат выбирается по длине суффикса: strptime с "%Y%m%d%H" разбирает и
+    восьмизначный суточный суффикс ("20261018" — 1 октября, 08:00). Имя,
+    которое не собирается обратно из разобранной даты, не считается секцией.
+    """
+    suffix = name[len(_PARTITION_PREFIX):]
+    interval = {10: "hour", 8: "day"}.get(len(suffix))
+    if interval is None or not suffix.isdigit():
+        return None
+    fmt = _PARTITION_FORMATS[interval]
+    try:
+        start = datetime.strptime(suffix, fmt)
+    except ValueError:
+        return None
+    if start.strftime(fmt) != suffix:
+        return None
+    return start, start + (timedelta(days=1) if interval == "day" else timedelta(hours=1))
+
+async def _list_partitions(conn) -> list:
+    rows = await conn.fetch(
+        '''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'dialog_history' AND p.relnamespace = to_regnamespace(current_schema())
+        '''
+    )
+    return [row['relname'] for row in rows]
+
+async def _create_partition(conn, start: datetime, end: datetime, name: str):
+    """Создаёт секцию; строки, успевшие попасть в DEFAULT-секцию, переносятся в неё"""
+    async with conn.transaction():
+        await conn.execute(f'CREATE TABLE {name} (LIKE dialog_history INCLUDING DEFAULTS)')
+        await conn.execute(
+            f'''
+            WITH moved AS (
+                DELETE FROM dialog_history_default
+                WHERE created_at >= $1 AND created_at < $2
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            ''',
+            start, end
         )
-    ''')
-    
-    # Таблица пользователей (для отслеживания активности)
-    await db_pool.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            chat_id BIGINT NOT NULL,
-            username TEXT,
-            last_message_from_user TIMESTAMP DEFAULT NOW(),
-            last_message_from_bot TIMESTAMP DEFAULT NOW(),
-            last_seen TIMESTAMP DEFAULT NOW(),
-            created_at TIMESTAMP DEFAULT NOW()
+        await conn.execute(
+            f"ALTER TABLE dialog_history ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
         )
-    ''')
-    
-    # Индексы
-    await db_pool.execute('CREATE INDEX IF NOT EXISTS idx_user_time ON dialog_history(user_id, created_at)')
-    await db_pool.execute('CREATE INDEX IF NOT EXISTS idx_cleanup ON dialog_history(created_at)')
-    await db_pool.execute('CREATE INDEX IF NOT EXISTS idx_users_last_bot ON users(last_message_from_bot)')
+
+async def ensure_dialog_partitions(conn, since: datetime = None) -> int:
+    """Создаёт недостающие секции от since (по умолчанию — текущей) до DIALOG_PARTITIONS_AHEAD вперёд"""
+    now = datetime.utcnow()
+    existing = [r for r in map(_partition_range, await _list_partitions(conn)) if r]
     
-    print("✅ База данных для памяти и пользователей инициализирована")
+    created = 0
+    start = _partition_start(since or now)
+    last = _partition_start(now) + _partition_step() * DIALOG_PARTITIONS_AHEAD
+    while start <= last:
+        end = start + _partition_step()
+        # Пропускаем, если диапазон уже покрыт (в том числе секциями другого размера)
+        if not any(s < end and start < e for s, e in existing):
+            try:
+                await _create_partition(conn, start, end, _partition_name(start))
+                created += 1
+            except Exception as e:
+                log(f"⚠️ Не удалось создать секцию {_partition_name(start)}: {e}")
+        start = end
+    return created
 
-async def cleanup_old_messages():
-    """Очистка сообщений старше 24 часов"""
-    while True:
-        try:
-            cutoff = datetime.utcnow() - timedelta(hours=24)
-            deleted = await db_pool.execute(
-                "DELETE FROM dialog_history WHERE created_at < $1",
-                cutoff
-            )
-            print(f"🧹 Очищено старых сообщений: {deleted}")
-        except Exception as e:
-            print(f"⚠️ Ошибка очистки: {e}")
-        
-        await asyncio.sleep(3600)
+async def drop_expired_partitions(conn, cutoff: datetime) -> list:
+    """Удаляет секции, целиком лежащие раньше cutoff — это операция над метаданными"""
+    dropped = []
+    for name in await _list_partitions(conn):
+        bounds = _partition_range(name)
+        if bounds and bounds[1] <= cutoff:
+            await conn.execute(f'DROP TABLE IF EXISTS {name}')
+            dropped.append(name)
+    # DEFAULT-секция обычно пуста; если обслуживание отставало — чистим её по-старому
+    await conn.execute("DELETE FROM dialog_history_default WHERE created_at < $1", cutoff)
+    return dropped
 
-async def save_message(user_id: int, chat_id: int, role: str, content: str):
-    """Сохранение сообщения в историю и обновление времени активности"""
-    try:
-        # Сохраняем в историю
-        await db_pool.execute(
-            '''
-            INSERT INTO dialog_history (user_id, chat_id, role, content)
-            VALUES ($1, $2, $3, $4)
-            ''',
-            user_id, chat_id, role, content[:2000]
+async def _init_dialog_history(conn):
+    """Создаёт секционированную dialog_history; старую несекционированную переносит"""
+    cutoff = datetime.utcnow() - HISTORY_TTL
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", _MIGRATION_LOCK_ID)
+        relkind = await conn.fetchval(
+            "SELECT relkind::text FROM pg_class WHERE relname = 'dialog_history' AND relnamespace = to_regnamespace(current_schema())"
         )
+        legacy = relkind == 'r'
+        if legacy:
+            # Одноразовая миграция: освобождаем имена таблицы, последовательности и индексов
+            await conn.execute('ALTER TABLE dialog_history RENAME TO dialog_history_legacy')
+            await conn.execute('ALTER TABLE dialog_history_legacy RENAME CONSTRAINT dialog_history_pkey TO dialog_history_legacy_pkey')
+            await conn.execute('ALTER SEQUENCE IF EXISTS dialog_history_id_seq RENAME TO dialog_history_legacy_id_seq')
+            await conn.execute('DROP INDEX IF EXISTS idx_user_time')
+            await conn.execute('DROP INDEX IF EXISTS idx_cleanup')
         
-        # Обновляем пользователя
-        username = None
-        if role == "user":
-            # Получаем имя пользователя из последнего сообщения (если есть)
-            username = content[:50] if len(content) < 50 else content[:50] + "..."
-            await db_pool.execute(
-                '''
-                INSERT INTO users (user_id, chat_id, username, last_message_from_user, last_seen)
-                VALUES ($1, $2, $3, NOW(), NOW())
-                ON CONFLICT (user_id) DO UPDATE 
-                SET last_message_from_user = NOW(), last_seen = NOW(), username = $3
-                ''',
-                user_id, chat_id, username
-            )
-        else:
-            await db_pool.execute(
+        # Таблица истории диалогов (24 часа хранения)
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS dialog_history (
+                id BIGSERIAL,
+                user_id BIGINT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        ''')
+        # Страховка: сюда попадают строки, если обслуживание не успело создать секцию
+        await conn.execute('CREATE TABLE IF NOT EXISTS dialog_history_default PARTITION OF dialog_history DEFAULT')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_user_time ON dialog_history(user_id, created_at)')
+        
+        await ensure_dialog_partitions(conn, since=cutoff if legacy else None)
+        
+        if legacy:
+            moved = await conn.execute(
                 '''
-                INSERT INTO users (user_id, chat_id, last_message_from_bot, last_seen)
-                VALUES ($1, $2, NOW(), NOW())
-                ON CONFLICT (user_id) DO UPDATE 
-                SET last_message_from_bot = NOW(), last_seen = NOW()
+                INSERT INTO dialog_history (user_id, chat_id, role, content, created_at)
+                SELECT user_id, chat_id, role, content, created_at FROM dialog_history_legacy
+                WHERE created_at > $1
                 ''',
-                user_id, chat_id
+                cutoff
             )
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения: {e}")
+            await conn.execute('DROP TABLE dialog_history_legacy')
+            log(f"🗂 dialog_history переведена на секции, перенесено: {moved}")
 
-async def get_history(user_id: int, limit: int = 8) -> list:
-    """Получение истории диалога за последние 24 часа"""
-    cutoff = datetime.utcnow() - timedelta(hours=24)
+class LeaderLock:
+    """Лидерство для задач, которые должны идти в одном процессе из нескольких.
     
-    rows = await db_pool.fetch(
-        '''
-        SELECT role, content FROM dialog_history
-        WHERE user_id = $1 AND created_at > $2
-        ORDER BY created_at ASC
-        LIMIT $3
-        ''',
-        user_id, cutoff, limit
-    )
+    Держит сессионный pg_try_advisory_lock на отдельном соединении: если процесс
+    упал или соединение оборвалось, блокировка снимается и её берёт другой процесс.
+    """
+    def __init__(self, key: int, name: str):
+        self.key = key
+        self.name = name
+        self.conn = None
     
-    history = []
-    for row in rows:
-        history.append({
-            "role": "user" if row['role'] == 'user' else 'assistant',
-            "text": row['content']
-        })
+    async def acquire(self) -> bool:
+        """True, если этот процесс — лидер (проверяет, что соединение живо)"""
+        if self.conn is not None:
+            try:
+                await self.conn.fetchval("SELECT 1")
+                return True
+            except Exception:
+                log(f"⚠️ Потеряно лидерство: {self.name}")
+                await self.release()
+        
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            if await conn.fetchval("SELECT pg_try_advisory_lock($1)", self.key):
+                self.conn = conn
+                log(f"👑 Процесс {WORKER_ID} ведёт задачу: {self.name}")
+                return True
+        except Exception:
+            await conn.close()
+            raise
+        await conn.close()
+        return False
     
-    return history
+    async def release(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            try:
+                await conn.close()
+            except Exception:
+                conn.terminate()
 
-# ============ СИСТЕМА "ЖИЗНИ" БОТА ============
-async def get_user_status(user_id: int) -> dict:
-    """Получает статус пользователя (время последней активности, обида и т.д.)"""
-    row = await db_pool.fetchrow(
-        '''
-        SELECT 
-            last_message_from_user, 
-            last_message_from_bot,
-            last_seen,
-            username
-        FROM users 
-        WHERE user_id = $1
-        ''',
-        user_id
-    )
+class PostgresStorage:
+    """Хранилище в Postgres (asyncpg), общее для нескольких процессов.
     
-    if not row:
-        return None
+    Интерфейс хранилища (его же реализует MemoryStorage из memory_store.py):
+    init/close, write_batch, load_history, clear_history, delete_user,
+    latest_history_at, user_activity, claim_due_users, release_leases, get_summary/put_summary,
+    get_cached/put_cached, acquire_leadership/release_leadership, acquire_ingest_lock, maintain.
+    """
+    HISTORY_COLUMNS = ["user_id", "chat_id", "role", "content", "created_at"]
     
-    now = datetime.utcnow()
-    last_user_msg = row['last_message_from_user']
-    last_bot_msg = row['last_message_from_bot']
-    last_seen = row['last_seen']
-    
-    # Рассчитываем "обиду"
-    hours_since_reply = (now - last_user_msg).total_seconds() / 3600
-    hours_since_bot_msg = (now - last_bot_msg).total_seconds() / 3600
-    hours_since_seen = (now - last_seen).total_seconds() / 3600
-    
-    status = {
-        "username": row['username'] or "выживший",
-        "hours_since_reply": hours_since_reply,
-        "hours_since_bot_msg": hours_since_bot_msg,
-        "hours_since_seen": hours_since_seen,
-        "is_offended": hours_since_reply > 4 and hours_since_seen < 1,  # Видел сообщение но не ответил >4ч
-        "is_angry": hours_since_reply > 12 and hours_since_seen < 2,    # Игнорирует >12ч
-        "should_message": hours_since_bot_msg > 3  # Пора написать (каждые 3-4 часа)
-    }
-    
-    return status
-
-async def generate_life_message(user_id: int, status: dict) -> str:
-    """Генерирует "живое" сообщение от бота"""
-    username = status["username"]
-    is_offended = status["is_offended"]
-    is_angry = status["is_angry"]
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool = None
+        # Обслуживание секций ведёт один процесс из всех
+        self.leader = LeaderLock(7_042_002, "обслуживание истории")
+        # Обновления Telegram тоже принимает один процесс
+        self.ingest = LeaderLock(7_042_003, "приём обновлений")
     
-    # Шаблоны сообщений
-    normal_messages = [
-        f"Что-то тихо сегодня в руинах... Как твои дела, {username}? 😊",
-        f"Мой Пип-бой показывает аномальный уровень радиации к северу отсюда. Ты не был там сегодня?",
-        f"Странно... я точно помню, что оставлял стимпаки на столе. Где они? 😰",
-        f"Прошёл целый день, а я так и не понял — почему гули не стареют? 🤓",
-        f"Сегодня видел стаю супермутантов у старого метро. Надеюсь, они не идут в нашу сторону... 😰",
-        f"Мой ламповый компьютер глючит уже третий день. Может, это из-за радиации? 🤔",
-        f"Нашёл старую виниловую пластинку 50-х годов! Хочешь послушать? 🎵",
-        f"Интересно, что делают другие выжившие в это время... Ты чем занят, {username}?",
-    ]
+    async def init(self):
+        """Пул соединений и схема БД для истории диалогов и пользователей"""
+        self.pool = InstrumentedPool(await asyncpg.create_pool(self.dsn, init=_setup_connection))
+        
+        async with self.pool.acquire() as conn:
+            await _init_dialog_history(conn)
+        
+        # Таблица пользователей (для отслеживания активности)
+        await self.pool.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                username TEXT,
+                last_message_from_user TIMESTAMP DEFAULT NOW(),
+                last_message_from_bot TIMESTAMP DEFAULT NOW(),
+                last_seen TIMESTAMP DEFAULT NOW(),
+                created_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        
+        # Аренда пользователей процессами-рассыльщиками (для нескольких процессов)
+        await self.pool.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS lease_owner TEXT')
+        await self.pool.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP')
+        
+        # Индексы
+        await self.pool.execute('CREATE INDEX IF NOT EXISTS idx_users_last_bot ON users(last_message_from_bot)')
+        
+        # Скользящие сводки старой части диалога (то, что не влезает в бюджет промпта)
+        await self.pool.execute('''
+            CREATE TABLE IF NOT EXISTS user_summaries (
+                user_id BIGINT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                covered_until TIMESTAMP NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        ''')
+        
+        # Кэш вики (общий для всех процессов и перезапусков)
+        await self.pool.execute('''
+            CREATE TABLE IF NOT EXISTS wiki_cache (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                expires_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+        
+        log("✅ База данных для памяти и пользователей инициализирована")
     
-    offended_messages = [
-        f"Ты меня игнорируешь? Я тут один в руинах с мутантами... 😰",
-        f"Мой Пип-бой показывает, что ты был онлайн 2 часа назад... Но не ответил мне. Это грубо 😔",
-        f"...я думал, мы друзья. А ты даже не отвечаешь на сообщения 😰",
-        f"Знаешь, даже гули отвечают друг другу. А ты молчишь уже 5 часов... 😔",
+    async def close(self):
+        await self.leader.release()
+        await self.ingest.release()
+        await self.pool.close()
+    
+    # История и активность
+    async def write_batch(self, history: list, activity: dict):
+        """Одна транзакция: история через COPY, активность — upsert на всю пачку"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if history:
+                    await conn.copy_records_to_table(
+                        "dialog_history", records=history, columns=self.HISTORY_COLUMNS
+                    )
+                    DB_STATEMENTS.inc("copy")
+                if activity:
+                    await self._write_activity(conn, activity)
+    
+    async def _write_activity(self, conn, activity: dict):
+        columns = (
+            list(activity.keys()),
+            [a["chat_id"] for a in activity.values()],
+            [a["username"] for a in activity.values()],
+            [a["from_user"] for a in activity.values()],
+            [a["from_bot"] for a in activity.values()],
+            [a["seen"] for a in activity.values()],
+        )
+        unnest = '''
+            unnest($1::bigint[], $2::bigint[], $3::text[], $4::timestamp[], $5::timestamp[], $6::timestamp[])
+                AS d(user_id, chat_id, username, from_user, from_bot, seen)
+        '''
+        # Новые пользователи
+        await conn.execute(
+            f'''
+            INSERT INTO users (user_id, chat_id, username, last_message_from_user, last_message_from_bot, last_seen)
+            SELECT d.user_id, d.chat_id, d.username, COALESCE(d.from_user, d.seen), COALESCE(d.from_bot, d.seen), d.seen
+            FROM {unnest}
+            ON CONFLICT (user_id) DO NOTHING
+            ''',
+            *columns
+        )
+        # Существующие — одним UPDATE на всю пачку
+        await conn.execute(
+            f'''
+            UPDATE users SET
+                username = COALESCE(d.username, users.username),
+                last_message_from_user = COALESCE(d.from_user, users.last_message_from_user),
+                last_message_from_bot = COALESCE(d.from_bot, users.last_message_from_bot),
+                last_seen = d.seen
+            FROM {unnest}
+            WHERE users.user_id = d.user_id
+            ''',
+            *columns
+        )
+    
+    async def load_history(self, user_id: int, since: datetime, limit: int) -> list:
+        """Последние limit сообщений новее since: [(created_at, role, content)] по возрастанию"""
+        rows = await self.pool.fetch(
+            '''
+            SELECT role, content, created_at FROM dialog_history
+            WHERE user_id = $1 AND created_at > $2
+            ORDER BY created_at DESC
+            LIMIT $3
+            ''',
+            user_id, since, limit
+        )
+        return [(row['created_at'], row['role'], row['content']) for row in reversed(rows)]
+    
+    async def latest_history_at(self, user_id: int, since: datetime):
+        """Время последнего сообщения пользователя новее since или None"""
+        return await self.pool.fetchval(
+            "SELECT max(created_at) FROM dialog_history WHERE user_id = $1 AND created_at > $2",
+            user_id, since
+        )
+    
+    async def clear_history(self, user_id: int):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM dialog_history WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM user_summaries WHERE user_id = $1", user_id)
+    
+    async def delete_user(self, user_id: int):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM dialog_history WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM user_summaries WHERE user_id = $1", user_id)
+    
+    async def user_activity(self, user_ids: list) -> dict:
+        """Активность пачки пользователей одним запросом: user_id -> поля users"""
+        rows = await self.pool.fetch(
+            '''
+            SELECT user_id, chat_id, username, last_message_from_user, last_message_from_bot, last_seen
+            FROM users
+            WHERE user_id = ANY($1::bigint[])
+            ''',
+            list(user_ids)
+        )
+        return {row['user_id']: dict(row) for row in rows}
+    
+    # "Живые" сообщения
+    async def claim_due_users(self, owner: str, due_before: datetime, lease_until: datetime,
+                              now: datetime, limit: int) -> list:
+        """Берёт в аренду тех, кому бот не писал до due_before: [(user_id, last_message_from_bot)].
+        
+        FOR UPDATE SKIP LOCKED делит пользователей между процессами; чужая аренда
+        мешает только до lease_until, свои аренды продлеваются.
+        """
+        rows = await self.pool.fetch(
+            '''
+            UPDATE users SET lease_owner = $1, lease_until = $2
+            WHERE user_id IN (
+                SELECT user_id FROM users
+                WHERE last_message_from_bot < $3
+                  AND (lease_until IS NULL OR lease_until < $4 OR lease_owner = $1)
+                ORDER BY last_message_from_bot ASC
+                LIMIT $5
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING user_id, last_message_from_bot
+            ''',
+            owner, lease_until, due_before, now, limit
+        )
+        return [(row['user_id'], row['last_message_from_bot']) for row in rows]
+    
+    async def release_leases(self, owner: str):
+        await self.pool.execute(
+            "UPDATE users SET lease_owner = NULL, lease_until = NULL WHERE lease_owner = $1",
+            owner
+        )
+    
+    # Сводки
+    async def get_summary(self, user_id: int, since: datetime):
+        row = await self.pool.fetchrow(
+            "SELECT summary, covered_until FROM user_summaries WHERE user_id = $1 AND updated_at > $2",
+            user_id, since
+        )
+        return (row['summary'], row['covered_until']) if row else None
+    
+    async def put_summary(self, user_id: int, summary: str, covered_until: datetime):
+        await self.pool.execute(
+            '''
+            INSERT INTO user_summaries (user_id, summary, covered_until, updated_at)
+            VALUES ($1, $2, $3, NOW())
+            ON CONFLICT (user_id) DO UPDATE
+            SET summary = EXCLUDED.summary, covered_until = EXCLUDED.covered_until, updated_at = NOW()
+            ''',
+            user_id, summary, covered_until
+        )
+    
+    # Кэш вики (общий для всех процессов и перезапусков)
+    async def get_cached(self, kind: str, key: str, now: datetime):
+        row = await self.pool.fetchrow(
+            "SELECT value, expires_at FROM wiki_cache WHERE kind = $1 AND key = $2 AND expires_at > $3",
+            kind, key, now
+        )
+        return (row['value'], row['expires_at']) if row else None
+    
+    async def put_cached(self, kind: str, key: str, value, expires_at: datetime):
+        await self.pool.execute(
+            '''
+            INSERT INTO wiki_cache (kind, key, value, expires_at)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (kind, key) DO UPDATE
+            SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+            ''',
+            kind, key, value, expires_at
+        )
+    
+    # Обслуживание
+    async def acquire_leadership(self) -> bool:
+        return await self.leader.acquire()
+    
+    async def release_leadership(self):
+        await self.leader.release()
+    
+    async def acquire_ingest_lock(self) -> bool:
+        return await self.ingest.acquire()
+    
+    async def maintain(self, cutoff: datetime) -> dict:
+        """Секции: создание будущих и удаление старше cutoff; устаревший кэш вики и сводки"""
+        async with self.pool.acquire() as conn:
+            created = await ensure_dialog_partitions(conn)
+            dropped = await drop_expired_partitions(conn, cutoff)
+        expired = await self.pool.execute("DELETE FROM wiki_cache WHERE expires_at < $1", datetime.utcnow())
+        # Сводки живут столько же, сколько история
+        await self.pool.execute("DELETE FROM user_summaries WHERE updated_at < $1", cutoff)
+        return {"partitions_created": created, "partitions_dropped": len(dropped), "wiki_cache_expired": int(expired.split()[-1])}
+
+async def init_db():
+    """Создаёт и инициализирует хранилище, выбранное STORAGE_BACKEND"""
+    global storage
+    if STORAGE_BACKEND == "memory":
+        storage = MemoryStorage(MEMORY_STORE_PATH, MEMORY_SNAPSHOT_BYTES, MEMORY_STORE_FSYNC)
+    else:
+        storage = PostgresStorage(DATABASE_URL)
+    await storage.init()
+
+async def cleanup_old_messages():
+    """Обслуживание хранилища: удаление истории старше 24 часов, устаревшего кэша и сводок"""
+    while True:
+        try:
+            # Только один процесс из всех запущенных
+            if not await storage.acquire_leadership():
+                await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+                continue
+            
+            with job_timer("partition_maintenance"):
+                stats = await storage.maintain(datetime.utcnow() - HISTORY_TTL)
+            log(f"🧹 Обслуживание хранилища: {stats}")
+            log(f"📚 Кэш вики: {wiki_cache.stats()}")
+        except Exception as e:
+            JOB_ERRORS.inc("partition_maintenance")
+            log(f"⚠️ Ошибка очистки: {e}")
+        
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+class WriteBehindBuffer:
+    """Отложенная пакетная запись истории диалогов и активности пользователей.
+    
+    save_message только кладёт строку в буфер; фоновая задача сбрасывает его
+    раз в HISTORY_FLUSH_INTERVAL или по достижении HISTORY_FLUSH_SIZE строк:
+    история — через COPY, активность — одним upsert на пачку (по строке на user_id).
+    """
+    def __init__(self, interval: float, max_batch: int):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_pending = max_batch * 50
+        self.history = []      # (user_id, chat_id, role, content, created_at)
+        self.activity = {}     # user_id -> сводка активности для users
+        self._inflight = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+    
+    def add(self, user_id: int, chat_id: int, role: str, content: str) -> tuple:
+        now = datetime.utcnow()
+        row = (user_id, chat_id, role, content[:2000], now)
+        self.history.append(row)
+        
+        act = self.activity.get(user_id)
+        if act is None:
+            act = self.activity[user_id] = {
+                "chat_id": chat_id, "username": None, "from_user": None, "from_bot": None, "seen": now
+            }
+        if role == "user":
+            # Получаем имя пользователя из последнего сообщения (если есть)
+            act["username"] = content[:50] if len(content) < 50 else content[:50] + "..."
+            act["from_user"] = now
+        else:
+            act["from_bot"] = now
+        act["seen"] = now
+        
+        if len(self.history) >= self.max_batch:
+            self._wakeup.set()
+        return row
+    
+    def pending_for(self, user_id: int) -> list:
+        """Ещё не записанные в БД строки истории пользователя"""
+        return [row for row in self._inflight + self.history if row[0] == user_id]
+    
+    async def discard_user(self, user_id: int, delete):
+        """Выбрасывает несохранённые строки пользователя и удаляет сохранённые (await delete()).
+        
+        Всё под замком сброса: пачка, которая уже пишется, попадёт в БД до удаления,
+        а не после, и при ошибке не вернёт строки пользователя в буфер.
+        """
+        async with self._flush_lock:
+            self.history = [row for row in self.history if row[0] != user_id]
+            self.activity.pop(user_id, None)
+            await delete()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def close(self):
+        """Останавливает фоновый сброс и записывает всё, что осталось"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for attempt in range(3):
+            if await self.flush():
+                break
+            await asyncio.sleep(1)
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self.history and not self.activity:
+                return True
+            history, self.history = self.history, []
+            activity, self.activity = self.activity, {}
+            self._inflight = history
+            try:
+                with job_timer("history_flush"):
+                    await storage.write_batch(history, activity)
+                return True
+            except Exception as e:
+                JOB_ERRORS.inc("history_flush")
+                log(f"⚠️ Ошибка сохранения: {e}")
+                self._requeue(history, activity)
+                return False
+            finally:
+                self._inflight = []
+    
+    def _requeue(self, history: list, activity: dict):
+        """Возвращает несохранённую пачку в буфер (более новые данные важнее)"""
+        self.history[:0] = history
+        if len(self.history) > self.max_pending:
+            dropped = len(self.history) - self.max_pending
+            del self.history[:dropped]
+            log(f"⚠️ Буфер истории переполнен, отброшено строк: {dropped}")
+        for user_id, old in activity.items():
+            new = self.activity.get(user_id)
+            if new is None:
+                self.activity[user_id] = old
+            else:
+                for key, value in old.items():
+                    if new.get(key) is None:
+                        new[key] = value
+
+write_buffer = WriteBehindBuffer(HISTORY_FLUSH_INTERVAL, HISTORY_FLUSH_SIZE)
+
+class ConversationCache:
+    """Кольцевые буферы последних сообщений пользователей в памяти процесса.
+    
+    Пополняется сквозной записью из save_message, при промахе — один раз
+    загружается из БД. Неактивные пользователи вытесняются (LRU), когда общий
+    объём превышает max_chars.
+    
+    Кэш рассчитан на одного писателя: записи и /clear других процессов он не
+    видит. Если процессов несколько, HISTORY_CACHE_REVALIDATE=1 включает сверку
+    с БД в get_history (см. _history_is_stale).
+    """
+    ROW_OVERHEAD = 100  # примерная стоимость строки сверх длины текста
+    
+    def __init__(self, per_user: int, max_chars: int):
+        self.per_user = per_user
+        self.max_chars = max_chars
+        self._users = OrderedDict()   # user_id -> deque[(created_at, role, content)]
+        self._chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+    
+    def _cost(self, row: tuple) -> int:
+        return len(row[2]) + self.ROW_OVERHEAD
+    
+    def get(self, user_id: int):
+        rows = self._users.get(user_id)
+        if rows is None:
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return rows
+    
+    def load(self, user_id: int, rows: list):
+        self.drop(user_id)
+        buf = deque(rows[-self.per_user:], maxlen=self.per_user)
+        self._users[user_id] = buf
+        self._chars += sum(self._cost(r) for r in buf)
+        self._evict()
+    
+    def append(self, user_id: int, row: tuple):
+        """Сквозная запись: только для пользователей, история которых уже загружена"""
+        buf = self._users.get(user_id)
+        if buf is None:
+            return
+        if len(buf) == buf.maxlen:
+            self._chars -= self._cost(buf[0])
+        buf.append(row)
+        self._chars += self._cost(row)
+        self._users.move_to_end(user_id)
+        self._evict()
+    
+    def reset(self, user_id: int):
+        """После /clear история пуста и перечитывать её из БД не нужно"""
+        self.load(user_id, [])
+    
+    def drop(self, user_id: int):
+        buf = self._users.pop(user_id, None)
+        if buf:
+            self._chars -= sum(self._cost(r) for r in buf)
+    
+    def _evict(self):
+        while self._chars > self.max_chars and len(self._users) > 1:
+            user_id, buf = self._users.popitem(last=False)
+            self._chars -= sum(self._cost(r) for r in buf)
+            self.evictions += 1
+    
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "chars": self._chars,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale": self.stale,
+        }
+
+conversation_cache = ConversationCache(HISTORY_CACHE_PER_USER, HISTORY_CACHE_MAX_CHARS)
+
+async def save_message(user_id: int, chat_id: int, role: str, content: str):
+    """Сохранение сообщения в историю и обновление времени активности (без ожидания БД)"""
+    with stage_timer("save_message"):
+        row = write_buffer.add(user_id, chat_id, role, content)
+        conversation_cache.append(user_id, (row[4], row[2], row[3]))
+
+async def _load_history(user_id: int, cutoff: datetime) -> list:
+    """Последние сообщения пользователя из БД плюс ещё не записанные из буфера"""
+    pending = write_buffer.pending_for(user_id)
+    
+    rows = await storage.load_history(user_id, cutoff, conversation_cache.per_user)
+    
+    # Пока шёл запрос, буфер мог частично записаться или пополниться
+    merged = set(rows)
+    merged.update((r[4], r[2], r[3]) for r in pending + write_buffer.pending_for(user_id) if r[4] > cutoff)
+    return sorted(merged, key=lambda r: r[0])
+
+async def _history_is_stale(user_id: int, rows, cutoff: datetime) -> bool:
+    """Кэш разошёлся с БД: там есть сообщения новее кэша (их записал другой процесс)
+    или, когда у нас нет несохранённых строк, последнее сообщение не совпадает (чужой /clear)"""
+    with stage_timer("history_revalidate"):
+        latest = await storage.latest_history_at(user_id, cutoff)
+    newest = max((r[0] for r in rows if r[0] > cutoff), default=None)
+    if latest is not None and (newest is None or latest > newest):
+        return True
+    return latest != newest and not write_buffer.pending_for(user_id)
+
+async def get_history(user_id: int, limit: int = HISTORY_CACHE_PER_USER) -> list:
+    """Получение последних сообщений диалога за 24 часа (из памяти, при промахе — из БД)"""
+    cutoff = datetime.utcnow() - HISTORY_TTL
+    
+    rows = conversation_cache.get(user_id)
+    if rows is not None and HISTORY_CACHE_REVALIDATE and await _history_is_stale(user_id, rows, cutoff):
+        conversation_cache.stale += 1
+        rows = None
+    if rows is None:
+        with stage_timer("history_backfill"):
+            conversation_cache.load(user_id, await _load_history(user_id, cutoff))
+        rows = conversation_cache.get(user_id)
+    
+    rows = [r for r in rows if r[0] > cutoff][-limit:]
+    
+    history = []
+    for created_at, role, content in rows:
+        history.append({
+            "role": "user" if role == 'user' else 'assistant',
+            "text": content,
+            "created_at": created_at
+        })
+    
+    return history
+
+# ============ ИСХОДЯЩИЕ СООБЩЕНИЯ ============
+PRIORITY_INTERACTIVE = 0   # ответы на сообщения пользователей
+PRIORITY_PROACTIVE = 1     # "живые" сообщения, которые бот пишет первым
+
+OUTBOUND_RESULTS = metrics.add(Counter("synth_outbound_total", "Исходящие запросы Telegram по результату", "result"))
+OUTBOUND_WAIT = metrics.add(Histogram("synth_outbound_wait_seconds", "Ожидание в очереди исходящих", "priority"))
+
+def classify_send_error(error: Exception) -> str:
+    """Тип ошибки Telegram при отправке: по классу исключения, а не по тексту"""
+    if isinstance(error, TelegramRetryAfter):
+        return "retry_after"
+    if isinstance(error, TelegramForbiddenError):
+        return "forbidden"          # бота заблокировали, исключили из группы, аккаунт удалён
+    if isinstance(error, TelegramMigrateToChat):
+        return "migrated"           # группа стала супергруппой
+    if isinstance(error, TelegramNotFound):
+        return "not_found"
+    if isinstance(error, TelegramBadRequest):
+        # У "chat not found" свой класс не предусмотрен — это 400 Bad Request
+        return "chat_not_found" if "chat not found" in error.message.lower() else "bad_request"
+    if isinstance(error, (TelegramNetworkError, TelegramServerError)):
+        return "transient"
+    return "error"
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 — уже есть)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity - 1e-6
+
+class _OutboundJob:
+    __slots__ = ("call", "priority", "seq", "retry", "future", "queued_at", "attempts")
+    
+    def __init__(self, call, priority: int, seq: int, retry: bool):
+        self.call = call
+        self.priority = priority
+        self.seq = seq
+        self.retry = retry
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+class _OutboundChat:
+    __slots__ = ("jobs", "bucket", "busy", "scheduled", "paused_until")
+    
+    def __init__(self, bucket: TokenBucket):
+        self.jobs = deque()
+        self.bucket = bucket
+        self.busy = False         # запрос чата сейчас выполняется
+        self.scheduled = False    # чат уже стоит в _ready или _waiting
+        self.paused_until = 0.0
+
+class OutboundDispatcher:
+    """Единая очередь исходящих запросов к Telegram с лимитами и приоритетами.
+    
+    Три корзины токенов: общая (OUTBOUND_GLOBAL_RATE), на чат (личный —
+    OUTBOUND_CHAT_RATE, группа — OUTBOUND_GROUP_PER_MINUTE) и на "живые"
+    сообщения (LIFE_SEND_RATE), чтобы они не вытесняли ответы. Внутри чата
+    порядок строго FIFO, между чатами первыми идут ответы пользователям.
+    RetryAfter ставит чат на паузу и повторяет запрос; сетевые ошибки и 5xx
+    повторяются с нарастающей паузой; остальные ошибки отдаются вызывающему.
+    """
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, group_per_minute: float,
+                 proactive_rate: float, concurrency: int, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.proactive_bucket = TokenBucket(proactive_rate, max(proactive_rate, 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60
+        self.max_retries = max_retries
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._chats = {}       # chat_id -> _OutboundChat
+        self._ready = []       # куча (priority, seq, chat_id): чаты, которым можно отправлять
+        self._waiting = []     # куча (monotonic, chat_id, is_gc): чаты, ждущие токена/паузы или удаления
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = set()  # задачи _execute: close() дожидается их до закрытия сессии бота
+        self.queued = 0
+    
+    def __len__(self):
+        return self.queued
+    
+    def send(self, chat_id: int, call, priority: int = PRIORITY_INTERACTIVE, retry: bool = True):
+        """Ставит в очередь call() (корутина запроса к Bot API); await — результат или исключение.
+        
+        retry=False — не ждать и не повторять при RetryAfter (промежуточные правки потокового ответа).
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._seq += 1
+        job = _OutboundJob(call, priority, self._seq, retry)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # Отрицательные chat_id — группы, супергруппы и каналы
+            rate, burst = (self.group_rate, 1) if chat_id < 0 else (self.chat_rate, self.chat_burst)
+            chat = self._chats[chat_id] = _OutboundChat(TokenBucket(rate, burst))
+        chat.jobs.append(job)
+        self.queued += 1
+        if not chat.busy:
+            self._schedule(chat_id, chat, time.monotonic())
+        return job.future
+    
+    def _schedule(self, chat_id: int, chat: _OutboundChat, now: float):
+        if chat.scheduled:
+            return
+        chat.scheduled = True
+        ready_at = max(now + chat.bucket.delay(now), chat.paused_until)
+        if ready_at <= now:
+            head = chat.jobs[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        else:
+            heapq.heappush(self._waiting, (ready_at, chat_id, False))
+        self._wakeup.set()
+    
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, chat_id, is_gc = heapq.heappop(self._waiting)
+                chat = self._chats.get(chat_id)
+                if chat is None:
+                    continue
+                if not is_gc:
+                    chat.scheduled = False
+                if chat.jobs and not chat.busy:
+                    self._schedule(chat_id, chat, now)
+                else:
+                    self._collect(chat_id, now)
+            
+            wait = self._waiting[0][0] - now if self._waiting else None
+            if self._ready and not self.semaphore.locked():
+                priority, _, chat_id = self._ready[0]
+                delay = self.global_bucket.delay(now)
+                if priority == PRIORITY_PROACTIVE:
+                    delay = max(delay, self.proactive_bucket.delay(now))
+                if delay <= 0:
+                    heapq.heappop(self._ready)
+                    self._start(chat_id, now)
+                    continue
+                wait = delay if wait is None else min(wait, delay)
+            
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _start(self, chat_id: int, now: float):
+        chat = self._chats[chat_id]
+        chat.scheduled = False
+        job = chat.jobs.popleft()
+        self.queued -= 1
+        chat.busy = True
+        chat.bucket.take(now)
+        self.global_bucket.take(now)
+        if job.priority == PRIORITY_PROACTIVE:
+            self.proactive_bucket.take(now)
+        OUTBOUND_WAIT.observe(now - job.queued_at, "interactive" if job.priority == PRIORITY_INTERACTIVE else "proactive")
+        task = asyncio.create_task(self._execute(chat_id, chat, job))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+    
+    async def _execute(self, chat_id: int, chat: _OutboundChat, job: _OutboundJob):
+        requeue = False
+        async with self.semaphore:
+            job.attempts += 1
+            try:
+                result = await job.call()
+            except Exception as e:
+                kind = classify_send_error(e)
+                OUTBOUND_RESULTS.inc(kind)
+                if kind == "retry_after":
+                    chat.paused_until = time.monotonic() + e.retry_after
+                    log(f"⏳ RetryAfter {e.retry_after} с для чата {chat_id}")
+                    requeue = job.retry and job.attempts <= self.max_retries
+                elif kind == "transient" and job.attempts <= self.max_retries:
+                    chat.paused_until = time.monotonic() + 0.5 * 2 ** job.attempts
+                    requeue = True
+                if not requeue and not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                OUTBOUND_RESULTS.inc("ok")
+                if not job.future.done():
+                    job.future.set_result(result)
+        
+        chat.busy = False
+        if requeue:
+            chat.jobs.appendleft(job)
+            self.queued += 1
+        now = time.monotonic()
+        if chat.jobs:
+            self._schedule(chat_id, chat, now)
+        else:
+            self._collect(chat_id, now)
+        self._wakeup.set()
+    
+    def _collect(self, chat_id: int, now: float):
+        """Чат без очереди и с полной корзиной ничем не отличается от нового — удаляем"""
+        chat = self._chats[chat_id]
+        if chat.jobs or chat.busy:
+            return
+        if chat.bucket.full(now) and chat.paused_until <= now:
+            del self._chats[chat_id]
+            return
+        # Состояние корзины ещё нужно; заглянем, когда она наполнится
+        refill = (chat.bucket.capacity - chat.bucket.tokens) / chat.bucket.rate + 0.001
+        heapq.heappush(self._waiting, (max(now + refill, chat.paused_until), chat_id, True))
+    
+    async def close(self, timeout: float):
+        """Ждёт отправки уже поставленных в очередь сообщений; не успевшие к сроку отменяет"""
+        deadline = time.monotonic() + timeout
+        while (self.queued or any(c.busy for c in self._chats.values())) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._sending:
+            _, pending = await asyncio.wait(set(self._sending), timeout=max(deadline - time.monotonic(), 0))
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+outbound = OutboundDispatcher(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_PER_MINUTE,
+    LIFE_SEND_RATE, OUTBOUND_CONCURRENCY, OUTBOUND_MAX_RETRIES
+)
+
+async def reply(message: Message, text: str, **kwargs) -> Message:
+    """message.answer через очередь исходящих (приоритет ответа пользователю)"""
+    return await outbound.send(message.chat.id, lambda: message.answer(text, **kwargs))
+
+# ============ СИСТЕМА "ЖИЗНИ" БОТА ============
+async def get_user_statuses(user_ids: list, now: datetime = None) -> dict:
+    """Статусы пачки пользователей одним запросом: user_id -> статус"""
+    now = now or datetime.utcnow()
+    users = await storage.user_activity(list(user_ids))
+    
+    statuses = {}
+    for user_id, user in users.items():
+        hours_since_reply = (now - user['last_message_from_user']).total_seconds() / 3600
+        hours_since_bot_msg = (now - user['last_message_from_bot']).total_seconds() / 3600
+        hours_since_seen = (now - user['last_seen']).total_seconds() / 3600
+        statuses[user_id] = {
+            "chat_id": user['chat_id'],
+            "username": user['username'] or 'выживший',
+            "hours_since_reply": hours_since_reply,
+            "hours_since_bot_msg": hours_since_bot_msg,
+            "hours_since_seen": hours_since_seen,
+            "is_offended": hours_since_reply > 4 and hours_since_seen < 1,  # Видел сообщение но не ответил >4ч
+            "is_angry": hours_since_reply > 12 and hours_since_seen < 2,    # Игнорирует >12ч
+            "should_message": hours_since_bot_msg > 3  # Пора написать (каждые 3-4 часа)
+        }
+    return statuses
+
+async def get_user_status(user_id: int) -> dict:
+    """Получает статус пользователя (время последней активности, обида и т.д.)"""
+    statuses = await get_user_statuses([user_id])
+    return statuses.get(user_id)
+
+async def generate_life_message(user_id: int, status: dict) -> str:
+    """Генерирует "живое" сообщение от бота"""
+    username = status["username"]
+    is_offended = status["is_offended"]
+    is_angry = status["is_angry"]
+    
+    # Шаблоны сообщений
+    normal_messages = [
+        f"Что-то тихо сегодня в руинах... Как твои дела, {username}? 😊",
+        f"Мой Пип-бой показывает аномальный уровень радиации к северу отсюда. Ты не был там сегодня?",
+        f"Странно... я точно помню, что оставлял стимпаки на столе. Где они? 😰",
+        f"Прошёл целый день, а я так и не понял — почему гули не стареют? 🤓",
+        f"Сегодня видел стаю супермутантов у старого метро. Надеюсь, они не идут в нашу сторону... 😰",
+        f"Мой ламповый компьютер глючит уже третий день. Может, это из-за радиации? 🤔",
+        f"Нашёл старую виниловую пластинку 50-х годов! Хочешь послушать? 🎵",
+        f"Интересно, что делают другие выжившие в это время... Ты чем занят, {username}?",
+    ]
+    
+    offended_messages = [
+        f"Ты меня игнорируешь? Я тут один в руинах с мутантами... 😰",
+        f"Мой Пип-бой показывает, что ты был онлайн 2 часа назад... Но не ответил мне. Это грубо 😔",
+        f"...я думал, мы друзья. А ты даже не отвечаешь на сообщения 😰",
+        f"Знаешь, даже гули отвечают друг другу. А ты молчишь уже 5 часов... 😔",
     ]
     
     angry_messages = [
@@ -332,58 +2078,132 @@ async def generate_life_message(user_id: int, status: dict) -> str:
     
     return message
 
-async def scheduled_life_messages():
-    """Фоновая задача: отправка живых сообщений каждые 3-4 часа"""
-    while True:
-        try:
-            now = datetime.utcnow()
-            # Выбираем пользователей, которым пора написать (последнее сообщение бота >3 часов назад)
-            users = await db_pool.fetch(
-                '''
-                SELECT user_id, chat_id FROM users 
-                WHERE last_message_from_bot < $1
-                ORDER BY last_message_from_bot ASC
-                LIMIT 10
-                ''',
-                now - timedelta(hours=3)
-            )
+class LifeScheduler:
+    """Планировщик "живых" сообщений: куча пользователей по времени, когда им пора написать.
+    
+    Раз в LIFE_REFRESH_INTERVAL из БД подгружаются пользователи, у которых срок
+    наступает в пределах горизонта; планировщик спит ровно до ближайшего срока,
+    проверяет статусы всей пачки одним запросом и рассылает сообщения параллельно
+    (не больше LIFE_SEND_CONCURRENCY). Темп отправки задаёт очередь исходящих:
+    "живые" сообщения идут с низким приоритетом и не быстрее LIFE_SEND_RATE в секунду.
+    """
+    def __init__(self, refresh_interval: int, batch_size: int, concurrency: int):
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._heap = []          # (due_at, user_id)
+        self._scheduled = {}     # user_id -> due_at
+        # Недавно отправленные: в БД это появится только после сброса буфера записи
+        self._recently_sent = TTLCache(1_000_000, LIFE_MESSAGE_INTERVAL.total_seconds())
+        self.sent = 0
+        self.failed = 0
+    
+    async def refresh(self):
+        """Берёт в аренду пользователей, которым пора написать в пределах горизонта.
+        
+        Аренда делит пользователей между процессами и истекает через LIFE_LEASE_TTL,
+        так что доля упавшего процесса достанется остальным. Свои аренды при
+        каждой подгрузке продлеваются.
+        """
+        now = datetime.utcnow()
+        horizon = now + timedelta(seconds=self.refresh_interval)
+        rows = await storage.claim_due_users(
+            WORKER_ID, horizon - LIFE_MESSAGE_INTERVAL, now + timedelta(seconds=LIFE_LEASE_TTL),
+            now, LIFE_CLAIM_LIMIT
+        )
+        added = 0
+        for user_id, last_message_from_bot in rows:
+            if user_id in self._scheduled or self._recently_sent.get(user_id) is not _MISSING:
+                continue
+            due_at = last_message_from_bot + LIFE_MESSAGE_INTERVAL
+            self._scheduled[user_id] = due_at
+            heapq.heappush(self._heap, (due_at, user_id))
+            added += 1
+        return added
+    
+    async def release_leases(self):
+        """При остановке отдаёт своих пользователей другим процессам"""
+        await storage.release_leases(WORKER_ID)
+    
+    def _pop_due(self, now: datetime) -> list:
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+            due_at, user_id = heapq.heappop(self._heap)
+            if self._scheduled.get(user_id) == due_at:
+                del self._scheduled[user_id]
+                batch.append(user_id)
+        return batch
+    
+    async def _send(self, user_id: int, status: dict):
+        async with self.semaphore:
+            chat_id = status["chat_id"]
+            
+            # Генерируем сообщение
+            message = await generate_life_message(user_id, status)
             
-            for user in users:
-                user_id = user['user_id']
-                chat_id = user['chat_id']
+            # Отправляем
+            try:
+                await outbound.send(chat_id, lambda: bot.send_message(chat_id, message), PRIORITY_PROACTIVE)
+                self._recently_sent.set(user_id, True)
+                self.sent += 1
+                log(f"💬 Отправлено живое сообщение пользователю {user_id}: {message[:50]}...")
                 
-                # Получаем статус пользователя
-                status = await get_user_status(user_id)
-                if not status or not status["should_message"]:
-                    continue
+                # Сохраняем в историю
+                await save_message(user_id, chat_id, "assistant", message)
                 
-                # Генерируем сообщение
-                message = await generate_life_message(user_id, status)
+            except Exception as e:
+                self.failed += 1
+                log(f"⚠️ Ошибка отправки живого сообщения {user_id}: {e}")
+                # Бота заблокировали или чата больше нет — удаляем пользователя
+                if classify_send_error(e) in ("forbidden", "chat_not_found", "not_found"):
+                    conversation_cache.drop(user_id)
+                    conversation_summaries.drop(user_id)
+                    await write_buffer.discard_user(user_id, lambda: storage.delete_user(user_id))
+    
+    async def _dispatch(self, user_ids: list):
+        # Статусы всей пачки одним запросом (за время ожидания пользователь мог ответить)
+        statuses = await get_user_statuses(user_ids)
+        jobs = {
+            user_id: self._send(user_id, status)
+            for user_id, status in statuses.items()
+            if status["should_message"]
+        }
+        # Сбой одной отправки не должен обрывать остальную пачку
+        results = await asyncio.gather(*jobs.values(), return_exceptions=True)
+        for user_id, result in zip(jobs, results):
+            if isinstance(result, Exception):
+                log(f"⚠️ Ошибка живого сообщения {user_id}: {result}", user_id=user_id)
+    
+    async def run(self):
+        next_refresh = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_refresh:
+                    with job_timer("life_refresh"):
+                        await self.refresh()
+                    next_refresh = time.monotonic() + self.refresh_interval
                 
-                # Отправляем
-                try:
-                    await bot.send_message(chat_id, message)
-                    print(f"💬 Отправлено живое сообщение пользователю {user_id}: {message[:50]}...")
-                    
-                    # Сохраняем в историю
-                    await save_message(user_id, chat_id, "assistant", message)
-                    
-                    # Пауза между сообщениями (чтобы не спамить)
-                    await asyncio.sleep(2)
-                    
-                except Exception as e:
-                    print(f"⚠️ Ошибка отправки живого сообщения {user_id}: {e}")
-                    # Если ошибка (пользователь заблокировал), удаляем из БД
-                    if "blocked" in str(e).lower() or "not found" in str(e).lower():
-                        await db_pool.execute("DELETE FROM users WHERE user_id = $1", user_id)
-                        await db_pool.execute("DELETE FROM dialog_history WHERE user_id = $1", user_id)
-            
-            # Следующая проверка через 10 минут
-            await asyncio.sleep(600)
-            
-        except Exception as e:
-            print(f"⚠️ Ошибка в фоновой задаче: {e}")
-            await asyncio.sleep(300)
+                batch = self._pop_due(datetime.utcnow())
+                if batch:
+                    with job_timer("life_dispatch"):
+                        await self._dispatch(batch)
+                    continue
+                
+                # Спим до ближайшего срока или до следующей подгрузки из БД
+                wait = next_refresh - time.monotonic()
+                if self._heap:
+                    wait = min(wait, (self._heap[0][0] - datetime.utcnow()).total_seconds())
+                await asyncio.sleep(max(wait, 0))
+            except Exception as e:
+                JOB_ERRORS.inc("life_scheduler")
+                log(f"⚠️ Ошибка в фоновой задаче: {e}")
+                await asyncio.sleep(30)
+
+life_scheduler = LifeScheduler(LIFE_REFRESH_INTERVAL, LIFE_BATCH_SIZE, LIFE_SEND_CONCURRENCY)
+
+async def scheduled_life_messages():
+    """Фоновая задача: отправка живых сообщений каждые 3-4 часа"""
+    await life_scheduler.run()
 
 # ============ ПРОВЕРКА ЗАПРОСОВ ПРО ИМЯ ============
 def is_name_query(text: str) -> bool:
@@ -391,47 +2211,620 @@ def is_name_query(text: str) -> bool:
     keywords = ["имя", "зовут", "как тебя", "ты кто", "кто ты", "назови себя", "какое имя", "твое имя", "твоё имя"]
     return any(kw in text.lower() for kw in keywords)
 
+# ============ НУЖНА ЛИ СПРАВКА ИЗ ВИКИ ============
+WIKI_GATE = metrics.add(Counter("synth_wiki_gate_total", "Решения о поиске в вики", "decision"))
+
+def wiki_query(text: str):
+    """Ключ поиска в вики или None, если справка не нужна.
+    
+    Ищем по заголовку найденной в сообщении сущности, а не по всему тексту:
+    болтовня без сущностей до вики не доходит вовсе.
+    """
+    if is_name_query(text):
+        query = None
+    elif gazetteer is not None:
+        query = gazetteer.find(text)
+    else:
+        query = text if len(text.split()) > 3 and random.random() > 0.4 else None
+    WIKI_GATE.inc("lookup" if query else "skip")
+    return query
+
 # ============ ЗАПРОС К YANDEXGPT ============
-async def get_yandex_response(prompt: str, history: list, wiki_context: str = "") -> str:
-    headers = {"Authorization": f"Api-Key {YC_API_KEY}", "Content-Type": "application/json"}
+# Ответ в образе, пока предохранитель YandexGPT разомкнут: сразу, без ожидания таймаута
+LLM_UNAVAILABLE_REPLY = "📡 Связь с центральным процессором потеряна... Перезапускаю модули, спросите чуть позже 🤖"
+_LLM_TIMEOUT_REPLY = "⏳ Обработка данных... Подождите 😊"
+
+class YandexGPTClient:
+    """Постоянный клиент YandexGPT: одна сессия с keep-alive пулом на весь процесс.
     
-    messages = [{"role": "system", "text": SYSTEM_PROMPT}]
+    Таймауты, сетевые ошибки, 5xx и 429 учитывает предохранитель breaker.
+    """
+    def __init__(self, api_key: str, folder_id: str, pool_size: int = 20, max_concurrency: int = 10,
+                 timeout: float = 20, connect_timeout: float = 5, breaker: CircuitBreaker = None):
+        self.url = YC_COMPLETION_URL
+        self.session = None
+        self.pool_size = pool_size
+        self.breaker = breaker
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        # Неизменяемые части запроса собираются один раз
+        self._headers = {"Authorization": f"Api-Key {api_key}", "Content-Type": "application/json"}
+        self._payload = {
+            "modelUri": f"gpt://{folder_id}/yandexgpt/rc",
+            "completionOptions": {"temperature": 0.85, "maxTokens": "600"},
+        }
     
-    for msg in history[-6:]:
-        messages.append(msg)
+    async def init(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self._headers,
+                timeout=self.timeout
+            )
     
-    if wiki_context:
-        messages.append({
-            "role": "system",
-            "text": f"СПРАВОЧНЫЕ ДАННЫЕ:\n{wiki_context}"
-        })
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+    
+    async def complete(self, messages: list, max_tokens: int = None, temperature: float = None) -> str:
+        if not self.session:
+            await self.init()
+        
+        data = dict(self._payload)
+        if max_tokens or temperature is not None:
+            options = dict(self._payload["completionOptions"])
+            if max_tokens:
+                options["maxTokens"] = str(max_tokens)
+            if temperature is not None:
+                options["temperature"] = temperature
+            data["completionOptions"] = options
+        data["messages"] = messages
+        
+        try:
+            if self.breaker:
+                return await self.breaker.call(lambda: self._post_limited(data))
+            return await self._post_limited(data)
+        except CircuitOpenError:
+            return LLM_UNAVAILABLE_REPLY
+        except UpstreamError as e:
+            return str(e)
+        except Exception as e:
+            log(f"⚠️ Неожиданный ответ YandexGPT: {type(e).__name__}: {e}")
+            return f"❌ Системная ошибка: {str(e)[:60]} 😰"
+    
+    async def _post_limited(self, data: dict) -> str:
+        """_post под семафором: повторный (hedged) запрос тоже занимает место"""
+        async with self.semaphore:
+            return await self._post(data)
     
-    messages.append({"role": "user", "text": prompt})
+    @staticmethod
+    def _error_reply(result: dict) -> str:
+        return f"❌ Сбой в системе: {result.get('error', {}).get('message', 'Неизвестная ошибка')} 😰"
     
-    data = {
-        "modelUri": f"gpt://{YC_FOLDER_ID}/yandexgpt/rc",
-        "completionOptions": {"temperature": 0.85, "maxTokens": "600"},
-        "messages": messages
-    }
+    @staticmethod
+    def _is_upstream_failure(status: int) -> bool:
+        """5xx и 429 — сбой сервиса; прочие 4xx — ошибка запроса, предохранитель их не считает"""
+        return status >= 500 or status == 429
     
-    async with aiohttp.ClientSession() as session:
+    async def _post(self, data: dict) -> str:
+        """Один запрос completion; текст UpstreamError — готовый ответ пользователю"""
         try:
-            async with session.post(
-                "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-                headers=headers,
-                json=data,
-                timeout=20
-            ) as response:
-                result = await response.json()
+            async with self.session.post(self.url, json=data) as response:
+                result = await response.json(content_type=None)
                 if response.status != 200:
-                    return f"❌ Сбой в системе: {result.get('error', {}).get('message', 'Неизвестная ошибка')} 😰"
+                    reply = self._error_reply(result if isinstance(result, dict) else {})
+                    if self._is_upstream_failure(response.status):
+                        raise UpstreamError(reply)
+                    return reply
                 if 'result' not in result or not result['result'].get('alternatives'):
                     return "❌ Мой Пип-бой завис... Попробуйте позже 🤖"
                 return result['result']['alternatives'][0]['message']['text']
         except asyncio.TimeoutError:
-            return "⏳ Обработка данных... Подождите 😊"
+            raise UpstreamError(_LLM_TIMEOUT_REPLY)
+        except (aiohttp.ClientError, ValueError) as e:
+            raise UpstreamError(f"❌ Системная ошибка: {str(e)[:60]} 😰")
+    
+    async def stream(self, messages: list):
+        """Потоковая генерация: отдаёт накопленный текст ответа по мере готовности"""
+        if not self.session:
+            await self.init()
+        
+        data = dict(self._payload)
+        data["completionOptions"] = {**self._payload["completionOptions"], "stream": True}
+        data["messages"] = messages
+        
+        async with self.semaphore:
+            # Поток не хеджируется; предохранитель видит время до первого фрагмента
+            try:
+                probe = self.breaker.acquire() if self.breaker else False
+            except CircuitOpenError:
+                yield LLM_UNAVAILABLE_REPLY
+                return
+            start = time.monotonic()
+            recorded = False
+            
+            def record(ok: bool):
+                nonlocal recorded
+                if self.breaker and not recorded:
+                    self.breaker.record(ok, time.monotonic() - start, probe)
+                recorded = True
+            
+            try:
+                async with self.session.post(self.url, json=data) as response:
+                    if response.status != 200:
+                        result = await response.json(content_type=None)
+                        record(not self._is_upstream_failure(response.status))
+                        yield self._error_reply(result if isinstance(result, dict) else {})
+                        return
+                    # Ответ — JSON-объекты по одному на строку, в каждом весь текст на данный момент
+                    async for line in response.content:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        alternatives = chunk.get('result', {}).get('alternatives')
+                        if alternatives:
+                            record(True)
+                            yield alternatives[0]['message']['text']
+                    record(True)
+            except asyncio.TimeoutError:
+                record(False)
+                yield _LLM_TIMEOUT_REPLY
+            except (aiohttp.ClientError, ValueError) as e:
+                record(False)
+                yield f"❌ Системная ошибка: {str(e)[:60]} 😰"
+            except Exception as e:
+                log(f"⚠️ Неожиданный ответ YandexGPT: {type(e).__name__}: {e}")
+                yield f"❌ Системная ошибка: {str(e)[:60]} 😰"
+            finally:
+                if self.breaker and not recorded:
+                    self.breaker.release(probe)
+
+llm_client = YandexGPTClient(
+    YC_API_KEY, YC_FOLDER_ID,
+    pool_size=LLM_POOL_SIZE,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    timeout=LLM_TIMEOUT,
+    connect_timeout=LLM_CONNECT_TIMEOUT,
+    breaker=breakers["llm"]
+)
+
+# ============ СБОРКА ПРОМПТА ============
+_TOKEN_PIECE = re.compile(r'\w+|[^\w\s]')
+# Так начинаются ответы YandexGPTClient при ошибках — в сводку их не пишем
+_LLM_ERROR_PREFIXES = ("❌", "⏳", "📡")
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов: слово — около токена на 4 символа, знак — токен"""
+    tokens = 0
+    for piece in _TOKEN_PIECE.findall(text):
+        tokens += (len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == "_" else 1
+    return tokens
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст до оценки max_tokens (по пропорции символов, с запасом)"""
+    tokens = estimate_tokens(text)
+    while tokens > max_tokens and text:
+        text = text[:max(int(len(text) * max_tokens / tokens * 0.95), 0)]
+        tokens = estimate_tokens(text)
+    return text
+
+PROMPT_TOKENS = metrics.add(Histogram(
+    "synth_prompt_tokens", "Оценка размера промпта YandexGPT в токенах",
+    buckets=(250, 500, 750, 1000, 1250, 1500, 2000, 2500, 3000, 4000, 6000)
+))
+
+class PromptBuilder:
+    """Сборка промпта в пределах бюджета токенов.
+    
+    Порядок приоритетов: системный промпт, вопрос, справка вики (не больше
+    wiki_tokens), сводка старой части диалога (не больше summary_tokens), затем
+    реплики истории от новых к старым, пока хватает бюджета и max_turns.
+    Не поместившиеся реплики, ещё не вошедшие в сводку, возвращаются отдельно,
+    чтобы их свернул ConversationSummaries.
+    """
+    MESSAGE_OVERHEAD = 4
+    
+    def __init__(self, budget: int, max_turns: int, wiki_tokens: int, summary_tokens: int):
+        self.budget = budget
+        self.max_turns = max_turns
+        self.wiki_tokens = wiki_tokens
+        self.summary_tokens = summary_tokens
+        self.system_tokens = estimate_tokens(SYSTEM_PROMPT) + self.MESSAGE_OVERHEAD
+    
+    def build(self, prompt: str, history: list, wiki_context: str = "", summary: tuple = None) -> tuple:
+        """Возвращает (messages, overflow): сообщения для YandexGPT и реплики для сводки"""
+        remaining = self.budget - self.system_tokens
+        
+        # Вопрос обязателен, но не больше половины оставшегося бюджета
+        prompt = truncate_to_tokens(prompt, max(remaining // 2, 64))
+        remaining -= estimate_tokens(prompt) + self.MESSAGE_OVERHEAD
+        
+        wiki_message = None
+        if wiki_context and remaining > self.MESSAGE_OVERHEAD:
+            wiki_text = truncate_to_tokens(wiki_context, min(self.wiki_tokens, remaining - self.MESSAGE_OVERHEAD))
+            if wiki_text:
+                wiki_message = {"role": "system", "text": f"СПРАВОЧНЫЕ ДАННЫЕ:\n{wiki_text}"}
+                remaining -= estimate_tokens(wiki_message["text"]) + self.MESSAGE_OVERHEAD
+        
+        summary_message = None
+        covered_until = None
+        if summary:
+            summary_text, covered_until = summary
+            summary_text = truncate_to_tokens(summary_text, min(self.summary_tokens, remaining - self.MESSAGE_OVERHEAD))
+            if summary_text:
+                summary_message = {"role": "system", "text": f"РАНЕЕ В РАЗГОВОРЕ:\n{summary_text}"}
+                remaining -= estimate_tokens(summary_message["text"]) + self.MESSAGE_OVERHEAD
+        
+        # История: от новых реплик к старым, без пропусков в середине
+        kept = 0
+        for msg in reversed(history[-self.max_turns:] if self.max_turns else []):
+            cost = estimate_tokens(msg["text"]) + self.MESSAGE_OVERHEAD
+            if cost > remaining:
+                break
+            remaining -= cost
+            kept += 1
+        turns = history[len(history) - kept:]
+        overflow = [
+            msg for msg in history[:len(history) - kept]
+            if msg.get("created_at") and (covered_until is None or msg["created_at"] > covered_until)
+        ]
+        
+        messages = [{"role": "system", "text": SYSTEM_PROMPT}]
+        if summary_message:
+            messages.append(summary_message)
+        messages.extend({"role": msg["role"], "text": msg["text"]} for msg in turns)
+        if wiki_message:
+            messages.append(wiki_message)
+        messages.append({"role": "user", "text": prompt})
+        
+        PROMPT_TOKENS.observe(self.budget - remaining)
+        return messages, overflow
+
+class ConversationSummaries:
+    """Скользящие сводки диалога: по одной на пользователя, в памяти и в user_summaries.
+    
+    Реплики, выпавшие из промпта, сворачиваются в сводку фоновой задачей (не на
+    пути ответа): YandexGPT получает прежнюю сводку и новые реплики и возвращает
+    обновлённую. covered_until — время последней учтённой реплики.
+    
+    Обновление запускается не на каждый ответ, а когда несвёрнутых реплик набралось
+    min_turns или min_tokens, и проходит через допуск к генерации с низшим
+    приоритетом: сводка не отнимает у интерактивных ответов ни квоту, ни места.
+    """
+    SUMMARY_PROMPT = (
+        "Ты ведёшь краткий конспект разговора Синта с собеседником. Обнови конспект с учётом новых реплик. "
+        "Сохрани факты о собеседнике, его просьбы, обещания Синта и важные детали. "
+        "Пиши от третьего лица, без вступлений, не длиннее 5 предложений."
+    )
+    
+    def __init__(self, max_tokens: int, min_turns: int, min_tokens: int, cache_size: int = 100_000):
+        self.max_tokens = max_tokens
+        self.min_turns = min_turns
+        self.min_tokens = min_tokens
+        self._cache = TTLCache(cache_size, HISTORY_TTL.total_seconds())   # user_id -> (текст, covered_until) | None
+        self._refreshing = set()
+        self._dropped = set()
+        self._tasks = set()
+        self.refreshes = 0
+        self.failures = 0
+    
+    async def get(self, user_id: int):
+        """(текст, covered_until) или None"""
+        cached = self._cache.get(user_id)
+        if cached is not _MISSING:
+            return cached
+        try:
+            summary = await storage.get_summary(user_id, datetime.utcnow() - HISTORY_TTL)
         except Exception as e:
-            return f"❌ Системная ошибка: {str(e)[:60]} 😰"
+            # Без сводки ответ всё равно можно собрать
+            log(f"⚠️ Ошибка чтения сводки: {e}")
+            return None
+        self._cache.set(user_id, summary)
+        return summary
+    
+    def schedule(self, user_id: int, turns: list):
+        """Запускает обновление сводки, если несвёрнутого набралось достаточно и оно ещё не идёт"""
+        if user_id in self._refreshing:
+            return
+        if len(turns) < self.min_turns and sum(estimate_tokens(m["text"]) for m in turns) < self.min_tokens:
+            return
+        self._refreshing.add(user_id)
+        task = asyncio.create_task(self._refresh(user_id, turns))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def drop(self, user_id: int):
+        """После /clear: забыть сводку и не записывать уже начатое обновление"""
+        self._cache.set(user_id, None)
+        if user_id in self._refreshing:
+            self._dropped.add(user_id)
+    
+    def _dialogue(self, turns: list) -> str:
+        lines = []
+        for msg in turns:
+            speaker = "Собеседник" if msg["role"] == "user" else "Синт"
+            lines.append(f"{speaker}: {msg['text']}")
+        return "\n".join(lines)
+    
+    async def _refresh(self, user_id: int, turns: list):
+        try:
+            current = await self.get(user_id)
+            previous = current[0] if current else "(пока пусто)"
+            request = f"КОНСПЕКТ:\n{previous}\n\nНОВЫЕ РЕПЛИКИ:\n{self._dialogue(turns)}"
+            try:
+                await admission.acquire(user_id, PRIORITY_SUMMARY, estimate_tokens(request), check_rate=False)
+            except Overloaded as e:
+                # Реплики остаются в истории: сводку догонит следующее обновление
+                log(f"🚦 Обновление сводки {user_id} отложено: {e.reason}", user_id=user_id, reason=e.reason)
+                return
+            try:
+                response = await llm_client.complete(
+                    [
+                        {"role": "system", "text": self.SUMMARY_PROMPT},
+                        {"role": "user", "text": request},
+                    ],
+                    max_tokens=self.max_tokens * 2,
+                    temperature=0.3
+                )
+            finally:
+                admission.release()
+            if response.startswith(_LLM_ERROR_PREFIXES):
+                self.failures += 1
+                return
+            if user_id in self._dropped:
+                return
+            
+            summary = (truncate_to_tokens(response.strip(), self.max_tokens), max(m["created_at"] for m in turns))
+            await storage.put_summary(user_id, *summary)
+            if user_id not in self._dropped:
+                self._cache.set(user_id, summary)
+            self.refreshes += 1
+        except Exception as e:
+            self.failures += 1
+            log(f"⚠️ Ошибка обновления сводки: {e}")
+        finally:
+            self._refreshing.discard(user_id)
+            self._dropped.discard(user_id)
+    
+    async def close(self, timeout: float):
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+prompt_builder = PromptBuilder(PROMPT_TOKEN_BUDGET, PROMPT_MAX_TURNS, PROMPT_WIKI_TOKENS, PROMPT_SUMMARY_TOKENS)
+# Порог не больше числа реплик, выпадающих из промпта, иначе кэш истории забудет их раньше сводки
+conversation_summaries = ConversationSummaries(
+    PROMPT_SUMMARY_TOKENS, max(1, min(SUMMARY_MIN_TURNS, HISTORY_CACHE_PER_USER - PROMPT_MAX_TURNS)), SUMMARY_MIN_TOKENS
+)
+
+async def prepare_messages(prompt: str, history: list, wiki_context: str = "", *,
+                           user_id: int = None, summary=_MISSING) -> list:
+    """Промпт в пределах бюджета; выпавшие реплики уходят в фоновое обновление сводки.
+    Без user_id сводки не читаются и не обновляются; уже загруженную сводку можно передать в summary."""
+    if user_id is None:
+        summary = None
+    elif summary is _MISSING:
+        summary = await conversation_summaries.get(user_id)
+    messages, overflow = prompt_builder.build(prompt, history, wiki_context, summary)
+    if overflow and user_id is not None:
+        conversation_summaries.schedule(user_id, overflow)
+    return messages
+
+async def get_yandex_response(prompt: str, history: list, wiki_context: str = "", *,
+                              user_id: int = None, summary=_MISSING) -> str:
+    return await llm_client.complete(
+        await prepare_messages(prompt, history, wiki_context, user_id=user_id, summary=summary)
+    )
+
+def add_glitch(response: str) -> str:
+    """Добавляет "странность" синта с 15% шансом"""
+    if random.random() < 0.15 and "SYSTEM:" not in response and "биологическ" not in response.lower():
+        glitches = [
+            " [Пип-бой: СИСТЕМНЫЙ СБОЙ 0.3с]",
+            " ...странно, я точно помню эту дату: 23 октября 2077, 14:47...",
+            " (обработка данных завершена)",
+            " ...почему я не чувствую голода уже 72 часа? Ладно, неважно 😊",
+            " [Память: 98.7%]"
+        ]
+        response += random.choice(glitches)
+    return response
+
+_SENTENCE_END = re.compile(r'[.!?…](?:\s|$)|\n')
+
+async def send_streaming_reply(message: Message, prompt: str, history: list, wiki_context: str = "",
+                               summary=_MISSING) -> tuple:
+    """Показывает ответ по мере генерации: первое предложение сразу, дальше — правками.
+    
+    Правки не чаще STREAM_EDIT_INTERVAL (в группах — STREAM_GROUP_EDIT_INTERVAL),
+    RetryAfter от Telegram сдвигает следующую правку. Если поток оборвался после
+    части ответа, часть остаётся, а сообщение об ошибке дописывается в конец.
+    Возвращает (ответ YandexGPT или текст ошибки, показанный текст с «глюками»).
+    """
+    is_group = message.chat.type in ["group", "supergroup"]
+    interval = STREAM_GROUP_EDIT_INTERVAL if is_group else STREAM_EDIT_INTERVAL
+    
+    sent = None
+    shown = ""
+    text = ""
+    partial = ""
+    next_edit = 0.0
+    
+    messages = await prepare_messages(prompt, history, wiki_context, user_id=message.from_user.id, summary=summary)
+    async for text in llm_client.stream(messages):
+        if text.startswith(_LLM_ERROR_PREFIXES):
+            # Ошибка приходит последней и заменила бы уже показанную часть ответа
+            break
+        partial = text
+        if sent is None:
+            if not _SENTENCE_END.search(text):
+                continue
+            sent = await reply(message, text)
+            shown = text
+            next_edit = time.monotonic() + interval
+            continue
+        
+        if text == shown or time.monotonic() < next_edit:
+            continue
+        try:
+            await outbound.send(message.chat.id, lambda: sent.edit_text(text), retry=False)
+            shown = text
+        except TelegramRetryAfter as e:
+            next_edit = time.monotonic() + e.retry_after
+            continue
+        except TelegramBadRequest:
+            pass
+        next_edit = time.monotonic() + interval
+    
+    if partial and partial != text:
+        response = f"{partial}\n\n{text}"
+    else:
+        response = add_glitch(text or "❌ Мой Пип-бой завис... Попробуйте позже 🤖")
+    
+    if sent is None:
+        await reply(message, response, parse_mode="Markdown")
+        return text, response
+    
+    # Финальная правка: дожидаемся окна лимита, Markdown — только если он валиден
+    delay = next_edit - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    # RetryAfter повторяет очередь исходящих; если она сдалась — ждём ещё раз сами
+    parse_mode = "Markdown"
+    waited = False
+    for attempt in range(3):
+        try:
+            await outbound.send(message.chat.id, lambda: sent.edit_text(response, parse_mode=parse_mode))
+            break
+        except TelegramRetryAfter as e:
+            if waited:
+                break
+            waited = True
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest:
+            # Битая разметка — пробуем без неё; "message is not modified" — уже готово
+            if parse_mode is None:
+                break
+            parse_mode = None
+    
+    return text, response
+
+# ============ КЭШ ОТВЕТОВ ============
+_MENTION = re.compile(r'@\w+')
+_QUESTION_WORD = re.compile(r'\w+')
+# Служебные слова вопроса: «кто такие гули» и «расскажи про гулей» — один и тот же вопрос
+_QUESTION_STOPWORDS = frozenset("""
+а и в во на о об обо про с со к ко у из за по до от для без над под при же ли ль бы ну вот
+кто что какой какая какое какие каков как где куда откуда когда зачем почему сколько чей чья чьё
+такой такая такое такие это этот эта эти тот та те то там тут здесь
+я ты он она оно мы вы они мне меня мной тебе тебя тобой нам нас вам вас им их его ее её
+есть был была было были быть будет можешь можно скажи расскажи подскажи объясни знаешь
+пожалуйста плиз привет слушай вообще просто кратко подробно подробнее немного чуть синт бот
+""".split())
+
+def question_fingerprint(text: str) -> str:
+    """Отпечаток вопроса: основы значимых слов без служебных, по алфавиту; "" — кэшировать нечего"""
+    words = _QUESTION_WORD.findall(_MENTION.sub(" ", text).lower().replace("ё", "е"))
+    stems = sorted({stem(word) for word in words if word not in _QUESTION_STOPWORDS})
+    if not stems or len(stems) > RESPONSE_CACHE_MAX_WORDS:
+        return ""
+    return " ".join(stems)
+
+RESPONSE_CACHE_LOOKUPS = metrics.add(Counter(
+    "synth_response_cache_total", "Кэш ответов: hit, miss, fill и bypass (у пользователя свежая история)", "result"
+))
+
+class ResponseCache:
+    """Готовые ответы на типовые вопросы: отпечаток вопроса + заголовок справки → варианты.
+    
+    Пока вариантов меньше variants, каждый промах дописывает свежий ответ
+    YandexGPT; когда набор полон, отдаётся случайный вариант, чтобы персонаж не
+    повторялся дословно. LRU с TTL в памяти; с persist — ещё и в хранилище
+    (таблица кэша вики, kind "response"), так что кэш переживает перезапуск.
+    """
+    KIND = "response"
+    
+    def __init__(self, size: int, ttl: int, variants: int, persist: bool):
+        self.memory = TTLCache(size, ttl)
+        self.ttl = ttl
+        self.variants = variants
+        self.persist = persist
+    
+    def __len__(self):
+        return len(self.memory)
+    
+    async def _load(self, key: str) -> list:
+        variants = self.memory.get(key)
+        if variants is not _MISSING:
+            return variants
+        if not self.persist or storage is None:
+            return []
+        try:
+            row = await storage.get_cached(self.KIND, key, datetime.utcnow())
+        except Exception as e:
+            log(f"⚠️ Ошибка чтения кэша ответов: {e}")
+            return []
+        if row is None or row[0] is None:
+            return []
+        value, expires_at = row
+        variants = json.loads(value)
+        self.memory.set(key, variants, ttl=min((expires_at - datetime.utcnow()).total_seconds(), self.ttl))
+        return variants
+    
+    async def get(self, key: str):
+        """Случайный готовый вариант или None, если нужен свежий ответ"""
+        variants = await self._load(key)
+        if len(variants) >= self.variants:
+            RESPONSE_CACHE_LOOKUPS.inc("hit")
+            return random.choice(variants)
+        RESPONSE_CACHE_LOOKUPS.inc("miss")
+        return None
+    
+    async def put(self, key: str, answer: str):
+        if not answer or answer.startswith(_LLM_ERROR_PREFIXES):
+            return
+        variants = await self._load(key)
+        # Повторы тоже считаются: при детерминированной генерации набор всё равно заполнится
+        if len(variants) >= self.variants:
+            return
+        variants = variants + [answer]
+        self.memory.set(key, variants)
+        RESPONSE_CACHE_LOOKUPS.inc("fill")
+        if not self.persist or storage is None:
+            return
+        try:
+            await storage.put_cached(self.KIND, key, json.dumps(variants, ensure_ascii=False),
+                                     datetime.utcnow() + timedelta(seconds=self.ttl))
+        except Exception as e:
+            log(f"⚠️ Ошибка записи кэша ответов: {e}")
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS, RESPONSE_CACHE_PERSIST)
+
+def response_cache_key(text: str, history: list, wiki_title: str = "", history_known: bool = True):
+    """Ключ кэша ответов или None: вопрос не типовой или недавний разговор может изменить ответ.
+    
+    history_known=False — история не успела загрузиться: пустой список ничего не
+    говорит о паузе в разговоре, поэтому кэш обходится.
+    """
+    if not RESPONSE_CACHE_SIZE:
+        return None
+    if not history_known:
+        RESPONSE_CACHE_LOOKUPS.inc("bypass")
+        return None
+    fingerprint = question_fingerprint(text)
+    if not fingerprint:
+        return None
+    cutoff = datetime.utcnow() - timedelta(seconds=RESPONSE_CACHE_QUIET)
+    if any(msg.get("created_at") and msg["created_at"] > cutoff for msg in history):
+        RESPONSE_CACHE_LOOKUPS.inc("bypass")
+        return None
+    return f"{fingerprint}|{wiki_title}"
 
 # ============ ОБРАБОТЧИКИ ============
 @dp.message(Command("start"))
@@ -439,7 +2832,8 @@ async def start_handler(message: Message):
     # Сохраняем пользователя при первом контакте
     await save_message(message.from_user.id, message.chat.id, "user", "/start")
     
-    await message.answer(
+    await reply(
+        message,
         "👋 *Приветствую, выживший!*\n"
         "Я — А-7X-42-Синт, обычный человек из руин Бостона.\n"
         "Помогаю советами в этом жестоком мире 😊\n\n"
@@ -457,13 +2851,439 @@ async def start_handler(message: Message):
 async def clear_handler(message: Message):
     """Очистка личной истории диалога"""
     try:
-        deleted = await db_pool.execute(
-            "DELETE FROM dialog_history WHERE user_id = $1",
-            message.from_user.id
-        )
-        await message.answer("🧠 Память очищена! Готов к новому диалогу 😊")
+        conversation_cache.reset(message.from_user.id)
+        conversation_summaries.drop(message.from_user.id)
+        await write_buffer.discard_user(message.from_user.id, lambda: storage.clear_history(message.from_user.id))
+        await reply(message, "🧠 Память очищена! Готов к новому диалогу 😊")
+    except Exception as e:
+        await reply(message, f"❌ Ошибка очистки: {str(e)}")
+
+class ChatCoalescer:
+    """Склейка быстрых серий сообщений и последовательная обработка внутри чата.
+    
+    На каждый чат с необработанными сообщениями — одна задача-обработчик, так что
+    ответы в чате идут строго по очереди, а разные чаты обрабатываются параллельно.
+    Сообщения одного автора, пришедшие подряд с паузами меньше COALESCE_WINDOW,
+    отдаются обработчику одной пачкой. Когда очередь чата пуста, его состояние удаляется.
+    """
+    def __init__(self, handler, window: float, max_wait: float, max_messages: int):
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._chats = {}   # chat_id -> deque[(received_at, Message)]
+        self._tasks = set()
+        self.batches = 0
+        self.coalesced = 0
+    
+    def __len__(self):
+        return len(self._chats)
+    
+    def submit(self, message: Message):
+        queue = self._chats.get(message.chat.id)
+        if queue is None:
+            queue = self._chats[message.chat.id] = deque()
+            task = asyncio.create_task(self._worker(message.chat.id, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append((time.monotonic(), message))
+    
+    async def drain(self, timeout: float):
+        """Ждёт, пока обработаются уже принятые сообщения (при остановке)"""
+        if self._tasks:
+            done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if pending:
+                log(f"⚠️ Не дождались обработки сообщений в {len(pending)} чатах")
+    
+    def _take_batch(self, queue: deque) -> list:
+        """Подряд идущие сообщения одного автора"""
+        author = queue[0][1].from_user.id
+        batch = []
+        while queue and queue[0][1].from_user.id == author and len(batch) < self.max_messages:
+            batch.append(queue.popleft()[1])
+        return batch
+    
+    async def _debounce(self, queue: deque):
+        first = queue[0][0]
+        while True:
+            deadline = min(queue[-1][0] + self.window, first + self.max_wait)
+            delay = deadline - time.monotonic()
+            if delay <= 0 or len(queue) >= self.max_messages:
+                return
+            await asyncio.sleep(delay)
+    
+    async def _worker(self, chat_id: int, queue: deque):
+        try:
+            while queue:
+                await self._debounce(queue)
+                batch = self._take_batch(queue)
+                self.batches += 1
+                self.coalesced += len(batch) - 1
+                try:
+                    await self.handler(batch)
+                except Exception as e:
+                    log(f"⚠️ Ошибка обработки сообщений чата {chat_id}: {e}")
+        finally:
+            # Очередь пуста — состояние чата больше не нужно
+            if self._chats.get(chat_id) is queue:
+                del self._chats[chat_id]
+
+# ============ ДОПУСК К ГЕНЕРАЦИИ ============
+PRIORITY_DIRECT = 0   # личные сообщения и ответы на сообщения бота
+PRIORITY_GROUP = 1    # упоминания в группах
+PRIORITY_SUMMARY = 2  # фоновые обновления сводок диалога
+_ADMISSION_CLASSES = {PRIORITY_DIRECT: "direct", PRIORITY_GROUP: "group", PRIORITY_SUMMARY: "summary"}
+
+BUSY_REPLY = "📟 В эфире слишком много сигналов — мои контуры перегружены. Повторите вопрос через минуту 🤖"
+SLOW_DOWN_REPLY = "🔋 Перегрев процессора: вы спрашиваете быстрее, чем я успеваю думать. Дайте мне минуту остыть 🤖"
+
+ADMISSION_WAIT = metrics.add(Histogram("synth_admission_wait_seconds", "Ожидание допуска к генерации", "priority"))
+ADMISSION_SHED = metrics.add(Counter("synth_admission_shed_total", "Запросы, не допущенные к генерации", "reason"))
+
+class Overloaded(Exception):
+    """Запрос не допущен к генерации; reason — причина для метрик"""
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class _AdmissionWaiter:
+    __slots__ = ("user_id", "priority", "cost", "future", "queued_at")
+    
+    def __init__(self, user_id: int, priority: int, cost: int):
+        self.user_id = user_id
+        self.priority = priority
+        self.cost = cost
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+class _AdmissionFlow:
+    __slots__ = ("waiters", "deficit")
+    
+    def __init__(self):
+        self.waiters = deque()
+        self.deficit = 0
+
+class AdmissionController:
+    """Допуск к генерации ответа: лимит пользователя, ограниченная очередь, справедливость.
+    
+    Одновременно готовится не больше concurrency ответов. Сверх лимита
+    пользователя (ведро токенов user_rate в минуту, серия user_burst) запрос
+    отклоняется сразу. Остальные ждут места в очереди: личные сообщения и ответы
+    боту раньше упоминаний в группах, а внутри класса — deficit round robin по
+    пользователям с ценой запроса в токенах, чтобы один болтливый пользователь
+    или группа не занимали всю очередь. Если очередь полна, ожидание дольше
+    max_wait или запрос вытеснен более срочным — Overloaded.
+    """
+    def __init__(self, concurrency: int, queue_size: int, user_queue: int, max_wait: float,
+                 user_rate: float, user_burst: int, quantum: int, notice_interval: float):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.user_queue = user_queue
+        self.max_wait = max_wait
+        self.user_rate = user_rate / 60
+        self.user_burst = user_burst
+        self.quantum = quantum
+        self.active = 0
+        # Приоритет -> {user_id: очередь пользователя}; порядок словаря — круг DRR
+        self._flows = {priority: OrderedDict() for priority in _ADMISSION_CLASSES}
+        self._queued = {priority: 0 for priority in _ADMISSION_CLASSES}
+        # Полное ведро можно забыть: через burst / rate секунд простоя оно и так полное
+        self._buckets = TTLCache(1_000_000, user_burst / self.user_rate)
+        self._notified = TTLCache(100_000, notice_interval)
+    
+    def __len__(self):
+        return sum(self._queued.values())
+    
+    def depth(self) -> dict:
+        return {_ADMISSION_CLASSES[priority]: count for priority, count in self._queued.items()}
+    
+    def _check_rate(self, user_id: int):
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+        if bucket.delay(now) > 0:
+            raise Overloaded("rate_limited")
+        bucket.take(now)
+        self._buckets.set(user_id, bucket)
+    
+    async def acquire(self, user_id: int, priority: int, cost: int, check_rate: bool = True):
+        """Ждёт места для генерации; после ответа обязательно release().
+        check_rate=False — служебная генерация, не расходующая лимит пользователя"""
+        if check_rate:
+            self._check_rate(user_id)
+        label = _ADMISSION_CLASSES[priority]
+        if self.active < self.concurrency and not len(self):
+            self.active += 1
+            ADMISSION_WAIT.observe(0, label)
+            return
+        
+        flow = self._flows[priority].get(user_id)
+        if flow and len(flow.waiters) >= self.user_queue:
+            raise Overloaded("user_queue")
+        if len(self) >= self.queue_size and not self._evict_below(priority):
+            raise Overloaded("queue_full")
+        
+        waiter = _AdmissionWaiter(user_id, priority, cost)
+        if flow is None:
+            flow = self._flows[priority][user_id] = _AdmissionFlow()
+        flow.waiters.append(waiter)
+        self._queued[priority] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                self._remove(waiter)
+                raise Overloaded("timeout")
+            waiter.future.result()
+        except asyncio.CancelledError:
+            if not waiter.future.done():
+                self._remove(waiter)
+            elif waiter.future.exception() is None:
+                self.release()
+            raise
+        ADMISSION_WAIT.observe(time.monotonic() - waiter.queued_at, label)
+    
+    def release(self):
+        self.active -= 1
+        while self.active < self.concurrency:
+            waiter = self._next()
+            if waiter is None:
+                return
+            self.active += 1
+            waiter.future.set_result(True)
+    
+    def _next(self):
+        """Следующий запрос: по классам приоритета, внутри класса — deficit round robin"""
+        for priority, flows in self._flows.items():
+            while flows:
+                user_id, flow = next(iter(flows.items()))
+                waiter = flow.waiters[0]
+                if flow.deficit < waiter.cost:
+                    flow.deficit += self.quantum
+                    flows.move_to_end(user_id)
+                    continue
+                flow.deficit -= waiter.cost
+                flow.waiters.popleft()
+                self._queued[priority] -= 1
+                if not flow.waiters:
+                    del flows[user_id]
+                return waiter
+        return None
+    
+    def _remove(self, waiter: _AdmissionWaiter):
+        flows = self._flows[waiter.priority]
+        flow = flows.get(waiter.user_id)
+        if flow and waiter in flow.waiters:
+            flow.waiters.remove(waiter)
+            self._queued[waiter.priority] -= 1
+            if not flow.waiters:
+                del flows[waiter.user_id]
+    
+    def _evict_below(self, priority: int) -> bool:
+        """Освобождает место в полной очереди за счёт менее срочного класса:
+        вытесняется последний запрос пользователя с самой длинной очередью"""
+        for lower in _ADMISSION_CLASSES:
+            if lower <= priority or not self._flows[lower]:
+                continue
+            flow = max(self._flows[lower].values(), key=lambda f: len(f.waiters))
+            waiter = flow.waiters[-1]
+            self._remove(waiter)
+            waiter.future.set_exception(Overloaded("evicted"))
+            return True
+        return False
+    
+    def should_notify(self, user_id: int) -> bool:
+        """Сообщать ли пользователю об отказе (не чаще раза в notice_interval)"""
+        if self._notified.get(user_id, None) is not None:
+            return False
+        self._notified.set(user_id, True)
+        return True
+
+def admission_priority(message: Message) -> int:
+    if message.chat.type == "private":
+        return PRIORITY_DIRECT
+    replied = message.reply_to_message
+    if replied and replied.from_user and replied.from_user.id == bot.id:
+        return PRIORITY_DIRECT
+    return PRIORITY_GROUP
+
+admission = AdmissionController(
+    ADMISSION_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_USER_QUEUE, ADMISSION_MAX_WAIT,
+    ADMISSION_USER_RATE, ADMISSION_USER_BURST, ADMISSION_QUANTUM, ADMISSION_NOTICE_INTERVAL
+)
+
+# ============ КОНВЕЙЕР ОТВЕТА ============
+STAGE_DEADLINE_MISSES = metrics.add(Counter(
+    "synth_stage_deadline_misses_total", "Этапы, не уложившиеся в бюджет (ответ собран без них)", "stage"
+))
+_late_tasks = set()
+
+def _finish_late(task: asyncio.Task):
+    _late_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        log(f"⚠️ Опоздавший этап завершился ошибкой: {task.exception()}")
+
+async def within_budget(aw, budget: float, default, stage: str):
+    """Результат aw, если он готов за budget секунд, иначе default.
+    
+    Опоздавшая задача не отменяется: она дорабатывает в фоне и заполняет кэши
+    (вики, история), так что следующий запрос получит результат сразу.
+    """
+    task = asyncio.ensure_future(aw)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), budget)
+    except asyncio.TimeoutError:
+        STAGE_DEADLINE_MISSES.inc(stage)
+        _late_tasks.add(task)
+        task.add_done_callback(_finish_late)
+        return default
     except Exception as e:
-        await message.answer(f"❌ Ошибка очистки: {str(e)}")
+        log(f"⚠️ Этап {stage} не удался: {e}")
+        return default
+
+class TypingIndicator:
+    """async with TypingIndicator(chat_id): «печатает…» обновляется, пока идёт генерация.
+    
+    Уже отправленный запрос при выходе не отменяется (отмена посреди записи
+    портит keep-alive соединение сессии), а дорабатывает в фоне.
+    """
+    def __init__(self, chat_id: int, interval: float = TYPING_REFRESH_INTERVAL):
+        self.chat_id = chat_id
+        self.interval = interval
+        self._task = None
+        self._stop = asyncio.Event()
+    
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+    
+    async def __aexit__(self, *exc):
+        self._stop.set()
+        if not self._task.done():
+            _late_tasks.add(self._task)
+            self._task.add_done_callback(_finish_late)
+    
+    async def _run(self):
+        while not self._stop.is_set():
+            try:
+                with stage_timer("send_chat_action"):
+                    await bot.send_chat_action(self.chat_id, "typing")
+            except Exception as e:
+                log(f"⚠️ Не удалось отправить «печатает»: {e}")
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+async def handle_dialog(messages: list):
+    """Один ответ на серию сообщений: тексты склеиваются в один вопрос"""
+    message = messages[-1]
+    text = "\n".join(m.text for m in messages)
+    trace_id_var.set(f"c{message.chat.id}m{message.message_id}")
+    
+    user_id = message.from_user.id
+    try:
+        await admission.acquire(user_id, admission_priority(message), estimate_tokens(text) + ADMISSION_BASE_COST)
+    except Overloaded as e:
+        # Сразу отвечаем «занят» вместо ответа по таймауту; повторные отказы — молча
+        ADMISSION_SHED.inc(e.reason)
+        log(f"🚦 Запрос {user_id} не допущен: {e.reason}", user_id=user_id, reason=e.reason)
+        if admission.should_notify(user_id):
+            await reply(message, SLOW_DOWN_REPLY if e.reason == "rate_limited" else BUSY_REPLY)
+        return
+    
+    try:
+        with stage_timer("handle_dialog"):
+            await _handle_dialog(message, text)
+    finally:
+        admission.release()
+
+async def _handle_dialog(message: Message, text: str):
+    try:
+        # Справка вики не зависит от истории: запускаем её сразу
+        wiki_task = None
+        query = wiki_query(text)
+        if query:
+            wiki_task = asyncio.ensure_future(wiki_client.lookup(query))
+        
+        # История до текущего вопроса (сам вопрос уходит в промпт отдельно) и сводка — параллельно
+        with stage_timer("get_history"):
+            history, summary = await asyncio.gather(
+                within_budget(get_history(message.from_user.id), HISTORY_BUDGET, None, "get_history"),
+                within_budget(conversation_summaries.get(message.from_user.id), HISTORY_BUDGET, _MISSING, "summary")
+            )
+        history_known = history is not None
+        history = history or []
+        # Не успевшая сводка в этот ответ не попадёт; повторно её не запрашиваем
+        summary_known = summary is not _MISSING
+        summary = summary if summary_known else None
+        # В общий кэш попадают только ответы, собранные без личного контекста
+        cacheable = history_known and summary_known and not history and not summary
+        
+        # СОХРАНЯЕМ ВОПРОС И ОБНОВЛЯЕМ АКТИВНОСТЬ
+        await save_message(message.from_user.id, message.chat.id, "user", text)
+        
+        # ПРОВЕРКА ЗАПРОСА ПРО ИМЯ
+        if is_name_query(text):
+            glitches = [
+                "СИСТЕМНЫЙ СБОЙ: [0x7F3A] Имя: А-7X-42-Синт",
+                "ПАМЯТЬ ПОВРЕЖДЕНА: А-7X-42-Синт... Имя... А-7X-42-Синт...",
+                "ОШИБКА: Имя не найдено. Использую резервный идентификатор: А-7X-42-Синт",
+            ]
+            # Отправляем три бредовых сообщения и сохраняем бред в историю
+            for line in glitches:
+                await reply(message, line)
+            for line in glitches:
+                await save_message(message.from_user.id, message.chat.id, "assistant", line)
+            
+            # Нормальный ответ (готовый из кэша, если он есть)
+            cache_key = response_cache_key(text, history, history_known=history_known)
+            response = await response_cache.get(cache_key) if cache_key else None
+            if response is None:
+                history = history + [{"role": "assistant", "text": line} for line in glitches]
+                response = await get_yandex_response(text, history, "", user_id=message.from_user.id, summary=summary)
+                if cache_key and cacheable:
+                    await response_cache.put(cache_key, response)
+            await save_message(message.from_user.id, message.chat.id, "assistant", response)
+            await reply(message, response)
+            return
+        
+        # ОБЫЧНАЯ ОБРАБОТКА
+        async with TypingIndicator(message.chat.id):
+            wiki_title, wiki_content = "", ""
+            if wiki_task:
+                with stage_timer("wiki"):
+                    wiki_title, wiki_content = await within_budget(wiki_task, WIKI_BUDGET, ("", ""), "wiki")
+            
+            # Типовой вопрос без свежего разговора — готовый ответ вместо генерации
+            cache_key = response_cache_key(text, history, wiki_title, history_known)
+            cached = await response_cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                response = add_glitch(cached)
+            elif LLM_STREAMING:
+                # Ответ появляется по мере генерации, в историю пишется один раз — итоговый
+                with stage_timer("llm_stream"):
+                    answer, response = await send_streaming_reply(message, text, history, wiki_content, summary)
+                if cache_key and cacheable:
+                    await response_cache.put(cache_key, answer)
+                await save_message(message.from_user.id, message.chat.id, "assistant", response)
+                return
+            else:
+                with stage_timer("llm"):
+                    answer = await get_yandex_response(text, history, wiki_content, user_id=message.from_user.id, summary=summary)
+                if cache_key and cacheable:
+                    await response_cache.put(cache_key, answer)
+                response = add_glitch(answer)
+        
+        await save_message(message.from_user.id, message.chat.id, "assistant", response)
+        with stage_timer("answer"):
+            await reply(message, response, parse_mode="Markdown")
+        
+    except Exception as e:
+        await reply(message, f"❌ Сбой: {str(e)}")
+
+chat_coalescer = ChatCoalescer(handle_dialog, COALESCE_WINDOW, COALESCE_MAX_WAIT, COALESCE_MAX_MESSAGES)
 
 @dp.message(AllowedUsersFilter())
 async def ai_handler(message: Message):
@@ -472,7 +3292,7 @@ async def ai_handler(message: Message):
     
     # В группах отвечаем только на упоминания или ответы на сообщения бота
     if message.chat.type in ["group", "supergroup"]:
-        bot_mentioned = f"@{message.bot.username}" in message.text
+        bot_mentioned = f"@{(await bot.me()).username}" in message.text
         replied_to_bot = (
             message.reply_to_message and 
             message.reply_to_message.from_user and 
@@ -482,81 +3302,195 @@ async def ai_handler(message: Message):
         if not (bot_mentioned or replied_to_bot):
             return
     
+    chat_coalescer.submit(message)
+
+# ============ ПРИЁМ ОБНОВЛЕНИЙ ============
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook: проверка секрета, мгновенный ответ 200 и ограниченная очередь.
+    
+    Обновления разбирает фиксированный пул задач; если очередь заполнена,
+    Telegram получает 503 и повторит доставку позже.
+    """
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, queue_size: int, workers: int):
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=secret_token, handle_in_background=True)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self._worker_tasks = []
+        self.accepted = 0
+        self.rejected = 0
+    
+    def start(self):
+        for _ in range(self.workers):
+            self._worker_tasks.append(asyncio.create_task(self._worker()))
+    
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self._background_feed_update(self.bot, update)
+            except Exception as e:
+                log(f"⚠️ Ошибка обработки обновления: {e}")
+            finally:
+                self.queue.task_done()
+    
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.accepted += 1
+        return web.json_response({}, dumps=bot.session.json_dumps)
+    
+    async def close(self):
+        """Дорабатывает очередь при остановке; сессию бота закрывает main()"""
+        try:
+            await asyncio.wait_for(self.queue.join(), SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log(f"⚠️ При остановке не обработано обновлений: {self.queue.qsize()}")
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks.clear()
+
+webhook_handler = None
+
+async def wait_ingest_lock():
+    """Ждёт, пока этот процесс не станет единственным приёмником обновлений.
+    
+    Состояние ответа (кэш истории, очередь чата, сводки, лимиты допуска) живёт в
+    памяти процесса: если обновления одного чата примут два процесса, ответы
+    перемешаются, а история разойдётся. Второй процесс (лишний web или worker,
+    запущенный рядом с web) ждёт, пока первый не остановится.
+    """
+    if ALLOW_MULTIPLE_INGEST:
+        return
+    waiting = False
+    while not await storage.acquire_ingest_lock():
+        if not waiting:
+            log(f"⏸ Обновления уже принимает другой процесс; {WORKER_ID} ждёт своей очереди")
+            waiting = True
+        await asyncio.sleep(INGEST_LOCK_RETRY)
+
+async def run_webhook():
+    """Приём обновлений через webhook на встроенном веб-сервере aiohttp"""
+    global webhook_handler
+    app = web.Application()
+    handler = webhook_handler = QueuedRequestHandler(dp, bot, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS)
+    handler.register(app, path=WEBHOOK_PATH)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, WEB_PORT).start()
+    handler.start()
+    log(f"🌐 Webhook слушает {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}")
+    
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
     try:
-        # СОХРАНЯЕМ ВОПРОС И ОБНОВЛЯЕМ АКТИВНОСТЬ
-        await save_message(message.from_user.id, message.chat.id, "user", message.text)
-        
-        # ПРОВЕРКА ЗАПРОСА ПРО ИМЯ
-        if is_name_query(message.text):
-            # Отправляем три бредовых сообщения
-            await message.answer("СИСТЕМНЫЙ СБОЙ: [0x7F3A] Имя: А-7X-42-Синт")
-            await message.answer("ПАМЯТЬ ПОВРЕЖДЕНА: А-7X-42-Синт... Имя... А-7X-42-Синт...")
-            await message.answer("ОШИБКА: Имя не найдено. Использую резервный идентификатор: А-7X-42-Синт")
-            
-            # Сохраняем бред в историю
-            await save_message(message.from_user.id, message.chat.id, "assistant", "СИСТЕМНЫЙ СБОЙ: [0x7F3A] Имя: А-7X-42-Синт")
-            await save_message(message.from_user.id, message.chat.id, "assistant", "ПАМЯТЬ ПОВРЕЖДЕНА: А-7X-42-Синт... Имя... А-7X-42-Синт...")
-            await save_message(message.from_user.id, message.chat.id, "assistant", "ОШИБКА: Имя не найдено. Использую резервный идентификатор: А-7X-42-Синт")
-            
-            # Нормальный ответ
-            history = await get_history(message.from_user.id)
-            response = await get_yandex_response(message.text, history, "")
-            await save_message(message.from_user.id, message.chat.id, "assistant", response)
-            await message.answer(response)
-            return
-        
-        # ОБЫЧНАЯ ОБРАБОТКА
-        history = await get_history(message.from_user.id)
-        
-        await bot.send_chat_action(message.chat.id, "typing")
-        
-        wiki_content = ""
-        if len(message.text.split()) > 3 and random.random() > 0.4:
-            wiki_content = await wiki_client.search_and_get_content(message.text)
-        
-        response = await get_yandex_response(message.text, history, wiki_content)
-        
-        # Добавляем "странность" с 15% шансом
-        if random.random() < 0.15 and "SYSTEM:" not in response and "биологическ" not in response.lower():
-            glitches = [
-                " [Пип-бой: СИСТЕМНЫЙ СБОЙ 0.3с]",
-                " ...странно, я точно помню эту дату: 23 октября 2077, 14:47...",
-                " (обработка данных завершена)",
-                " ...почему я не чувствую голода уже 72 часа? Ладно, неважно 😊",
-                " [Память: 98.7%]"
-            ]
-            response += random.choice(glitches)
-        
-        await save_message(message.from_user.id, message.chat.id, "assistant", response)
-        await message.answer(response, parse_mode="Markdown")
-        
-    except Exception as e:
-        await message.answer(f"❌ Сбой: {str(e)}")
+        await stop.wait()
+    finally:
+        # Перестаём принимать запросы и дорабатываем очередь
+        await runner.cleanup()
+
+# ============ СОСТОЯНИЕ КОМПОНЕНТОВ В МЕТРИКАХ ============
+def _wiki_cache_stat(field: str) -> dict:
+    tiers = {"title": wiki_cache.tiers["title"], "page": wiki_cache.tiers["page"], "negative": wiki_cache.negative}
+    return {name: tier.stats()[field] for name, tier in tiers.items()}
+
+metrics.add(Gauge("synth_wiki_cache_entries", "Записей в кэше вики", lambda: _wiki_cache_stat("size"), "tier"))
+metrics.add(Gauge("synth_wiki_cache_hits_total", "Попадания в кэш вики", lambda: _wiki_cache_stat("hits"), "tier", "counter"))
+metrics.add(Gauge("synth_wiki_cache_misses_total", "Промахи кэша вики", lambda: _wiki_cache_stat("misses"), "tier", "counter"))
+metrics.add(Gauge("synth_wiki_cache_evictions_total", "Вытеснения из кэша вики по размеру", lambda: _wiki_cache_stat("evictions"), "tier", "counter"))
+metrics.add(Gauge("synth_conversation_cache_users", "Пользователей в кэше истории", lambda: conversation_cache.stats()["users"]))
+metrics.add(Gauge("synth_conversation_cache_hits_total", "Попадания в кэш истории", lambda: conversation_cache.hits, type="counter"))
+metrics.add(Gauge("synth_conversation_cache_misses_total", "Промахи кэша истории", lambda: conversation_cache.misses, type="counter"))
+metrics.add(Gauge("synth_conversation_cache_stale_total", "Перезагрузки кэша истории после сверки с БД",
+                  lambda: conversation_cache.stale, type="counter"))
+metrics.add(Gauge("synth_summary_refreshes_total", "Обновления сводок диалога",
+                  lambda: {"ok": conversation_summaries.refreshes, "failed": conversation_summaries.failures},
+                  "result", "counter"))
+metrics.add(Gauge("synth_circuit_state", "Предохранители: 0 — замкнут, 1 — пробный запрос, 2 — разомкнут",
+                  lambda: {name: b.STATE_VALUES[b.state] for name, b in breakers.items()}, "upstream"))
+metrics.add(Gauge("synth_upstream_error_rate", "Доля ошибок внешнего сервиса в окне предохранителя",
+                  lambda: {name: b.error_rate() for name, b in breakers.items()}, "upstream"))
+metrics.add(Gauge("synth_upstream_p95_seconds", "p95 успешных запросов к внешнему сервису (порог хеджа)",
+                  lambda: {name: b.p95() or 0 for name, b in breakers.items()}, "upstream"))
+metrics.add(Gauge("synth_circuit_rejected_total", "Запросы, отклонённые разомкнутым предохранителем",
+                  lambda: {name: b.rejected for name, b in breakers.items()}, "upstream", "counter"))
+metrics.add(Gauge("synth_hedges_total", "Отправленные дублирующие запросы",
+                  lambda: {name: b.hedges for name, b in breakers.items()}, "upstream", "counter"))
+metrics.add(Gauge("synth_hedge_wins_total", "Дублирующие запросы, ответившие раньше первого",
+                  lambda: {name: b.hedge_wins for name, b in breakers.items()}, "upstream", "counter"))
+metrics.add(Gauge("synth_response_cache_entries", "Вопросов в кэше ответов", lambda: len(response_cache)))
+metrics.add(Gauge("synth_history_buffer_pending", "Строк истории, ждущих записи в БД", lambda: len(write_buffer.history)))
+metrics.add(Gauge("synth_outbound_queue", "Исходящих запросов в очереди", lambda: len(outbound)))
+metrics.add(Gauge("synth_admission_queue", "Запросов в очереди допуска к генерации", admission.depth, "priority"))
+metrics.add(Gauge("synth_admission_active", "Ответов в работе", lambda: admission.active))
+metrics.add(Gauge("synth_coalescer_chats", "Чатов с необработанными сообщениями", lambda: len(chat_coalescer)))
+metrics.add(Gauge("synth_life_scheduled_users", "Пользователей в куче планировщика", lambda: len(life_scheduler._scheduled)))
+metrics.add(Gauge("synth_life_messages_total", "Отправленные \"живые\" сообщения",
+                  lambda: {"sent": life_scheduler.sent, "failed": life_scheduler.failed}, "result", "counter"))
+metrics.add(Gauge("synth_webhook_queue_size", "Обновлений в очереди webhook",
+                  lambda: webhook_handler.queue.qsize() if webhook_handler else 0))
+metrics.add(Gauge("synth_webhook_rejected_total", "Обновления, отклонённые с 503",
+                  lambda: webhook_handler.rejected if webhook_handler else 0, type="counter"))
 
 # ============ ЗАПУСК ============
 async def main():
-    global db_pool
+    log("🚀 Инициализация Синта с памятью и 'жизнью'...")
     
-    print("🚀 Инициализация Синта с памятью и 'жизнью'...")
-    
-    # Инициализируем БД
+    # Инициализируем хранилище
     await init_db()
+    write_buffer.start()
     asyncio.create_task(cleanup_old_messages())
     asyncio.create_task(scheduled_life_messages())  # ЗАПУСКАЕМ ФОНОВУЮ ЗАДАЧУ ЖИЗНИ
     
-    # Инициализируем клиент вики
+    # Инициализируем клиенты вики и YandexGPT
     await wiki_client.init()
+    await llm_client.init()
+    
+    asyncio.create_task(monitor_event_loop())
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
     
-    print("✅ Синт А-7X-42-Синт активирован с полной 'жизнью'!")
-    print(f"YC_FOLDER_ID: {YC_FOLDER_ID}")
-    print("💬 Бот будет писать 5-6 раз в день, обижаться при игноре и вести себя как живой человек!")
+    log("✅ Синт А-7X-42-Синт активирован с полной 'жизнью'!")
+    log(f"YC_FOLDER_ID: {YC_FOLDER_ID}")
+    log("💬 Бот будет писать 5-6 раз в день, обижаться при игноре и вести себя как живой человек!")
     
     try:
-        await dp.start_polling(bot)
+        await wait_ingest_lock()
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot, close_bot_session=False)
     finally:
+        # Даём закончить уже начатые ответы
+        await chat_coalescer.drain(SHUTDOWN_DRAIN_TIMEOUT)
+        await conversation_summaries.close(SHUTDOWN_DRAIN_TIMEOUT)
+        await outbound.close(SHUTDOWN_DRAIN_TIMEOUT)
+        await bot.session.close()
         await wiki_client.close()
-        if db_pool:
-            await db_pool.close()
+        await llm_client.close()
+        # Дописываем в хранилище всё, что осталось в буфере
+        await write_buffer.close()
+        if storage:
+            try:
+                await life_scheduler.release_leases()
+            except Exception as e:
+                log(f"⚠️ Не удалось снять аренды: {e}")
+            await storage.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
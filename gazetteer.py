@@ -0,0 +1,243 @@
+"""Газеттир сущностей Fallout: дешёвое решение «стоит ли идти в вики» и что искать.
+
+Файл данных (по умолчанию gazetteer.txt рядом с модулем) — строки вида
+
+    Brotherhood of Steel = братство стали | стальное братство | паладин
+
+Слева заголовок статьи вики (он же ключ поиска и сам по себе псевдоним), справа
+псевдонимы через |. Сравнение идёт по основам слов: регистр, ё/е и русские
+падежные окончания не важны («Братством Стали» совпадёт с «братство стали»).
+Звёздочка в конце псевдонима — любое продолжение последнего слова
+(«супермутант*»). Строки с # — комментарии.
+
+Все псевдонимы собираются в один автомат Ахо — Корасик, поэтому проверка
+сообщения стоит один проход по тексту независимо от размера словаря.
+
+Пересборка из списка заголовков (по одному в строке, например выгрузка
+api.php?action=query&list=allpages) с сохранением ручных псевдонимов:
+
+    python gazetteer.py build titles.txt --merge gazetteer.txt -o gazetteer.txt
+
+Проверка:
+
+    python gazetteer.py match "Расскажи про Братство Стали"
+"""
+import argparse
+import os
+import re
+from collections import deque
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.txt")
+MIN_ALIAS_CHARS = 4
+
+# ============ НОРМАЛИЗАЦИЯ ============
+_WORD = re.compile(r'\w+')
+_DISAMBIGUATION = re.compile(r'\s*\([^)]*\)\s*$')
+
+# Падежные окончания существительных и прилагательных, длинные — первыми.
+# Глагольных окончаний нет намеренно: «гулять» не должно стать «гул».
+_ENDINGS = sorted([
+    "иями", "ями", "ами", "иях", "ях", "ах", "ией", "ей", "ой", "ий", "ый", "ая", "яя",
+    "ое", "ее", "ые", "ие", "ых", "их", "ым", "им", "ом", "ем", "ью", "ию", "ия", "ье",
+    "ья", "ов", "ев", "ам", "ям", "ого", "его", "ому", "ему", "ыми", "ими", "ую", "юю",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+_MIN_STEM = 3
+
+
+def stem(word: str) -> str:
+    """Грубая основа слова: нижний регистр, ё → е, без одного падежного окончания"""
+    word = word.lower().replace("ё", "е")
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def normalize(text: str) -> str:
+    """Текст → основы слов через пробел, с пробелами по краям (границы слов для автомата)"""
+    return " " + " ".join(stem(word) for word in _WORD.findall(text)) + " "
+
+
+def _pattern(alias: str) -> str:
+    """Псевдоним → строка для автомата. Со звёздочкой нет замыкающего пробела:
+    основа последнего слова может продолжаться в тексте"""
+    prefix = alias.endswith("*")
+    pattern = normalize(alias.rstrip("*"))
+    if not pattern.strip():
+        return ""
+    return pattern[:-1] if prefix else pattern
+
+
+# ============ АВТОМАТ ============
+class Gazetteer:
+    """Словарь сущностей: find(text) → заголовок статьи или None.
+
+    Из нескольких совпадений выбирается самое длинное (при равенстве — первое
+    в тексте): «Братство Стали Запада» важнее «Братства Стали».
+    """
+    def __init__(self, entries=()):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self.keys = []
+        self.aliases = 0
+        for key, aliases in entries:
+            self.add(key, aliases)
+        self._compile()
+
+    def __len__(self) -> int:
+        return self.aliases
+
+    def add(self, key: str, aliases=()):
+        index = len(self.keys)
+        self.keys.append(key)
+        seen = set()
+        for alias in (key, *aliases):
+            pattern = _pattern(alias)
+            if len(pattern.strip()) < 2 or pattern in seen:
+                continue
+            seen.add(pattern)
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append((len(pattern), index))
+            self.aliases += 1
+
+    def _compile(self):
+        """Ссылки неудач обходом в ширину; выходы наследуются по ним"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def matches(self, text: str) -> list:
+        """Все совпадения: [(начало, длина, ключ), ...] в координатах normalize(text)"""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = []
+        state = 0
+        for position, ch in enumerate(normalize(text)):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for length, index in out[state]:
+                found.append((position - length + 1, length, self.keys[index]))
+        return found
+
+    def find(self, text: str):
+        best = None
+        for start, length, key in self.matches(text):
+            if best is None or length > best[1] or (length == best[1] and start < best[0]):
+                best = (start, length, key)
+        return best[2] if best else None
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_PATH) -> "Gazetteer":
+        with open(path, encoding="utf-8") as f:
+            return cls(parse_entries(f))
+
+
+def parse_entries(lines) -> list:
+    """Строки файла данных → [(ключ, [псевдонимы]), ...]"""
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        key, _, aliases = line.partition(" = ")
+        entries.append((key.strip(), [a.strip() for a in aliases.split("|") if a.strip()]))
+    return entries
+
+
+def format_entries(entries) -> str:
+    return "".join(f"{key} = {' | '.join(aliases)}\n" if aliases else f"{key}\n" for key, aliases in entries)
+
+
+# ============ ПЕРЕСБОРКА ============
+def title_key(title: str):
+    """Заголовок вики → ключ словаря или None (служебные страницы и слишком короткие названия)"""
+    title = title.strip()
+    if not title or ":" in title.split(" ", 1)[0] or title.startswith(("List of", "Category")):
+        return None
+    key = _DISAMBIGUATION.sub("", title)
+    if len(key) < MIN_ALIAS_CHARS or not any(ch.isalpha() for ch in key):
+        return None
+    return key
+
+
+def build_entries(titles, merge=(), exclude=()) -> list:
+    """Ручные записи из merge идут первыми и сохраняют свои псевдонимы;
+    новые заголовки добавляются без псевдонимов, исключения отбрасываются"""
+    excluded = {normalize(title) for title in exclude}
+    entries = list(merge)
+    known = {normalize(key) for key, _ in entries}
+    for title in titles:
+        key = title_key(title)
+        if key is None:
+            continue
+        pattern = normalize(key)
+        if pattern in known or pattern in excluded:
+            continue
+        known.add(pattern)
+        entries.append((key, []))
+    return entries
+
+
+def _read_lines(path: str) -> list:
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="собрать словарь из списка заголовков")
+    build.add_argument("titles")
+    build.add_argument("-o", "--output", default=DEFAULT_PATH)
+    build.add_argument("--merge", help="существующий словарь, чьи записи и псевдонимы сохраняются")
+    build.add_argument("--exclude", help="заголовки, которые не должны включать поиск (по одному в строке)")
+
+    match = sub.add_parser("match", help="проверить сообщение")
+    match.add_argument("text")
+    match.add_argument("-g", "--gazetteer", default=DEFAULT_PATH)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        merge = []
+        if args.merge and os.path.exists(args.merge):
+            with open(args.merge, encoding="utf-8") as f:
+                merge = parse_entries(f)
+        entries = build_entries(_read_lines(args.titles), merge, _read_lines(args.exclude))
+        tmp_path = args.output + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("# Газеттир сущностей Fallout, формат и пересборка — в gazetteer.py\n")
+            f.write(format_entries(entries))
+        os.replace(tmp_path, args.output)
+        gazetteer = Gazetteer(entries)
+        print(f"✅ Словарь собран: {args.output}, статей {len(entries)}, псевдонимов {len(gazetteer)}")
+    else:
+        gazetteer = Gazetteer.load(args.gazetteer)
+        for start, length, key in gazetteer.matches(args.text):
+            print(f"{start:>4} {length:>3}  {key}")
+        print(f"→ {gazetteer.find(args.text) or 'справка не нужна'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""Встроенное хранилище для одиночного процесса: всё в памяти, на диске — журнал и снимок.
+
+Тот же набор операций, что у PostgresStorage в bot.py (история диалогов,
+активность пользователей, сводки, аренда пользователей для "живых" сообщений,
+кэш вики, очистка по сроку), но без сети: операции выполняются за микросекунды.
+
+Каждое изменение дописывается строкой JSON в journal.jsonl. Когда журнал
+вырастает больше snapshot_bytes (и при остановке), состояние целиком пишется в
+snapshot.json (через временный файл и атомарную замену), а из журнала остаются
+только записи новее снимка. При запуске читается снимок и доигрывается журнал;
+номера записей (seq) не дают применить одну запись дважды.
+
+Подходит для небольших установок на одном узле и для тестов/бенчмарков без БД:
+
+    STORAGE_BACKEND=memory MEMORY_STORE_PATH=./synth_data python bot.py
+"""
+import asyncio
+import bisect
+import json
+import os
+from datetime import datetime
+
+_DT = datetime.fromisoformat
+
+
+def _iso(value: datetime):
+    return value.isoformat() if value is not None else None
+
+
+def _dt(value: str):
+    return _DT(value) if value is not None else None
+
+
+class MemoryStorage:
+    def __init__(self, path: str, snapshot_bytes: int = 16 * 1024 * 1024, fsync: bool = False):
+        self.path = path
+        self.snapshot_bytes = snapshot_bytes
+        self.fsync = fsync
+        self.journal_path = os.path.join(path, "journal.jsonl")
+        self.snapshot_path = os.path.join(path, "snapshot.json")
+        self.history = {}      # user_id -> [(created_at, chat_id, role, content)] по возрастанию времени
+        self.users = {}        # user_id -> dict полей как в таблице users
+        self.summaries = {}    # user_id -> (summary, covered_until, updated_at)
+        self.cache = {}        # (kind, key) -> (value, expires_at); только в памяти
+        self.leases = {}       # user_id -> (owner, lease_until); только в памяти
+        self._by_bot = []      # отсортированный индекс [(last_message_from_bot, user_id)]
+        self.seq = 0
+        self._journal = None
+        self._snapshot_task = None
+
+    # ============ ЗАПУСК И ОСТАНОВКА ============
+    async def init(self):
+        os.makedirs(self.path, exist_ok=True)
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot_seq = self._load_snapshot(json.load(f))
+        self.seq = snapshot_seq
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная последняя строка после аварийной остановки
+                        break
+                    if record["seq"] <= snapshot_seq:
+                        continue
+                    self._apply(record)
+                    self.seq = record["seq"]
+                    replayed += 1
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        print(f"✅ Встроенное хранилище: {self.path}, пользователей {len(self.users)}, "
+              f"из журнала {replayed} записей")
+
+    async def close(self):
+        if self._snapshot_task:
+            await self._snapshot_task
+        if self._journal:
+            await self.snapshot()
+            self._journal.close()
+            self._journal = None
+
+    # ============ ЖУРНАЛ И СНИМОК ============
+    def _log(self, record: dict):
+        """Применяет изменение и дописывает его в журнал"""
+        self.seq += 1
+        record["seq"] = self.seq
+        self._apply(record)
+        self._journal.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        if self._journal.tell() > self.snapshot_bytes and self._snapshot_task is None:
+            self._snapshot_task = asyncio.create_task(self.snapshot())
+
+    def _state(self) -> dict:
+        return {
+            "seq": self.seq,
+            "users": [
+                [user_id, {k: (_iso(v) if isinstance(v, datetime) else v) for k, v in user.items()}]
+                for user_id, user in self.users.items()
+            ],
+            "history": [
+                [user_id, [[_iso(r[0]), r[1], r[2], r[3]] for r in rows]]
+                for user_id, rows in self.history.items()
+            ],
+            "summaries": [
+                [user_id, s[0], _iso(s[1]), _iso(s[2])] for user_id, s in self.summaries.items()
+            ],
+        }
+
+    def _load_snapshot(self, state: dict) -> int:
+        for user_id, user in state["users"]:
+            self.users[user_id] = {
+                k: (_dt(v) if k.startswith(("last_", "created")) else v) for k, v in user.items()
+            }
+        self._by_bot = sorted((u["last_message_from_bot"], user_id) for user_id, u in self.users.items())
+        for user_id, rows in state["history"]:
+            self.history[user_id] = [(_dt(r[0]), r[1], r[2], r[3]) for r in rows]
+        for user_id, summary, covered_until, updated_at in state["summaries"]:
+            self.summaries[user_id] = (summary, _dt(covered_until), _dt(updated_at))
+        return state["seq"]
+
+    @staticmethod
+    def _write_file(path: str, state: dict):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    async def snapshot(self):
+        """Пишет снимок в потоке; из журнала остаются только записи, появившиеся за это время"""
+        try:
+            state = self._state()
+            offset = self._journal.tell()
+            await asyncio.to_thread(self._write_file, self.snapshot_path, state)
+
+            self._journal.flush()
+            with open(self.journal_path, encoding="utf-8") as f:
+                f.seek(offset)
+                tail = f.read()
+            tmp_path = self.journal_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal.close()
+            os.replace(tmp_path, self.journal_path)
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        finally:
+            self._snapshot_task = None
+
+    # ============ ПРИМЕНЕНИЕ ЗАПИСЕЙ ============
+    def _apply(self, record: dict):
+        op = record["op"]
+        if op == "batch":
+            for user_id, chat_id, role, content, created_at in record["history"]:
+                rows = self.history.setdefault(user_id, [])
+                row = (_dt(created_at), chat_id, role, content)
+                if rows and rows[-1][0] > row[0]:
+                    bisect.insort(rows, row, key=lambda r: r[0])
+                else:
+                    rows.append(row)
+            for user_id, act in record["activity"]:
+                self._apply_activity(user_id, act)
+        elif op == "delete_user":
+            user_id = record["user_id"]
+            user = self.users.pop(user_id, None)
+            if user:
+                self._unindex(user["last_message_from_bot"], user_id)
+            self.history.pop(user_id, None)
+            self.summaries.pop(user_id, None)
+            self.leases.pop(user_id, None)
+        elif op == "clear":
+            self.history.pop(record["user_id"], None)
+            self.summaries.pop(record["user_id"], None)
+        elif op == "summary":
+            self.summaries[record["user_id"]] = (
+                record["summary"], _dt(record["covered_until"]), _dt(record["updated_at"])
+            )
+        elif op == "retention":
+            self._apply_retention(_dt(record["cutoff"]))
+
+    def _apply_activity(self, user_id: int, act: dict):
+        seen = _dt(act["seen"])
+        from_user = _dt(act["from_user"])
+        from_bot = _dt(act["from_bot"])
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = {
+                "chat_id": act["chat_id"],
+                "username": act["username"],
+                "last_message_from_user": from_user or seen,
+                "last_message_from_bot": from_bot or seen,
+                "last_seen": seen,
+                "created_at": seen,
+            }
+            self._index(user["last_message_from_bot"], user_id)
+            return
+        if act["username"] is not None:
+            user["username"] = act["username"]
+        if from_user is not None:
+            user["last_message_from_user"] = from_user
+        if from_bot is not None and from_bot != user["last_message_from_bot"]:
+            self._unindex(user["last_message_from_bot"], user_id)
+            user["last_message_from_bot"] = from_bot
+            self._index(from_bot, user_id)
+        user["last_seen"] = seen
+
+    def _apply_retention(self, cutoff: datetime):
+        for user_id in list(self.history):
+            rows = self.history[user_id]
+            keep = bisect.bisect_right(rows, cutoff, key=lambda r: r[0])
+            if keep == len(rows):
+                del self.history[user_id]
+            elif keep:
+                del rows[:keep]
+        for user_id in [u for u, s in self.summaries.items() if s[2] < cutoff]:
+            del self.summaries[user_id]
+
+    def _index(self, at: datetime, user_id: int):
+        bisect.insort(self._by_bot, (at, user_id))
+
+    def _unindex(self, at: datetime, user_id: int):
+        i = bisect.bisect_left(self._by_bot, (at, user_id))
+        if i < len(self._by_bot) and self._by_bot[i] == (at, user_id):
+            del self._by_bot[i]
+
+    # ============ ИСТОРИЯ И АКТИВНОСТЬ ============
+    async def write_batch(self, history: list, activity: dict):
+        """history — строки (user_id, chat_id, role, content, created_at); activity — user_id -> сводка"""
+        self._log({
+            "op": "batch",
+            "history": [[r[0], r[1], r[2], r[3], _iso(r[4])] for r in history],
+            "activity": [
+                [user_id, {
+                    "chat_id": a["chat_id"],
+                    "username": a["username"],
+                    "from_user": _iso(a["from_user"]),
+                    "from_bot": _iso(a["from_bot"]),
+                    "seen": _iso(a["seen"]),
+                }]
+                for user_id, a in activity.items()
+            ],
+        })
+
+    async def load_history(self, user_id: int, since: datetime, limit: int) -> list:
+        """Последние limit сообщений новее since: [(created_at, role, content)] по возрастанию"""
+        rows = self.history.get(user_id, [])
+        start = max(bisect.bisect_right(rows, since, key=lambda r: r[0]), len(rows) - limit)
+        return [(r[0], r[2], r[3]) for r in rows[start:]]
+
+    async def latest_history_at(self, user_id: int, since: datetime):
+        rows = self.history.get(user_id)
+        if rows and rows[-1][0] > since:
+            return rows[-1][0]
+        return None
+
+    async def clear_history(self, user_id: int):
+        self._log({"op": "clear", "user_id": user_id})
+
+    async def delete_user(self, user_id: int):
+        self._log({"op": "delete_user", "user_id": user_id})
+
+    async def user_activity(self, user_ids: list) -> dict:
+        return {
+            user_id: {
+                "chat_id": user["chat_id"],
+                "username": user["username"],
+                "last_message_from_user": user["last_message_from_user"],
+                "last_message_from_bot": user["last_message_from_bot"],
+                "last_seen": user["last_seen"],
+            }
+            for user_id in user_ids
+            if (user := self.users.get(user_id)) is not None
+        }
+
+    # ============ "ЖИВЫЕ" СООБЩЕНИЯ ============
+    async def claim_due_users(self, owner: str, due_before: datetime, lease_until: datetime,
+                              now: datetime, limit: int) -> list:
+        """[(user_id, last_message_from_bot)] — самые давние, кому бот не писал до due_before"""
+        claimed = []
+        for at, user_id in self._by_bot:
+            if at >= due_before or len(claimed) >= limit:
+                break
+            lease = self.leases.get(user_id)
+            if lease is None or lease[1] < now or lease[0] == owner:
+                self.leases[user_id] = (owner, lease_until)
+                claimed.append((user_id, at))
+        return claimed
+
+    async def release_leases(self, owner: str):
+        for user_id in [u for u, lease in self.leases.items() if lease[0] == owner]:
+            del self.leases[user_id]
+
+    # ============ СВОДКИ ============
+    async def get_summary(self, user_id: int, since: datetime):
+        summary = self.summaries.get(user_id)
+        if summary is None or summary[2] <= since:
+            return None
+        return summary[0], summary[1]
+
+    async def put_summary(self, user_id: int, summary: str, covered_until: datetime):
+        self._log({
+            "op": "summary",
+            "user_id": user_id,
+            "summary": summary,
+            "covered_until": _iso(covered_until),
+            "updated_at": _iso(datetime.utcnow()),
+        })
+
+    # ============ КЭШ ВИКИ ============
+    async def get_cached(self, kind: str, key: str, now: datetime):
+        item = self.cache.get((kind, key))
+        if item is None or item[1] <= now:
+            return None
+        return item
+
+    async def put_cached(self, kind: str, key: str, value, expires_at: datetime):
+        self.cache[(kind, key)] = (value, expires_at)
+
+    # ============ ОБСЛУЖИВАНИЕ ============
+    async def acquire_leadership(self) -> bool:
+        # Процесс один — он всегда ведёт обслуживание
+        return True
+
+    async def release_leadership(self):
+        pass
+
+    async def acquire_ingest_lock(self) -> bool:
+        return True
+
+    async def maintain(self, cutoff: datetime) -> dict:
+        """Удаляет историю и сводки старше cutoff и устаревший кэш вики"""
+        before = sum(len(rows) for rows in self.history.values())
+        self._log({"op": "retention", "cutoff": _iso(cutoff)})
+        now = datetime.utcnow()
+        expired = [k for k, (value, expires_at) in self.cache.items() if expires_at < now]
+        for k in expired:
+            del self.cache[k]
+        if self._snapshot_task is None:
+            self._snapshot_task = asyncio.create_task(self.snapshot())
+        return {
+            "history_deleted": before - sum(len(rows) for rows in self.history.values()),
+            "cache_expired": len(expired),
+        }
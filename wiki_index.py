@@ -0,0 +1,312 @@
+"""Локальный полнотекстовый индекс вики Fallout (SQLite FTS5, ранжирование BM25).
+
+Сборка индекса из дампа MediaWiki (XML, в том числе .bz2/.gz) или JSON
+(список объектов или JSON Lines с полями "title" и "text"/"wikitext"):
+
+    python wiki_index.py build falloutwiki_pages_current.xml.bz2 -o wiki_index.db
+
+Проверка поиска:
+
+    python wiki_index.py search wiki_index.db "Братство Стали"
+"""
+import argparse
+import asyncio
+import bz2
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+
+PASSAGE_CHARS = 500
+
+# ============ ОЧИСТКА ВИКИТЕКСТА ============
+_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+_REF = re.compile(r'<ref[^>/]*/>|<ref[^>]*>.*?</ref>', re.DOTALL | re.IGNORECASE)
+_TEMPLATE = re.compile(r'\{\{[^{}]*\}\}')
+_TABLE = re.compile(r'\{\|.*?\|\}', re.DOTALL)
+_FILE_LINK = re.compile(r'\[\[(?:File|Image|Файл|Изображение|Category|Категория):[^\[\]]*(?:\[\[[^\[\]]*\]\][^\[\]]*)*\]\]', re.IGNORECASE)
+_LINK = re.compile(r'\[\[(?:[^\[\]|]*\|)?([^\[\]]*)\]\]')
+_EXTERNAL_LINK = re.compile(r'\[https?://[^\s\]]+\s*([^\]]*)\]')
+_HEADING = re.compile(r'^=+\s*(.*?)\s*=+\s*$', re.MULTILINE)
+_QUOTES = re.compile(r"'{2,}")
+_TAG = re.compile(r'<[^>]+>')
+_LIST_MARK = re.compile(r'^[*#:;]+\s*', re.MULTILINE)
+_SPACES = re.compile(r'[ \t]+')
+_BLANK_LINES = re.compile(r'\n\s*\n+')
+_WORD = re.compile(r'\w{2,}')
+
+
+def wikitext_to_text(wikitext: str) -> str:
+    """Грубое превращение викитекста в простой текст (шаблоны, таблицы и сноски отбрасываются)"""
+    text = _COMMENT.sub('', wikitext)
+    text = _REF.sub('', text)
+    # Вложенные шаблоны снимаются изнутри наружу
+    previous = None
+    while previous != text:
+        previous = text
+        text = _TEMPLATE.sub('', text)
+    text = _TABLE.sub('', text)
+    text = _FILE_LINK.sub('', text)
+    text = _LINK.sub(r'\1', text)
+    text = _EXTERNAL_LINK.sub(r'\1', text)
+    text = _HEADING.sub(r'\1', text)
+    text = _QUOTES.sub('', text)
+    text = _TAG.sub('', text)
+    text = _LIST_MARK.sub('', text)
+    text = _SPACES.sub(' ', text)
+    text = _BLANK_LINES.sub('\n\n', text)
+    return text.strip()
+
+
+def split_passages(text: str, size: int = PASSAGE_CHARS) -> list:
+    """Режет текст на фрагменты около size символов по границам абзацев"""
+    passages = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        while len(paragraph) > size:
+            cut = paragraph.rfind(". ", 0, size)
+            cut = cut + 1 if cut > size // 2 else size
+            if current:
+                passages.append(current)
+                current = ""
+            passages.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if current and len(current) + len(paragraph) + 1 > size:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+
+# ============ ЧТЕНИЕ ДАМПОВ ============
+def _open_dump(path: str):
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def iter_xml_pages(path: str):
+    """Статьи основного пространства имён из XML-дампа MediaWiki (потоково)"""
+    with _open_dump(path) as f:
+        title = ns = text = None
+        redirect = False
+        for event, elem in ET.iterparse(f, events=("end",)):
+            name = _local_name(elem.tag)
+            if name == "title":
+                title = elem.text
+            elif name == "ns":
+                ns = elem.text
+            elif name == "redirect":
+                redirect = True
+            elif name == "text":
+                text = elem.text or ""
+            elif name == "page":
+                if title and ns == "0" and not redirect and text:
+                    yield title, text
+                title = ns = text = None
+                redirect = False
+                elem.clear()
+
+
+def iter_json_pages(path: str):
+    with _open_dump(path) as f:
+        raw = f.read().decode("utf-8")
+    stripped = raw.lstrip()
+    if stripped.startswith("["):
+        items = json.loads(raw)
+    else:
+        items = (json.loads(line) for line in raw.splitlines() if line.strip())
+    for item in items:
+        title = item.get("title")
+        text = item.get("wikitext") or item.get("text") or ""
+        if title and text:
+            yield title, text
+
+
+def iter_dump_pages(path: str):
+    name = path[:-4] if path.endswith(".bz2") else path[:-3] if path.endswith(".gz") else path
+    if name.endswith((".json", ".jsonl")):
+        return iter_json_pages(path)
+    return iter_xml_pages(path)
+
+
+def build_index(dump_path: str, index_path: str, passage_chars: int = PASSAGE_CHARS) -> dict:
+    """Собирает индекс во временный файл и атомарно подменяет им index_path"""
+    tmp_path = index_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(
+        "CREATE VIRTUAL TABLE passages USING fts5(title, body, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    pages = 0
+    passages = 0
+    batch = []
+    for title, wikitext in iter_dump_pages(dump_path):
+        pages += 1
+        for passage in split_passages(wikitext_to_text(wikitext), passage_chars):
+            batch.append((title, passage))
+        if len(batch) >= 5000:
+            conn.executemany("INSERT INTO passages (title, body) VALUES (?, ?)", batch)
+            passages += len(batch)
+            batch.clear()
+    if batch:
+        conn.executemany("INSERT INTO passages (title, body) VALUES (?, ?)", batch)
+        passages += len(batch)
+
+    conn.execute("INSERT INTO passages (passages) VALUES ('optimize')")
+    conn.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?)",
+        [("source", os.path.basename(dump_path)), ("pages", str(pages)), ("passages", str(passages))]
+    )
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, index_path)
+    return {"pages": pages, "passages": passages}
+
+
+# ============ ПОИСК ============
+def build_match_query(query: str, max_terms: int = 16) -> str:
+    """Запрос пользователя → выражение FTS5: слова через OR, каждое в кавычках"""
+    terms = []
+    for word in _WORD.findall(query.lower()):
+        if word not in terms:
+            terms.append(word)
+    return " OR ".join(f'"{term}"' for term in terms[:max_terms])
+
+
+class LocalWikiIndex:
+    """Локальный бэкенд вики с интерфейсом WikiClient.search_and_get_content.
+
+    Файл индекса открывается только при первом запросе (только чтение, mmap),
+    поиск выполняется в пуле потоков. Возвращает лучшие top_k фрагментов
+    (BM25, заголовок весит больше текста). Если индекса нет или ничего не
+    найдено, запрос уходит в fallback (обычно удалённый WikiClient).
+    """
+    def __init__(self, path: str, top_k: int = 3, max_chars: int = 800, fallback=None,
+                 mmap_size: int = 256 * 1024 * 1024):
+        self.path = path
+        self.top_k = top_k
+        self.max_chars = max_chars
+        self.fallback = fallback
+        self.mmap_size = mmap_size
+        self._conn = None
+        self._lock = threading.Lock()
+        self.available = None
+
+    async def init(self):
+        if self.fallback:
+            await self.fallback.init()
+
+    async def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+        if self.fallback:
+            await self.fallback.close()
+
+    def _connect(self):
+        if self._conn is None and self.available is not False:
+            if not os.path.exists(self.path):
+                self.available = False
+                print(f"⚠️ Локальный индекс вики не найден: {self.path}")
+                return None
+            uri = f"file:{os.path.abspath(self.path)}?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._conn.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+            self.available = True
+        return self._conn
+
+    def search(self, query: str) -> list:
+        """Лучшие фрагменты: [(title, passage), ...]"""
+        match = build_match_query(query)
+        if not match:
+            return []
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return []
+            return conn.execute(
+                """
+                SELECT title, body FROM passages
+                WHERE passages MATCH ?
+                ORDER BY bm25(passages, 10.0, 1.0)
+                LIMIT ?
+                """,
+                (match, self.top_k)
+            ).fetchall()
+
+    def format_passages(self, passages: list) -> str:
+        parts = []
+        length = 0
+        for title, body in passages:
+            part = f"{title}: {body}"
+            if parts and length + len(part) + 2 > self.max_chars:
+                break
+            parts.append(part)
+            length += len(part) + 2
+        return "\n\n".join(parts)[:self.max_chars]
+
+    async def search_and_get_content(self, query: str) -> str:
+        return (await self.lookup(query))[1]
+
+    async def lookup(self, query: str) -> tuple:
+        """Запрос → (заголовок лучшего фрагмента, текст фрагментов); ("", ""), если ничего нет"""
+        try:
+            passages = await asyncio.to_thread(self.search, query)
+        except sqlite3.Error as e:
+            print(f"⚠️ Ошибка локального индекса вики: {e}")
+            passages = []
+        if passages:
+            return passages[0][0], self.format_passages(passages)
+        if self.fallback:
+            return await self.fallback.lookup(query)
+        return "", ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="собрать индекс из дампа")
+    build.add_argument("dump")
+    build.add_argument("-o", "--output", default="wiki_index.db")
+    build.add_argument("--passage-chars", type=int, default=PASSAGE_CHARS)
+
+    search = sub.add_parser("search", help="поиск по готовому индексу")
+    search.add_argument("index")
+    search.add_argument("query")
+    search.add_argument("-k", "--top-k", type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        stats = build_index(args.dump, args.output, args.passage_chars)
+        print(f"✅ Индекс собран: {args.output}, статей {stats['pages']}, фрагментов {stats['passages']}")
+    else:
+        index = LocalWikiIndex(args.index, top_k=args.top_k)
+        for title, body in index.search(args.query):
+            print(f"## {title}\n{body}\n")
+
+
+if __name__ == "__main__":
+    main()